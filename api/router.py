@@ -2,16 +2,48 @@
 This file is responsible for routing the incoming requests to the respective endpoints.
 """
 
-from fastapi.responses import JSONResponse
-from fastapi import APIRouter, Request
-from pydantic import BaseModel
+import json
+import logging
+
+from typing import Union
+
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi import APIRouter, Depends, Query, Request
+from pydantic import BaseModel, Field
 from fastapi.templating import Jinja2Templates
 
+from config.main import config
 from services.chat import ChatService
+from services.metrics import registry
+from services.neighbors import NeighborIndex
+from services.postgres_searcher import PostgresSearcher
+
+logger = logging.getLogger(__name__)
 
 api_router = APIRouter()
 templates = Jinja2Templates(directory="templates")
-chat_service = ChatService()
+
+
+def get_chat_service(request: Request) -> ChatService:
+    """
+    Returns the chat service created by the application lifespan.
+    """
+    return request.app.state.chat_service
+
+
+def get_searcher(request: Request) -> PostgresSearcher:
+    """
+    Returns the product searcher of the chat service.
+    """
+    return request.app.state.chat_service.searcher
+
+
+def get_neighbor_index(request: Request) -> NeighborIndex:
+    """
+    Returns the precomputed product neighbors created by the application
+    lifespan.
+    """
+    return request.app.state.neighbor_index
 
 
 class ChatRequest(BaseModel):
@@ -31,11 +63,13 @@ async def tester(request: Request):
 
 
 @api_router.post("/chat", response_class=JSONResponse)
-async def chat(chat_request: ChatRequest):
+async def chat(
+    chat_request: ChatRequest, chat_service: ChatService = Depends(get_chat_service)
+):
     """
     This function is used to chat with the chatbot.
     """
-    response, product_recommendations = chat_service.generate_response(
+    response, product_recommendations = await chat_service.agenerate_response(
         chat_request.query
     )
     return {
@@ -44,3 +78,220 @@ async def chat(chat_request: ChatRequest):
             product.to_dict() for product in product_recommendations
         ],
     }
+
+
+def server_sent_event(event: str, data) -> str:
+    """
+    Formats an event of the Server-Sent Events stream, data is JSON encoded.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def chat_events(chat_service: ChatService, query: str):
+    """
+    Converts the chat service stream into Server-Sent Events.
+    """
+    try:
+        async for event, data in chat_service.astream_response(query):
+            if event == "products":
+                data = [product.to_dict() for product in data]
+            yield server_sent_event(event, data)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Chat stream failed")
+        yield server_sent_event("error", "Error generating the response.")
+
+
+@api_router.post("/chat/stream")
+async def chat_stream(
+    chat_request: ChatRequest, chat_service: ChatService = Depends(get_chat_service)
+):
+    """
+    Streaming counterpart of `/chat`: the product recommendations are sent as
+    soon as the search returns, followed by the tokens of the answer, as
+    Server-Sent Events (`products`, `token`, `done` and `error`).
+    """
+    return StreamingResponse(
+        chat_events(chat_service, chat_request.query),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+class SearchRequest(BaseModel):
+    """
+    This class is used to model the request for the search endpoint.
+    """
+
+    query: str
+    limit: int = Field(default=10, ge=1, le=100)
+    offset: int = Field(default=0, ge=0)
+    filters: Union[list[dict], None] = None
+    enable_vector_search: bool = True
+    enable_text_search: bool = True
+    facets: bool = False
+
+
+@api_router.post("/search", response_class=JSONResponse)
+async def search(
+    search_request: SearchRequest, searcher: PostgresSearcher = Depends(get_searcher)
+):
+    """
+    Searches the products without the LLM. The fused ranking is paged with
+    offset and limit (next_offset is null on the last page). Every page is
+    ranked over the same SEARCH_MAX_RESULTS candidates per leg, so the pages
+    neither overlap nor skip products, and offsets past them are rejected.
+    The facets count these fused candidates on request, not every product
+    matching the query.
+    """
+    if not (search_request.enable_vector_search or search_request.enable_text_search):
+        return JSONResponse(
+            {"detail": "Enable the vector or the text search."}, status_code=422
+        )
+    if search_request.offset + search_request.limit > config.SEARCH_MAX_RESULTS:
+        return JSONResponse(
+            {"detail": f"Only the first {config.SEARCH_MAX_RESULTS} results can be paged."},
+            status_code=422,
+        )
+    try:
+        # One more row tells whether there is a next page.
+        products = await searcher.asearch_and_embed(
+            search_request.query,
+            top=search_request.limit + 1,
+            candidates=config.SEARCH_MAX_RESULTS,
+            enable_vector_search=search_request.enable_vector_search,
+            enable_text_search=search_request.enable_text_search,
+            filters=search_request.filters,
+            offset=search_request.offset,
+            facets=search_request.facets,
+        )
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=422)
+    has_more = len(products) > search_request.limit
+    response = {
+        "products": [
+            dict(product.to_dict(), search_info=product.search_info)
+            for product in products[: search_request.limit]
+        ],
+        "offset": search_request.offset,
+        "limit": search_request.limit,
+        "next_offset": (
+            search_request.offset + search_request.limit if has_more else None
+        ),
+    }
+    if search_request.facets:
+        response["facets"] = products.facets
+    return response
+
+
+@api_router.get("/products/{product_id}/similar", response_class=JSONResponse)
+async def similar_products(
+    product_id: int,
+    top: int = Query(default=5, ge=1, le=100),
+    filters: Union[str, None] = Query(
+        default=None, description="JSON encoded list of search filters"
+    ),
+    live: bool = False,
+    searcher: PostgresSearcher = Depends(get_searcher),
+    neighbor_index: NeighborIndex = Depends(get_neighbor_index),
+):
+    """
+    Returns the products most similar to product_id. Without filters, they
+    are read from the precomputed neighbors when these cover top, otherwise
+    (or with live) they are searched with the product's stored embedding.
+    """
+    try:
+        parsed_filters = json.loads(filters) if filters else None
+    except json.JSONDecodeError:
+        return JSONResponse({"detail": "filters must be JSON encoded."}, status_code=422)
+
+    source = "precomputed"
+    products = None
+    if not (live or parsed_filters) and top <= neighbor_index.k:
+        products = await neighbor_index.aneighbors(product_id, top)
+    if not products:
+        source = "live"
+        try:
+            products = await searcher.asimilar_to(product_id, top, parsed_filters)
+        except ValueError as e:
+            return JSONResponse({"detail": str(e)}, status_code=422)
+    if products is None:
+        return JSONResponse({"detail": "Product not found."}, status_code=404)
+    return {
+        "product_id": product_id,
+        "source": source,
+        "products": [
+            dict(product.to_dict(), search_info=product.search_info)
+            for product in products
+        ],
+    }
+
+
+class BatchSearchRequest(BaseModel):
+    """
+    This class is used to model the request for the batch search endpoint,
+    the options apply to all the queries.
+    """
+
+    queries: list[str] = Field(min_length=1, max_length=config.SEARCH_BATCH_MAX_QUERIES)
+    top: int = Field(default=5, ge=1, le=100)
+    filters: Union[list[dict], None] = None
+    enable_vector_search: bool = True
+    enable_text_search: bool = True
+
+
+async def batch_search_results(searcher: PostgresSearcher, search: BatchSearchRequest):
+    """
+    Searches the queries in chunks of SEARCH_BATCH_SIZE and yields one JSON
+    line per query, in order, as soon as its chunk has been searched.
+    """
+    try:
+        for start in range(0, len(search.queries), config.SEARCH_BATCH_SIZE):
+            queries = search.queries[start : start + config.SEARCH_BATCH_SIZE]
+            results = await searcher.asearch_many(
+                queries,
+                top=search.top,
+                enable_vector_search=search.enable_vector_search,
+                enable_text_search=search.enable_text_search,
+                filters=search.filters,
+            )
+            for i, (query, hits) in enumerate(zip(queries, results)):
+                line = {
+                    "query_index": start + i,
+                    "query": query,
+                    "products": [
+                        dict(product.to_dict(), search_info=search_info)
+                        for product, search_info in hits
+                    ],
+                }
+                yield json.dumps(line) + "\n"
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Batch search failed")
+        yield json.dumps({"error": "Error searching the products."}) + "\n"
+
+
+@api_router.post("/search/batch")
+async def search_batch(
+    search: BatchSearchRequest, searcher: PostgresSearcher = Depends(get_searcher)
+):
+    """
+    Searches many queries in one request. The results are streamed as JSON
+    lines (`{"query_index", "query", "products"}`), one per query in the
+    order of the queries, ending with an `{"error"}` line if a chunk fails.
+    """
+    if not (search.enable_vector_search or search.enable_text_search):
+        return JSONResponse(
+            {"detail": "Enable the vector or the text search."}, status_code=422
+        )
+    return StreamingResponse(
+        batch_search_results(searcher, search), media_type="application/x-ndjson"
+    )
+
+
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Exports the metrics in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,4 @@
+"""
+    This folder contains the offline relevance and latency benchmarks of the
+    search stack. See benchmarks/run.py.
+"""
@@ -0,0 +1,92 @@
+"""
+    This module generates the synthetic catalog and the labeled queries used by
+    the benchmarks. Products follow the notebooks/product_schema.py schema.
+"""
+
+import random
+import sys
+
+sys.path.append("notebooks")
+
+from product_schema import Product as ProductSchema  # pylint: disable=wrong-import-position
+
+CATEGORIES = {
+    "Summer Wear": ["t-shirt", "shorts", "sundress", "tank top", "swimsuit"],
+    "Winter Wear": ["hoodie", "jacket", "sweater", "beanie", "gloves"],
+    "Footwear": ["sneakers", "boots", "rain boots", "slippers", "sandals"],
+    "Sleepwear": ["pajama set", "nightgown", "bathrobe", "sleep sack"],
+    "Accessories": ["backpack", "sunglasses", "umbrella", "cap", "scarf"],
+    "Formal Wear": ["shirt", "blazer", "party dress", "trousers", "bow tie"],
+}
+ADJECTIVES = [
+    "colorful", "warm", "lightweight", "waterproof", "cozy",
+    "striped", "floral", "classic", "sporty", "glittery",
+]
+THEMES = [
+    "dinosaur", "unicorn", "space", "rainbow", "animal",
+    "superhero", "ocean", "forest", "robot", "princess",
+]
+AGE_GROUPS = ["1-3", "3-6", "4-8", "6-12", "8-14"]
+SIZES = ["XS", "S", "M", "L", "XL"]
+
+
+def generate_catalog(rows: int, seed: int = 0):
+    """
+    Yields (product, attributes) pairs, product being a dict validated against
+    the product schema and attributes the generating terms used for labeling.
+    """
+    rng = random.Random(seed)
+    categories = list(CATEGORIES)
+    for i in range(rows):
+        category = rng.choice(categories)
+        noun = rng.choice(CATEGORIES[category])
+        adjective = rng.choice(ADJECTIVES)
+        theme = rng.choice(THEMES)
+        product = ProductSchema(
+            name=f"{adjective.title()} {theme.title()} {noun.title()} #{i}",
+            description=(
+                f"A {adjective} {noun} with a {theme} design, "
+                f"part of our {category.lower()} collection for kids."
+            ),
+            category=category,
+            price=round(rng.uniform(5, 80), 2),
+            currency="USD",
+            available_stock=rng.randint(0, 500),
+            rating=round(rng.uniform(2.5, 5), 1),
+            age_group=rng.choice(AGE_GROUPS),
+            sizes=sorted(rng.sample(SIZES, rng.randint(1, 4)), key=SIZES.index),
+        ).model_dump(mode="json")
+        product["sku"] = f"bench-{i}"
+        yield product, {"category": category, "noun": noun, "adjective": adjective}
+
+
+def generate_queries(count: int, seed: int = 1):
+    """
+    Returns labeled queries: their text and the terms a product must share to
+    be relevant (see `relevance`).
+    """
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        category = rng.choice(list(CATEGORIES))
+        noun = rng.choice(CATEGORIES[category])
+        adjective = rng.choice(ADJECTIVES)
+        queries.append(
+            {
+                "text": f"{adjective} {noun} for kids",
+                "noun": noun,
+                "adjective": adjective,
+                "category": category,
+            }
+        )
+    return queries
+
+
+def relevance(query: dict, attributes: dict) -> int:
+    """
+    Graded relevance of a product for a query: 2 for the same item with the
+    same adjective, 1 for the same item, 0 otherwise.
+    """
+    if attributes["noun"] != query["noun"]:
+        return 0
+    return 2 if attributes["adjective"] == query["adjective"] else 1
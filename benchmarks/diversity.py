@@ -0,0 +1,83 @@
+"""
+    This file measures the cost of the diversity re-ranking (services/diversity.py)
+    in process: the decoding of the binary embeddings of the pool and the
+    MMR re-ranking, on random candidates. No database is needed.
+
+        python -m benchmarks.diversity --pool 200 --k 10
+"""
+
+# pylint:disable=wrong-import-position
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(".")
+
+from services.diversity import MMRDiversity, decode_vectors
+
+from benchmarks.run import percentiles
+
+
+def encode_vector(vector: np.ndarray) -> bytes:
+    """
+    Returns the binary form of a pgvector vector, as sent by `vector_send`.
+    """
+    header = np.array([len(vector), 0], dtype=">i2").tobytes()
+    return header + vector.astype(">f4").tobytes()
+
+
+def measure(function, repeats: int) -> dict:
+    latencies = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - started)
+    return percentiles(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pool", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--groups", type=int, default=8)
+    parser.add_argument("--mmr-lambda", type=float, default=0.7)
+    parser.add_argument("--max-per-group", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # Clusters of near duplicates, as the variants of a product.
+    centers = rng.standard_normal((args.pool // 5 + 1, args.dimensions))
+    vectors = centers[np.arange(args.pool) // 5] + 0.1 * rng.standard_normal(
+        (args.pool, args.dimensions)
+    )
+    values = [encode_vector(vector) for vector in vectors]
+    scores = np.sort(rng.random(args.pool).astype(np.float32))[::-1]
+    groups = rng.integers(0, args.groups, args.pool)
+    decoded = decode_vectors(values, args.dimensions)
+
+    report = {
+        "pool": args.pool,
+        "k": args.k,
+        "dimensions": args.dimensions,
+        "decode_ms": measure(lambda: decode_vectors(values, args.dimensions), args.repeats),
+        "mmr_ms": measure(
+            lambda: MMRDiversity(args.mmr_lambda).rerank(scores, decoded, args.k),
+            args.repeats,
+        ),
+        "mmr_capped_ms": measure(
+            lambda: MMRDiversity(args.mmr_lambda, max_per_group=args.max_per_group).rerank(
+                scores, decoded, args.k, groups
+            ),
+            args.repeats,
+        ),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
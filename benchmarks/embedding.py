@@ -0,0 +1,53 @@
+"""
+    This module contains a deterministic, offline stand-in for
+    services.embedding.Embedding used by the benchmarks.
+"""
+
+import hashlib
+
+import numpy as np
+
+
+class DeterministicEmbedding:
+    """
+    Embeds a text as the normalized sum of pseudo-random vectors seeded by its
+    tokens, so that texts sharing words get similar embeddings and the same
+    text always gets the same embedding, without any network call.
+    """
+
+    def __init__(self, dimensions: int = 1536):
+        self.dimensions = dimensions
+        self.embedding_model_name = f"deterministic-{dimensions}"
+        self.token_vectors: dict[str, np.ndarray] = {}
+
+    def token_vector(self, token: str) -> np.ndarray:
+        vector = self.token_vectors.get(token)
+        if vector is None:
+            seed = int.from_bytes(hashlib.sha256(token.encode()).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(
+                self.dimensions, dtype=np.float32
+            )
+            self.token_vectors[token] = vector
+        return vector
+
+    def embed(self, content: str) -> list[float]:
+        tokens = "".join(
+            c if c.isalnum() else " " for c in content.lower()
+        ).split()
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for token in tokens:
+            vector += self.token_vector(token)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def generate(self, content, dimensions=None):
+        return self.embed(content)
+
+    def generate_multiple(self, contents, dimensions=None):
+        return [self.embed(content) for content in contents]
+
+    async def agenerate(self, content, dimensions=None):
+        return self.embed(content)
+
+    async def agenerate_multiple(self, contents, dimensions=None):
+        return [self.embed(content) for content in contents]
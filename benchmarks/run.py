@@ -0,0 +1,340 @@
+"""
+    This file runs the offline relevance and latency benchmark of the search
+    stack: it loads a synthetic catalog embedded by a deterministic local
+    embedder, runs a labeled query set through the vector, text and hybrid
+    modes and writes latency percentiles, QPS, recall@k against exact search
+    and nDCG@k to a JSON file, so runs can be compared across commits.
+
+    Run it from the root of the repository against a dedicated database:
+
+        DATABASE_NAME=benchmark python -m benchmarks.run --rows 100000
+"""
+
+# pylint:disable=wrong-import-position
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+
+sys.path.append(".")
+
+from sqlalchemy import text
+
+from config.main import config
+from models.database import get_db_session
+from models.product import Product
+from models.schema import migrate
+from services.ingestion import IngestionPipeline
+from services.diversity import MMRDiversity
+from services.postgres_searcher import PostgresSearcher
+from services.vector_snapshot import VectorSnapshotTier, build_snapshot
+
+from benchmarks.catalog import generate_catalog, generate_queries, relevance
+from benchmarks.embedding import DeterministicEmbedding
+
+logger = logging.getLogger(__name__)
+
+MODES = ("vector", "text", "hybrid")
+
+
+def load_catalog(rows: int, embedding: DeterministicEmbedding, seed: int):
+    """
+    Replaces the benchmark products (sku `bench-*`) with a catalog of `rows`
+    products and returns the generating attributes of each product by sku.
+    """
+    migrate()
+    attributes = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "catalog.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for product, product_attributes in generate_catalog(rows, seed):
+                attributes[product["sku"]] = product_attributes
+                f.write(json.dumps(product) + "\n")
+        with get_db_session() as db_session:
+            db_session.execute(
+                text(f"DELETE FROM \"{Product.__tablename__}\" WHERE sku LIKE 'bench-%'")
+            )
+            db_session.commit()
+        IngestionPipeline(Product, embedding).run(path, rebuild_index=True)
+    with get_db_session() as db_session:
+        db_session.execute(text(f'ANALYZE "{Product.__tablename__}"'))
+        db_session.commit()
+    return attributes
+
+
+def catalog_attributes(rows: int, seed: int):
+    return {
+        product["sku"]: product_attributes
+        for product, product_attributes in generate_catalog(rows, seed)
+    }
+
+
+def mode_arguments(mode: str, query: dict):
+    if mode == "vector":
+        return None, query["vector"]
+    if mode == "text":
+        return query["text"], []
+    return query["text"], query["vector"]
+
+
+def exact_ids(searcher: PostgresSearcher, mode: str, query: dict, k: int):
+    """
+    Returns the ids ranked by the same query with the vector leg computed
+    exactly, i.e. without the ANN index.
+    """
+    query_text, query_vector = mode_arguments(mode, query)
+    sql, params = searcher.build_search_query(
+        query_text, query_vector, vector_strategy="exact", top=k
+    )
+    with get_db_session() as db_session:
+        return [row.id for row in db_session.execute(sql, params)]
+
+
+def ndcg(gains: list[int], ideal_gains: list[int], k: int) -> float:
+    def dcg(values):
+        return sum((2**gain - 1) / math.log2(i + 2) for i, gain in enumerate(values[:k]))
+
+    ideal = dcg(sorted(ideal_gains, reverse=True))
+    return dcg(gains) / ideal if ideal else 0.0
+
+
+def ideal_gains(query: dict, counts: Counter, k: int) -> list[int]:
+    exact = counts[(query["noun"], query["adjective"])]
+    partial = sum(
+        count for (noun, _), count in counts.items() if noun == query["noun"]
+    ) - exact
+    return ([2] * min(exact, k) + [1] * min(partial, k))[:k]
+
+
+def percentiles(latencies: list[float]) -> dict:
+    values = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {
+        "p50": round(float(values[0]), 3),
+        "p95": round(float(values[1]), 3),
+        "p99": round(float(values[2]), 3),
+        "mean": round(float(np.mean(latencies) * 1000), 3),
+    }
+
+
+async def benchmark_mode(
+    searcher: PostgresSearcher,
+    mode: str,
+    queries: list[dict],
+    attributes: dict,
+    counts: Counter,
+    k: int,
+    concurrency: int,
+    rounds: int,
+    ef_search,
+    diversity=None,
+):
+    """
+    Returns the latency, throughput, recall and nDCG of a search mode.
+    """
+
+    async def search(query):
+        query_text, query_vector = mode_arguments(mode, query)
+        return await searcher.asearch(
+            query_text, query_vector, top=k, ef_search=ef_search, diversity=diversity
+        )
+
+    # Warm up the connection pool and the caches.
+    for query in queries[: min(len(queries), 5)]:
+        await search(query)
+
+    latencies, recalls, ndcgs = [], [], []
+    for query in queries:
+        started = time.perf_counter()
+        items = await search(query)
+        latencies.append(time.perf_counter() - started)
+
+        ids = [item.id for item in items]
+        expected = exact_ids(searcher, mode, query, k)
+        if expected:
+            recalls.append(len(set(ids) & set(expected)) / len(expected))
+        gains = [
+            relevance(query, attributes[item.sku]) if item.sku in attributes else 0
+            for item in items
+        ]
+        ndcgs.append(ndcg(gains, ideal_gains(query, counts, k), k))
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded_search(query):
+        async with semaphore:
+            await search(query)
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(bounded_search(query) for _ in range(rounds) for query in queries)
+    )
+    elapsed = time.perf_counter() - started
+
+    return {
+        "latency_ms": percentiles(latencies),
+        "qps": round(rounds * len(queries) / elapsed, 2),
+        f"recall@{k}": round(float(np.mean(recalls)), 4) if recalls else None,
+        f"ndcg@{k}": round(float(np.mean(ndcgs)), 4),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    embedding = DeterministicEmbedding()
+    if args.skip_load:
+        attributes = catalog_attributes(args.rows, args.seed)
+    else:
+        attributes = load_catalog(args.rows, embedding, args.seed)
+    counts = Counter(
+        (product["noun"], product["adjective"]) for product in attributes.values()
+    )
+
+    queries = generate_queries(args.queries, args.seed + 1)
+    vectors = embedding.generate_multiple([query["text"] for query in queries])
+    for query, vector in zip(queries, vectors):
+        query["vector"] = vector
+
+    vector_tier = None
+    if args.vector_snapshot:
+        directory = tempfile.mkdtemp(prefix="vector_snapshot")
+        build_snapshot(
+            Product, directory, dtype=args.snapshot_dtype, lists=args.snapshot_lists
+        )
+        vector_tier = VectorSnapshotTier(
+            Product, directory, probes=args.snapshot_probes, check_interval=3600
+        )
+        vector_tier.refresh()
+    searcher = PostgresSearcher(Product, vector_tier=vector_tier)
+    diversity = None
+    if args.mmr_lambda is not None or args.max_per_group is not None:
+        diversity = MMRDiversity(
+            1.0 if args.mmr_lambda is None else args.mmr_lambda,
+            args.diversity_pool,
+            args.max_per_group,
+            dimensions=args.diversity_dimensions,
+        )
+    with get_db_session() as db_session:
+        server_version = db_session.execute(text("SHOW server_version")).scalar()
+
+    report = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "server_version": server_version,
+        "rows": args.rows,
+        "queries": len(queries),
+        "k": args.k,
+        "concurrency": args.concurrency,
+        "rounds": args.rounds,
+        "ef_search": args.ef_search,
+        "fusion": config.FUSION_METHOD,
+        "vector_index": f"{Product.vector_index_method}/{Product.vector_metric}",
+        "vector_index_type": Product.vector_index_type,
+        "vector_index_dimensions": Product.vector_index_dimensions,
+        "vector_rerank_oversampling": config.VECTOR_RERANK_OVERSAMPLING,
+        "vector_snapshot": (
+            {
+                "dtype": args.snapshot_dtype,
+                "lists": args.snapshot_lists,
+                "probes": args.snapshot_probes,
+            }
+            if args.vector_snapshot
+            else None
+        ),
+        "diversity": (
+            {
+                "mmr_lambda": diversity.mmr_lambda,
+                "pool": diversity.pool,
+                "max_per_group": diversity.max_per_group,
+                "dimensions": diversity.dimensions,
+            }
+            if diversity is not None
+            else None
+        ),
+        "modes": {},
+    }
+    for mode in args.modes:
+        logger.info("Benchmarking %s search", mode)
+        report["modes"][mode] = await benchmark_mode(
+            searcher,
+            mode,
+            queries,
+            attributes,
+            counts,
+            args.k,
+            args.concurrency,
+            args.rounds,
+            args.ef_search,
+            diversity,
+        )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--rows", type=int, default=10_000, help="catalog size, eg 10000, 100000 or 1000000"
+    )
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="passes over the queries to measure QPS"
+    )
+    parser.add_argument("--ef-search", type=int, default=None)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--skip-load",
+        action="store_true",
+        help="reuse the catalog loaded by a previous run with the same rows and seed",
+    )
+    parser.add_argument(
+        "--vector-snapshot",
+        action="store_true",
+        help="serve the vector leg from an in-process snapshot (services/vector_snapshot.py)",
+    )
+    parser.add_argument(
+        "--snapshot-lists", type=int, default=0, help="IVF lists of the snapshot, 0 for exact"
+    )
+    parser.add_argument("--snapshot-probes", type=int, default=8)
+    parser.add_argument(
+        "--snapshot-dtype", choices=("float16", "float32"), default="float32"
+    )
+    parser.add_argument(
+        "--mmr-lambda",
+        type=float,
+        default=None,
+        help="re-rank the results for diversity (services/diversity.py)",
+    )
+    parser.add_argument("--max-per-group", type=int, default=None, help="results per category")
+    parser.add_argument("--diversity-pool", type=int, default=200)
+    parser.add_argument("--diversity-dimensions", type=int, default=None)
+    parser.add_argument("--output", default="benchmarks/results.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    report = asyncio.run(run(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["modes"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@
 """
 
 import os
+from typing import Union
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,17 +14,246 @@ class Config(object):
     Base configuration class. Contains all the default configurations.
     """
 
+    # LLM and embedding APIs.
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY")
     GROQ_API_KEY: str = os.getenv("GROQ_API_KEY")
+
+    # Database and connection pools.
     DATABASE_NAME: str = os.getenv("DATABASE_NAME")
     DATABASE_USER: str = os.getenv("DATABASE_USER")
     DATABASE_PASSWORD: str = os.getenv("DATABASE_PASSWORD")
     DATABASE_URL: str = os.getenv("DATABASE_URL")
     DATABASE_PORT: str = os.getenv("DATABASE_PORT")
+    # Used by both the sync and the async engines: psycopg 3 has both APIs
+    # and supports server-side prepared statements.
     SQLALCHEMY_DATABASE_URL: str = (
-        f"postgresql://{DATABASE_USER}:{DATABASE_PASSWORD}@"
+        f"postgresql+psycopg://{DATABASE_USER}:{DATABASE_PASSWORD}@"
         f"{DATABASE_URL}:{DATABASE_PORT}/{DATABASE_NAME}"
     )
 
+    # Connection pools, sized per engine (each worker process has a sync and
+    # an async engine). psycopg prepares a statement on the server once it has
+    # been run DATABASE_PREPARE_THRESHOLD times on a connection, 0 prepares
+    # every statement and "none" disables prepared statements (needed behind
+    # PgBouncer older than 1.21 in transaction mode, see the README).
+    DATABASE_POOL_SIZE: int = int(os.getenv("DATABASE_POOL_SIZE", "10"))
+    DATABASE_MAX_OVERFLOW: int = int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
+    DATABASE_POOL_TIMEOUT: float = float(os.getenv("DATABASE_POOL_TIMEOUT", "30"))
+    DATABASE_POOL_RECYCLE: int = int(os.getenv("DATABASE_POOL_RECYCLE", "3600"))
+    DATABASE_PREPARE_THRESHOLD: Union[int, None] = (
+        None
+        if os.getenv("DATABASE_PREPARE_THRESHOLD", "2").lower() == "none"
+        else int(os.getenv("DATABASE_PREPARE_THRESHOLD", "2"))
+    )
+
+    # Startup of the application workers. MIGRATE_ON_STARTUP runs the schema
+    # migrations (scripts/migrate.py) on startup, which is convenient with a
+    # single worker. The warmup prewarms the product indexes with pg_prewarm
+    # (and the table with WARMUP_PREWARM_TABLE), opens WARMUP_CONNECTIONS
+    # pooled connections and runs the comma separated WARMUP_QUERIES.
+    MIGRATE_ON_STARTUP: bool = os.getenv("MIGRATE_ON_STARTUP", "false").lower() in (
+        "1",
+        "true",
+    )
+    WARMUP_ON_STARTUP: bool = os.getenv("WARMUP_ON_STARTUP", "true").lower() in (
+        "1",
+        "true",
+    )
+    WARMUP_PREWARM_TABLE: bool = os.getenv(
+        "WARMUP_PREWARM_TABLE", "false"
+    ).lower() in ("1", "true")
+    WARMUP_CONNECTIONS: int = int(os.getenv("WARMUP_CONNECTIONS", "2"))
+    WARMUP_QUERIES: str = os.getenv("WARMUP_QUERIES", "")
+
+    # Product and query embeddings.
+
+    # Comma separated Product fields making up the embedded text, eg
+    # "name,description,category,age_group". Defaults to
+    # Product.embedding_fields.
+    EMBEDDING_FIELDS: str = os.getenv("EMBEDDING_FIELDS")
+
+    # Query-embedding cache. EMBEDDING_CACHE_BACKEND is one of "memory",
+    # "sqlite" (shared by the workers of one host) or "postgres".
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+    EMBEDDING_CACHE_TTL: int = int(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+    EMBEDDING_CACHE_BACKEND: str = os.getenv("EMBEDDING_CACHE_BACKEND", "memory")
+    EMBEDDING_CACHE_PATH: str = os.getenv(
+        "EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3"
+    )
+
+    # Hybrid search: fusion, direct search, batch search and diversity.
+
+    # Hybrid search fusion. FUSION_METHOD is "rrf", "minmax" or "zscore".
+    # SEARCH_CANDIDATES is the number of rows fetched by each search leg.
+    FUSION_METHOD: str = os.getenv("FUSION_METHOD", "rrf")
+    RRF_K: int = int(os.getenv("RRF_K", "60"))
+    FUSION_VECTOR_WEIGHT: float = float(os.getenv("FUSION_VECTOR_WEIGHT", "1.0"))
+    FUSION_TEXT_WEIGHT: float = float(os.getenv("FUSION_TEXT_WEIGHT", "1.0"))
+    SEARCH_CANDIDATES: int = int(os.getenv("SEARCH_CANDIDATES", "20"))
+
+    # Direct search. /search pages through the first SEARCH_MAX_RESULTS fused
+    # results, each leg fetching SEARCH_MAX_RESULTS rows on every page, and
+    # counts the prices in the buckets bounded by SEARCH_PRICE_FACET_BOUNDS
+    # (comma separated, increasing).
+    SEARCH_MAX_RESULTS: int = int(os.getenv("SEARCH_MAX_RESULTS", "200"))
+    SEARCH_PRICE_FACET_BOUNDS: str = os.getenv(
+        "SEARCH_PRICE_FACET_BOUNDS", "10,20,50,100"
+    )
+
+    # Batch search. /search/batch embeds and ranks the queries in chunks of
+    # SEARCH_BATCH_SIZE, each one embedding call and one SQL statement, and
+    # accepts at most SEARCH_BATCH_MAX_QUERIES queries per request.
+    SEARCH_BATCH_SIZE: int = int(os.getenv("SEARCH_BATCH_SIZE", "100"))
+    SEARCH_BATCH_MAX_QUERIES: int = int(os.getenv("SEARCH_BATCH_MAX_QUERIES", "10000"))
+
+    # Diversity re-ranking of the chat searches (see services/diversity.py).
+    # The DIVERSITY_POOL best fused candidates are re-ranked by Maximal
+    # Marginal Relevance with DIVERSITY_MMR_LAMBDA (1 keeps the fused order,
+    # lower values favor diversity), and at most DIVERSITY_MAX_PER_GROUP
+    # results share a DIVERSITY_GROUP_FIELD value. Disabled while both
+    # DIVERSITY_MMR_LAMBDA and DIVERSITY_MAX_PER_GROUP are "none".
+    # DIVERSITY_DIMENSIONS only compares the first dimensions of the
+    # embeddings, which is valid for Matryoshka embeddings.
+    DIVERSITY_MMR_LAMBDA: Union[float, None] = (
+        None
+        if os.getenv("DIVERSITY_MMR_LAMBDA", "none").lower() == "none"
+        else float(os.getenv("DIVERSITY_MMR_LAMBDA"))
+    )
+    DIVERSITY_POOL: int = int(os.getenv("DIVERSITY_POOL", "200"))
+    DIVERSITY_MAX_PER_GROUP: Union[int, None] = (
+        None
+        if os.getenv("DIVERSITY_MAX_PER_GROUP", "none").lower() == "none"
+        else int(os.getenv("DIVERSITY_MAX_PER_GROUP"))
+    )
+    DIVERSITY_GROUP_FIELD: str = os.getenv("DIVERSITY_GROUP_FIELD", "category")
+    DIVERSITY_DIMENSIONS: Union[int, None] = (
+        None
+        if os.getenv("DIVERSITY_DIMENSIONS", "none").lower() == "none"
+        else int(os.getenv("DIVERSITY_DIMENSIONS"))
+    )
+
+    # Vector search: filtered search, compact index, snapshot and neighbors.
+
+    # Filtered vector search. Filters matching at most EXACT_SEARCH_MAX_ROWS
+    # rows (as estimated by the planner) are ranked exactly, otherwise the ANN
+    # scan is widened up to VECTOR_SEARCH_MAX_CANDIDATES rows (the HNSW
+    # ef_search limit is 1000). PARTIAL_VECTOR_INDEX_VALUES is a comma
+    # separated list of categories that get their own partial HNSW index.
+    EXACT_SEARCH_MAX_ROWS: int = int(os.getenv("EXACT_SEARCH_MAX_ROWS", "20000"))
+    VECTOR_SEARCH_MAX_CANDIDATES: int = int(
+        os.getenv("VECTOR_SEARCH_MAX_CANDIDATES", "1000")
+    )
+    PARTIAL_VECTOR_INDEX_VALUES: str = os.getenv("PARTIAL_VECTOR_INDEX_VALUES")
+
+    # Compact ANN index. VECTOR_INDEX_TYPE is "vector", "halfvec" (half the
+    # size) or "bit" (binary quantized, 32 times smaller) and
+    # VECTOR_INDEX_DIMENSIONS truncates the indexed embeddings, eg 512. The
+    # index then returns VECTOR_RERANK_OVERSAMPLING times the candidates,
+    # which are reranked with the full embeddings.
+    VECTOR_INDEX_TYPE: str = os.getenv("VECTOR_INDEX_TYPE", "vector")
+    VECTOR_INDEX_DIMENSIONS: Union[int, None] = (
+        int(os.getenv("VECTOR_INDEX_DIMENSIONS"))
+        if os.getenv("VECTOR_INDEX_DIMENSIONS")
+        else None
+    )
+    VECTOR_RERANK_OVERSAMPLING: int = int(
+        os.getenv("VECTOR_RERANK_OVERSAMPLING", "4")
+    )
+
+    # In-process vector search tier, see services/vector_snapshot.py.
+    # VECTOR_SNAPSHOT_MODE is "off", "on" or "overload" (only while the
+    # database pools have more than VECTOR_SNAPSHOT_POOL_THRESHOLD of their
+    # connections checked out). The workers look for a new snapshot in
+    # VECTOR_SNAPSHOT_DIR every VECTOR_SNAPSHOT_CHECK_INTERVAL seconds and
+    # scan VECTOR_SNAPSHOT_PROBES lists of a partitioned snapshot.
+    VECTOR_SNAPSHOT_MODE: str = os.getenv("VECTOR_SNAPSHOT_MODE", "off")
+    VECTOR_SNAPSHOT_DIR: str = os.getenv("VECTOR_SNAPSHOT_DIR", "vector_snapshot")
+    VECTOR_SNAPSHOT_PROBES: int = int(os.getenv("VECTOR_SNAPSHOT_PROBES", "8"))
+    VECTOR_SNAPSHOT_CHECK_INTERVAL: float = float(
+        os.getenv("VECTOR_SNAPSHOT_CHECK_INTERVAL", "30")
+    )
+    VECTOR_SNAPSHOT_POOL_THRESHOLD: float = float(
+        os.getenv("VECTOR_SNAPSHOT_POOL_THRESHOLD", "0.8")
+    )
+    # Changed embeddings received from the change feed are applied to the
+    # snapshot in memory, up to VECTOR_SNAPSHOT_MAX_CHANGES products.
+    VECTOR_SNAPSHOT_MAX_CHANGES: int = int(
+        os.getenv("VECTOR_SNAPSHOT_MAX_CHANGES", "10000")
+    )
+
+    # Precomputed product neighbors. NEIGHBORS_K neighbors are stored per
+    # product by scripts/refresh_neighbors.py, NEIGHBORS_BATCH_SIZE products
+    # per transaction.
+    NEIGHBORS_K: int = int(os.getenv("NEIGHBORS_K", "20"))
+    NEIGHBORS_BATCH_SIZE: int = int(os.getenv("NEIGHBORS_BATCH_SIZE", "200"))
+
+    # Catalog changes: change feed and the caches depending on the catalog.
+
+    # Catalog change feed. Each worker listens to the product changes and
+    # handles them in batches, once no change came for CHANGE_FEED_DEBOUNCE
+    # seconds, at most CHANGE_FEED_MAX_DELAY seconds after the first one or
+    # with CHANGE_FEED_MAX_EVENTS notifications. With
+    # CHANGE_FEED_REFRESH_NEIGHBORS, changed embeddings also refresh the
+    # precomputed neighbors.
+    CHANGE_FEED_ENABLED: bool = os.getenv("CHANGE_FEED_ENABLED", "true").lower() in (
+        "1",
+        "true",
+    )
+    CHANGE_FEED_DEBOUNCE: float = float(os.getenv("CHANGE_FEED_DEBOUNCE", "0.5"))
+    CHANGE_FEED_MAX_DELAY: float = float(os.getenv("CHANGE_FEED_MAX_DELAY", "5"))
+    CHANGE_FEED_MAX_EVENTS: int = int(os.getenv("CHANGE_FEED_MAX_EVENTS", "10000"))
+    CHANGE_FEED_REFRESH_NEIGHBORS: bool = os.getenv(
+        "CHANGE_FEED_REFRESH_NEIGHBORS", "false"
+    ).lower() in ("1", "true")
+
+    # Semantic chat response cache. SEMANTIC_CACHE_BACKEND is "none",
+    # "memory" or "postgres" (shared by all the workers). A query reuses the
+    # answer of a cached query when their embeddings' cosine similarity is at
+    # least SEMANTIC_CACHE_THRESHOLD. Entries are dropped after
+    # SEMANTIC_CACHE_TTL seconds and when the catalog version changes, which
+    # is read at most every CATALOG_VERSION_TTL seconds.
+    SEMANTIC_CACHE_BACKEND: str = os.getenv("SEMANTIC_CACHE_BACKEND", "none")
+    SEMANTIC_CACHE_THRESHOLD: float = float(
+        os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")
+    )
+    SEMANTIC_CACHE_TTL: int = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+    SEMANTIC_CACHE_SIZE: int = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+    CATALOG_VERSION_TTL: float = float(os.getenv("CATALOG_VERSION_TTL", "10"))
+
+    # Chat: tool loop and tool results.
+
+    # Chat tool loop. The LLM is called at most CHAT_MAX_ITERATIONS times per
+    # message and is asked for its final answer once CHAT_TIME_BUDGET seconds
+    # have elapsed. CHAT_TOOL_WORKERS bounds the concurrent sync tool calls.
+    CHAT_MAX_ITERATIONS: int = int(os.getenv("CHAT_MAX_ITERATIONS", "3"))
+    CHAT_TIME_BUDGET: float = float(os.getenv("CHAT_TIME_BUDGET", "20"))
+    CHAT_TOOL_WORKERS: int = int(os.getenv("CHAT_TOOL_WORKERS", "4"))
+
+    # Search tool results sent back to the LLM. CHAT_TOOL_RESULT_FORMAT is
+    # "compact" (a summary of the products and one line per product with
+    # CHAT_TOOL_RESULT_FIELDS, the description truncated to
+    # CHAT_TOOL_RESULT_DESCRIPTION_CHARS, within CHAT_TOOL_RESULT_MAX_TOKENS
+    # estimated tokens) or "full" (the whole content of every product).
+    CHAT_TOOL_RESULT_FORMAT: str = os.getenv("CHAT_TOOL_RESULT_FORMAT", "compact")
+    CHAT_TOOL_RESULT_FIELDS: str = os.getenv(
+        "CHAT_TOOL_RESULT_FIELDS", "name,category,age_group,price,rating,description"
+    )
+    CHAT_TOOL_RESULT_DESCRIPTION_CHARS: int = int(
+        os.getenv("CHAT_TOOL_RESULT_DESCRIPTION_CHARS", "160")
+    )
+    CHAT_TOOL_RESULT_MAX_TOKENS: int = int(
+        os.getenv("CHAT_TOOL_RESULT_MAX_TOKENS", "400")
+    )
+
+    # Instrumentation. With DEBUG_TIMINGS the responses carry a Server-Timing
+    # header with the time spent in each stage. A METRICS_EXPLAIN_SAMPLE_RATE
+    # fraction of the searches is run again under EXPLAIN (ANALYZE, BUFFERS)
+    # to record the rows scanned and the use of the vector index.
+    DEBUG_TIMINGS: bool = os.getenv("DEBUG_TIMINGS", "false").lower() in ("1", "true")
+    METRICS_EXPLAIN_SAMPLE_RATE: float = float(
+        os.getenv("METRICS_EXPLAIN_SAMPLE_RATE", "0")
+    )
+
+
 
 config = Config()
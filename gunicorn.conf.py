@@ -0,0 +1,39 @@
+"""
+    Gunicorn settings for running the application with several Uvicorn
+    workers:
+
+        python scripts/migrate.py
+        gunicorn main:app -c gunicorn.conf.py
+
+    Each worker has its own database pools (DATABASE_POOL_SIZE +
+    DATABASE_MAX_OVERFLOW connections per engine, sync and async), in-process
+    caches and API clients, so the total number of database connections grows
+    with WEB_CONCURRENCY. See the README.
+"""
+
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+# The workers are async and mostly wait on the LLM, the embeddings API and
+# Postgres, one per core is usually enough.
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+
+# The application is imported by each worker after the fork, so that the
+# engines, pools and clients are never shared between processes.
+preload_app = False
+
+# Chat requests wait on the LLM for several seconds, streamed ones longer.
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+
+# Recycle the workers from time to time, at different times, to bound the
+# growth of the in-process caches.
+max_requests = int(os.getenv("MAX_REQUESTS", "10000"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "1000"))
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
@@ -1,17 +1,65 @@
 """
     The entry file for the FastAPI application.
 """
+import asyncio
 import logging
-from fastapi import FastAPI
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 from api.router import api_router
+from config.main import config
+from models.database import async_engine, engine
+from models.schema import migrate
+from services.change_feed import ChangeFeedListener
+from services.chat import ChatService
+from services.neighbors import NeighborIndex
+from services.metrics import (
+    http_request_duration,
+    server_timing_header,
+    start_request_timings,
+)
+from services.warmup import warmup
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.info("This is an info message.")
 
-app = FastAPI(title="Hybrid Search with Postgres", version="1.0", debug=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Creates the services of the worker when it starts and releases its
+    database connections when it stops. The database and the API clients are
+    only connected to on first use, so a worker starts even if they are
+    briefly unavailable, and the change feed listener keeps reconnecting in
+    the background.
+    """
+    if config.MIGRATE_ON_STARTUP:
+        await asyncio.to_thread(migrate)
+    app.state.chat_service = ChatService()
+    app.state.neighbor_index = NeighborIndex.from_config(app.state.chat_service.searcher)
+    handlers = [app.state.chat_service.searcher.apply_changes]
+    if app.state.chat_service.semantic_cache is not None:
+        handlers.append(app.state.chat_service.semantic_cache.apply_changes)
+    if config.CHANGE_FEED_REFRESH_NEIGHBORS:
+        handlers.append(app.state.neighbor_index.apply_changes)
+    app.state.change_feed = ChangeFeedListener.from_config(handlers)
+    if app.state.change_feed is not None:
+        app.state.change_feed.start()
+    if config.WARMUP_ON_STARTUP:
+        await warmup(app.state.chat_service.searcher)
+    yield
+    if app.state.change_feed is not None:
+        await app.state.change_feed.stop()
+    await async_engine.dispose()
+    engine.dispose()
+
+
+app = FastAPI(
+    title="Hybrid Search with Postgres", version="1.0", debug=True, lifespan=lifespan
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,4 +69,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def request_timings(request: Request, call_next):
+    """
+    Records the duration of the request and, with DEBUG_TIMINGS, sends the
+    time spent in each stage in a Server-Timing header. Streamed responses
+    only include the stages completed before their headers are sent.
+    """
+    started = time.perf_counter()
+    timings = start_request_timings()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    http_request_duration.observe(
+        elapsed,
+        method=request.method,
+        route=getattr(route, "path", "unmatched"),
+        status=response.status_code,
+    )
+    if config.DEBUG_TIMINGS:
+        response.headers["Server-Timing"] = server_timing_header(timings, elapsed)
+    return response
+
+
 app.include_router(api_router)
@@ -0,0 +1,28 @@
+"""
+    This module contains the catalog version, a sequence advanced whenever
+    products change (by the change feed triggers, see models.change_feed) so
+    that caches built on the catalog can tell they are stale.
+
+    A sequence rather than a counter row, so that concurrent writers don't
+    queue on the same row: `nextval` takes no lock and isn't rolled back. A
+    version is thus taken before its transaction commits, and the versions
+    of rolled back transactions are never used.
+"""
+
+from sqlalchemy import Sequence
+
+from models import Base
+
+catalog_version_sequence = Sequence(
+    "catalog_version_seq", start=1, metadata=Base.metadata
+)
+
+
+def current_version_sql() -> str:
+    """
+    Returns the SQL expression of the last version taken, 0 before the first.
+    """
+    return (
+        f"(SELECT CASE WHEN is_called THEN last_value ELSE 0 END "
+        f"FROM {catalog_version_sequence.name})"
+    )
@@ -0,0 +1,123 @@
+"""
+    This module contains the triggers of the catalog change feed.
+
+    Every statement changing the products takes a new catalog version and
+    publishes the ids of the changed rows on the `product_changes` channel,
+    read by services.change_feed.ChangeFeedListener. The notifications are
+    only delivered once the transaction commits, in commit order, which isn't
+    the version order when transactions overlap: the listeners keep the
+    highest version they have seen.
+"""
+
+from sqlalchemy import text
+
+from models.catalog_version import catalog_version_sequence
+
+CHANGE_FEED_CHANNEL = "product_changes"
+# Ids per notification, which keeps the payloads well below the 8000 bytes
+# limit of NOTIFY.
+CHANGE_FEED_CHUNK_SIZE = 250
+
+
+def change_feed_function(db_model) -> str:
+    """
+    Returns the trigger function of db_model. The payload of a notification
+    is `{"op", "version", "xid", "at", "ids", "embedding_ids"}`, xid being the
+    id of the transaction and embedding_ids the ids whose embedding was
+    added, changed or removed. After a TRUNCATE, ids is null.
+    """
+    table_name = db_model.__tablename__
+    embedding_field = db_model.get_embedding_field()
+    chunk_size = CHANGE_FEED_CHUNK_SIZE
+    return f"""
+        CREATE OR REPLACE FUNCTION {table_name.lower()}_change_feed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            changed_ids integer[];
+            embedding_ids integer[];
+            chunk integer[];
+            new_version bigint;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT array_agg(id ORDER BY id),
+                    array_agg(id ORDER BY id) FILTER (WHERE {embedding_field} IS NOT NULL)
+                INTO changed_ids, embedding_ids FROM new_rows;
+            ELSIF TG_OP = 'UPDATE' THEN
+                SELECT array_agg(new_rows.id ORDER BY new_rows.id),
+                    array_agg(new_rows.id ORDER BY new_rows.id) FILTER (
+                        WHERE new_rows.{embedding_field}
+                            IS DISTINCT FROM old_rows.{embedding_field}
+                    )
+                INTO changed_ids, embedding_ids
+                FROM new_rows JOIN old_rows ON old_rows.id = new_rows.id;
+            ELSIF TG_OP = 'DELETE' THEN
+                SELECT array_agg(id ORDER BY id),
+                    array_agg(id ORDER BY id) FILTER (WHERE {embedding_field} IS NOT NULL)
+                INTO changed_ids, embedding_ids FROM old_rows;
+            END IF;
+            IF TG_OP <> 'TRUNCATE' AND changed_ids IS NULL THEN
+                RETURN NULL;
+            END IF;
+
+            -- A sequence takes no lock, concurrent writers don't wait on
+            -- each other.
+            new_version := nextval('{catalog_version_sequence.name}');
+
+            IF TG_OP = 'TRUNCATE' THEN
+                PERFORM pg_notify('{CHANGE_FEED_CHANNEL}', json_build_object(
+                    'op', TG_OP, 'version', new_version, 'xid', txid_current(),
+                    'at', extract(epoch FROM clock_timestamp()),
+                    'ids', NULL, 'embedding_ids', NULL
+                )::text);
+                RETURN NULL;
+            END IF;
+            FOR part IN 0 .. (cardinality(changed_ids) - 1) / {chunk_size} LOOP
+                chunk := changed_ids[part * {chunk_size} + 1 : (part + 1) * {chunk_size}];
+                PERFORM pg_notify('{CHANGE_FEED_CHANNEL}', json_build_object(
+                    'op', TG_OP, 'version', new_version, 'xid', txid_current(),
+                    'at', extract(epoch FROM clock_timestamp()),
+                    'ids', chunk,
+                    'embedding_ids', ARRAY(
+                        SELECT unnest(chunk) INTERSECT SELECT unnest(embedding_ids)
+                    )
+                )::text);
+            END LOOP;
+            RETURN NULL;
+        END
+        $$
+    """
+
+
+def change_feed_triggers(db_model) -> list[str]:
+    """
+    Returns the statements (re)creating the statement level triggers of
+    db_model, one per event as transition tables require.
+    """
+    table_name = db_model.__tablename__
+    function = f"{table_name.lower()}_change_feed"
+    transition_tables = {
+        "INSERT": "REFERENCING NEW TABLE AS new_rows",
+        "UPDATE": "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows",
+        "DELETE": "REFERENCING OLD TABLE AS old_rows",
+        "TRUNCATE": "",
+    }
+    statements = []
+    for event, referencing in transition_tables.items():
+        trigger = f"{function}_{event.lower()}"
+        statements.append(f'DROP TRIGGER IF EXISTS {trigger} ON "{table_name}"')
+        statements.append(
+            f'CREATE TRIGGER {trigger} AFTER {event} ON "{table_name}" {referencing} '
+            f"FOR EACH STATEMENT EXECUTE FUNCTION {function}()"
+        )
+    return statements
+
+
+def install_change_feed(bind, db_model):
+    """
+    Creates or replaces the change feed triggers of db_model.
+    """
+    catalog_version_sequence.create(bind, checkfirst=True)
+    with bind.begin() as connection:
+        connection.execute(text(change_feed_function(db_model)))
+        for statement in change_feed_triggers(db_model):
+            connection.execute(text(statement))
@@ -2,18 +2,70 @@
 This file is used to create a database connection and session for the application.
 """
 # pylint: disable=missing-function-docstring
+import contextvars
+import math
+import time
+from typing import Union
+
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from config.main import config
 
-engine = create_engine(
-    config.SQLALCHEMY_DATABASE_URL, pool_recycle=3600, pool_pre_ping=True
-)
+engine_options = {
+    "pool_size": config.DATABASE_POOL_SIZE,
+    "max_overflow": config.DATABASE_MAX_OVERFLOW,
+    "pool_timeout": config.DATABASE_POOL_TIMEOUT,
+    "pool_recycle": config.DATABASE_POOL_RECYCLE,
+    "pool_pre_ping": True,
+    "connect_args": {"prepare_threshold": config.DATABASE_PREPARE_THRESHOLD},
+}
+
+engine = create_engine(config.SQLALCHEMY_DATABASE_URL, **engine_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(config.SQLALCHEMY_DATABASE_URL, **engine_options)
+AsyncSessionLocal = async_sessionmaker(
+    autoflush=False, expire_on_commit=False, bind=async_engine
+)
+
 Base = declarative_base()
 
+# time.monotonic() deadline of the statements run in the current context, eg
+# by a tool call whose result is no longer awaited past it.
+statement_deadline: contextvars.ContextVar[Union[float, None]] = contextvars.ContextVar(
+    "statement_deadline", default=None
+)
+
+
+def statement_timeout_ms() -> Union[int, None]:
+    """
+    Returns the statement_timeout (at least 1ms, as 0 disables it) left
+    before the statement deadline of the current context, None without one.
+    """
+    deadline = statement_deadline.get()
+    if deadline is None:
+        return None
+    return max(math.ceil((deadline - time.monotonic()) * 1000), 1)
+
+
+def pool_stats() -> dict:
+    """
+    Returns the state of the connection pools of the sync and async engines.
+    """
+    stats = {}
+    for name, pool in (("database", engine.pool), ("async_database", async_engine.pool)):
+        stats[name] = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "max_overflow": config.DATABASE_MAX_OVERFLOW,
+            "timeout": pool.timeout(),
+        }
+    return stats
+
 
 # Dependency
 def get_db():
@@ -38,3 +90,18 @@ class SessionManager:
 
 def get_db_session():
     return SessionManager()
+
+
+class AsyncSessionManager:
+    def __init__(self):
+        self.session = AsyncSessionLocal()
+
+    async def __aenter__(self):
+        return self.session
+
+    async def __aexit__(self, type, value, traceback):
+        await self.session.close()
+
+
+def get_async_db_session():
+    return AsyncSessionManager()
@@ -0,0 +1,19 @@
+"""
+    This module contains SQLAlchemy model for the shared query-embedding cache.
+"""
+
+# pylint:disable=missing-class-docstring
+
+import datetime
+
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Column, DateTime, String
+
+from models import Base
+
+
+class EmbeddingCacheEntry(Base):
+    __tablename__ = "embedding_cache"
+    key = Column(String(64), primary_key=True)
+    embedding = Column(Vector())
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
@@ -6,24 +6,55 @@
 
 from __future__ import annotations
 import datetime
+import hashlib
+import re
 
 from pgvector.sqlalchemy import Vector
 from sqlalchemy import Index
 from sqlalchemy import (
     Column,
+    Computed,
     Integer,
     String,
     DateTime,
     ARRAY,
     Text,
 )
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
 
-from models.database import engine
+from config.main import config
+from models.vector_index import build_partial_vector_indexes, build_vector_index
 from models import Base
 
 class Product(Base):
     __tablename__ = "Product"
+    # Distance metric of the embeddings, the ANN index and the search
+    # operator are both derived from it. See models.vector_index.
+    vector_metric = "cosine"
+    vector_index_method = "hnsw"
+    vector_index_options = {"m": 16, "ef_construction": 64}
+    # Form of the embeddings stored in the ANN index, see
+    # models.vector_index.VECTOR_INDEX_TYPES. Set by the VECTOR_INDEX_TYPE
+    # and VECTOR_INDEX_DIMENSIONS settings.
+    vector_index_type = config.VECTOR_INDEX_TYPE
+    vector_index_dimensions = config.VECTOR_INDEX_DIMENSIONS
+    # Column of the partial HNSW indexes built for the values listed in the
+    # PARTIAL_VECTOR_INDEX_VALUES setting, eg a few selective categories.
+    partial_vector_index_column = "category"
+    # Fused score and per-leg ranks and scores, set on search results.
+    search_info = None
+    # Fields making up the embedded text. The other fields are only stored
+    # and filtered on, so updating them never requires a new embedding.
+    # Overridden by the EMBEDDING_FIELDS setting.
+    embedding_fields = ("name", "description", "category", "age_group")
+    # Fields counted by value in the search facets, and the field counted by
+    # the price buckets of the SEARCH_PRICE_FACET_BOUNDS setting.
+    facet_fields = ("category", "age_group", "sizes")
+    price_facet_field = "price"
+
     id = Column(Integer, primary_key=True)
+    sku = Column(String, unique=True)
     name = Column(String)
     description = Column(String)
     category = Column(String)
@@ -35,6 +66,13 @@ class Product(Base):
     sizes = Column(ARRAY(String))
     embedding = Column(Vector(1536))
     content = Column(Text)
+    content_hash = Column(String(64))
+    content_tsv = deferred(
+        Column(
+            TSVECTOR,
+            Computed("to_tsvector('english', coalesce(content, ''))", persisted=True),
+        )
+    )
     created_at= Column(DateTime, default=datetime.datetime.utcnow)
 
     def to_str(self):
@@ -47,9 +85,64 @@ class Product(Base):
         res += f"Age Group: {self.age_group}\n"
         res += f"Sizes: {', '.join(self.sizes)}\n"
         return res
-    
+
+    def to_embedding_str(self):
+        labels = {
+            "name": "Product",
+            "description": "Description",
+            "category": "Category",
+            "price": "Price",
+            "currency": "Currency",
+            "available_stock": "Available Stock",
+            "rating": "Rating",
+            "age_group": "Age Group",
+            "sizes": "Sizes",
+        }
+        res = ""
+        for field in self.get_embedding_fields():
+            value = getattr(self, field)
+            if isinstance(value, list):
+                value = ", ".join(value)
+            res += f"{labels.get(field, field)}: {value}\n"
+        return res
+
+    def get_content_hash(self, embedding_model: str):
+        """
+        Hash of the embedded text and model, the embedding only needs to be
+        regenerated when it changes.
+        """
+        return hashlib.sha256(
+            f"{embedding_model}\n{self.to_embedding_str()}".encode()
+        ).hexdigest()
+
+    @classmethod
+    def get_embedding_fields(cls):
+        if config.EMBEDDING_FIELDS:
+            return tuple(
+                field.strip() for field in config.EMBEDDING_FIELDS.split(",")
+            )
+        return cls.embedding_fields
+
+    @staticmethod
+    def get_partial_vector_index_values():
+        if not config.PARTIAL_VECTOR_INDEX_VALUES:
+            return ()
+        return tuple(
+            value.strip() for value in config.PARTIAL_VECTOR_INDEX_VALUES.split(",")
+        )
+
+    @staticmethod
+    def get_natural_key_field():
+        return "sku"
+
+    @staticmethod
+    def default_natural_key(item: dict):
+        # Used when a catalog has no sku, names must then be unique.
+        return re.sub(r"[^a-z0-9]+", "-", item["name"].lower()).strip("-")
+
     def to_dict(self):
         return {
+            "id": self.id,
             "name": self.name,
             "description": self.description,
             "category": self.category,
@@ -65,16 +158,24 @@ class Product(Base):
     def get_text_search_field():
         return "content"
 
+    @staticmethod
+    def get_text_search_vector_field():
+        return "content_tsv"
+
     @staticmethod
     def get_embedding_field():
         return "embedding"
 
-index_ada002 = Index(
-    "hnsw_index_for_innerproduct_product_embedding_ada002",
-    Product.embedding,
-    postgresql_using="hnsw",
-    postgresql_with={"m": 16, "ef_construction": 64},
-    postgresql_ops={"embedding_ada002": "vector_ip_ops"},
+index_embedding = build_vector_index(Product)
+partial_indexes_embedding = build_partial_vector_indexes(Product)
+
+index_content_tsv = Index(
+    "gin_index_product_content_tsv",
+    Product.content_tsv,
+    postgresql_using="gin",
 )
 
-Base.metadata.create_all(engine)
+# Supporting indexes for the filters of the filtered vector search.
+index_category = Index("btree_index_product_category", Product.category)
+index_price = Index("btree_index_product_price", Product.price)
+index_sizes = Index("gin_index_product_sizes", Product.sizes, postgresql_using="gin")
@@ -0,0 +1,40 @@
+"""
+    This module contains SQLAlchemy models for the precomputed nearest
+    neighbors of each product, refreshed by services.neighbors.
+"""
+
+# pylint:disable=missing-class-docstring
+
+import datetime
+
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Index, Integer, String
+
+from models import Base
+
+
+class ProductNeighbor(Base):
+    __tablename__ = "product_neighbor"
+    # The primary key serves the lookup of the neighbors of a product in rank
+    # order, the neighbor_id index finds the lists a product appears in.
+    product_id = Column(
+        Integer, ForeignKey("Product.id", ondelete="CASCADE"), primary_key=True
+    )
+    rank = Column(Integer, primary_key=True)
+    neighbor_id = Column(
+        Integer, ForeignKey("Product.id", ondelete="CASCADE"), nullable=False
+    )
+    score = Column(Float, nullable=False)
+
+
+Index("btree_index_product_neighbor_neighbor_id", ProductNeighbor.neighbor_id)
+
+
+class ProductNeighborState(Base):
+    __tablename__ = "product_neighbor_state"
+    # Content hash of the product when its neighbors were computed, the
+    # neighbors are stale once the product's content_hash differs.
+    product_id = Column(
+        Integer, ForeignKey("Product.id", ondelete="CASCADE"), primary_key=True
+    )
+    content_hash = Column(String(64))
+    refreshed_at = Column(DateTime, default=datetime.datetime.utcnow)
@@ -0,0 +1,54 @@
+"""
+    This module creates the database schema. It is run by scripts/migrate.py
+    (and optionally on startup, see MIGRATE_ON_STARTUP) rather than when the
+    models are imported, so that the application workers never run DDL.
+"""
+
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+# The models are imported to register their tables on the metadata.
+# pylint: disable=unused-import
+from models import Base
+from models.catalog_version import catalog_version_sequence
+from models.change_feed import install_change_feed
+from models.database import engine
+from models.embedding_cache import EmbeddingCacheEntry
+from models.product import Product
+from models.product_neighbor import ProductNeighbor, ProductNeighborState
+from models.semantic_cache import SemanticCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# Extensions used by the application, the optional ones only enable features
+# (pg_prewarm is used by the startup warmup).
+EXTENSIONS = {"vector": True, "pg_prewarm": False}
+
+
+def create_extensions(bind=engine):
+    for extension, required in EXTENSIONS.items():
+        try:
+            with bind.begin() as connection:
+                connection.execute(text(f"CREATE EXTENSION IF NOT EXISTS {extension}"))
+        except DBAPIError:
+            if required:
+                raise
+            logger.warning("Extension %s is not available, skipping it", extension)
+
+
+def migrate(bind=engine):
+    """
+    Creates the extensions, the missing tables and the indexes missing from
+    the existing tables, which `create_all` alone doesn't add, and replaces
+    the change feed triggers. Columns added to existing tables still need
+    the statements listed in the README.
+    """
+    create_extensions(bind)
+    Base.metadata.create_all(bind)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+    install_change_feed(bind, Product)
+    logger.info("Database schema is up to date")
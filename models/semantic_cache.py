@@ -0,0 +1,32 @@
+"""
+    This module contains SQLAlchemy model for the semantic chat response cache.
+"""
+
+# pylint:disable=missing-class-docstring
+
+import datetime
+
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import ARRAY, BigInteger, Column, DateTime, Index, Integer, String
+
+from models import Base
+
+
+class SemanticCacheEntry(Base):
+    __tablename__ = "semantic_cache"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    query = Column(String, nullable=False)
+    embedding = Column(Vector(1536), nullable=False)
+    response = Column(String)
+    product_ids = Column(ARRAY(Integer))
+    catalog_version = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+
+index_semantic_cache_embedding = Index(
+    "hnsw_index_for_cosine_semantic_cache_embedding",
+    SemanticCacheEntry.embedding,
+    postgresql_using="hnsw",
+    postgresql_with={"m": 16, "ef_construction": 64},
+    postgresql_ops={"embedding": "vector_cosine_ops"},
+)
@@ -0,0 +1,220 @@
+"""
+    This module maps vector distance metrics to the pgvector operators and
+    operator classes that implement them, so that the ANN index declared on a
+    model and the operator used to query it are derived from the same place.
+"""
+
+import re
+
+from sqlalchemy import Index, text
+
+# similarity turns a distance into a score where higher is better, eg the
+# cosine similarity for the cosine distance. `<#>` is the negative inner product.
+VECTOR_METRICS = {
+    "cosine": {
+        "operator": "<=>",
+        "opclass": "vector_cosine_ops",
+        "similarity": "1 - ({distance})",
+    },
+    "ip": {"operator": "<#>", "opclass": "vector_ip_ops", "similarity": "-({distance})"},
+    "l2": {"operator": "<->", "opclass": "vector_l2_ops", "similarity": "-({distance})"},
+}
+
+VECTOR_INDEX_METHODS = {
+    "hnsw": {"options": {"m": 16, "ef_construction": 64}},
+    "ivfflat": {"options": {"lists": 100}},
+}
+
+# Types the ANN index can store the embeddings as (pgvector 0.7+ for halfvec
+# and bit). A compact index is built on an expression of the full embedding
+# column: cast to half precision, or binary quantized and searched by Hamming
+# distance, optionally truncated to its first dimensions first (Matryoshka
+# embeddings such as text-embedding-3 stay meaningful when truncated). The
+# full embedding is kept in the table to rerank the index candidates exactly.
+VECTOR_INDEX_TYPES = {
+    "vector": {"cast": "CAST({expression} AS vector({dimensions}))", "operator": None},
+    "halfvec": {"cast": "CAST({expression} AS halfvec({dimensions}))", "operator": None},
+    "bit": {
+        "cast": "CAST(binary_quantize({expression}) AS bit({dimensions}))",
+        "operator": "<~>",
+        "opclass": "bit_hamming_ops",
+    },
+}
+
+
+def get_vector_metric(metric: str) -> dict:
+    """
+    Returns the registry entry for the given distance metric.
+    """
+    if metric not in VECTOR_METRICS:
+        raise ValueError(
+            f"Unknown vector metric '{metric}', expected one of {list(VECTOR_METRICS)}"
+        )
+    return VECTOR_METRICS[metric]
+
+
+def distance_operator(db_model) -> str:
+    """
+    Returns the pgvector distance operator matching the metric declared on
+    the model, eg `<=>` for cosine.
+    """
+    return get_vector_metric(db_model.vector_metric)["operator"]
+
+
+def similarity_sql(db_model, distance: str) -> str:
+    """
+    Returns the SQL expression turning the distance expression into a
+    similarity score, higher being more similar.
+    """
+    return get_vector_metric(db_model.vector_metric)["similarity"].format(
+        distance=distance
+    )
+
+
+def get_vector_index_type(db_model) -> dict:
+    index_type = db_model.vector_index_type
+    if index_type not in VECTOR_INDEX_TYPES:
+        raise ValueError(
+            f"Unknown vector index type '{index_type}', "
+            f"expected one of {list(VECTOR_INDEX_TYPES)}"
+        )
+    return VECTOR_INDEX_TYPES[index_type]
+
+
+def embedding_dimensions(db_model) -> int:
+    return getattr(db_model, db_model.get_embedding_field()).type.dim
+
+
+def index_dimensions(db_model) -> int:
+    """
+    Returns the number of dimensions of the vectors stored in the ANN index.
+    """
+    dimensions = db_model.vector_index_dimensions or embedding_dimensions(db_model)
+    if not 0 < dimensions <= embedding_dimensions(db_model):
+        raise ValueError(
+            f"Vector index dimensions must be between 1 and "
+            f"{embedding_dimensions(db_model)}, got {dimensions}"
+        )
+    return dimensions
+
+
+def is_compact_index(db_model) -> bool:
+    """
+    Returns whether the ANN index stores a compact (truncated or quantized)
+    form of the embeddings, whose results must be reranked exactly.
+    """
+    return db_model.vector_index_type != "vector" or index_dimensions(
+        db_model
+    ) != embedding_dimensions(db_model)
+
+
+def index_expression(db_model, operand: str) -> str:
+    """
+    Returns the SQL expression converting the vector operand (the embedding
+    column or the query vector) to the form stored in the ANN index.
+    """
+    if not is_compact_index(db_model):
+        return operand
+    dimensions = index_dimensions(db_model)
+    if dimensions != embedding_dimensions(db_model):
+        operand = f"subvector({operand}, 1, {dimensions})"
+    return get_vector_index_type(db_model)["cast"].format(
+        expression=operand, dimensions=dimensions
+    )
+
+
+def index_operator(db_model) -> str:
+    return get_vector_index_type(db_model)["operator"] or distance_operator(db_model)
+
+
+def index_opclass(db_model) -> str:
+    index_type = get_vector_index_type(db_model)
+    opclass = get_vector_metric(db_model.vector_metric)["opclass"]
+    if "opclass" in index_type:
+        return index_type["opclass"]
+    return opclass.replace("vector_", f"{db_model.vector_index_type}_", 1)
+
+
+def index_distance_sql(db_model, query: str) -> str:
+    """
+    Returns the distance expression served by the ANN index, query being the
+    SQL of the query vector.
+    """
+    column = db_model.get_embedding_field()
+    return (
+        f"{index_expression(db_model, column)} {index_operator(db_model)} "
+        f"{index_expression(db_model, query)}"
+    )
+
+
+def vector_index_name(db_model) -> str:
+    name = (
+        f"{db_model.vector_index_method}_index_for_{db_model.vector_metric}_"
+        f"{db_model.__tablename__.lower()}_{db_model.get_embedding_field()}"
+    )
+    if is_compact_index(db_model):
+        name = f"{name}_{db_model.vector_index_type}{index_dimensions(db_model)}"
+    return name
+
+
+def build_vector_index(db_model, value: str = None) -> Index:
+    """
+    Builds the ANN index for the embedding field of the model, using the
+    operator class of the declared metric and index method, on the compact
+    form of the embeddings for the halfvec and bit index types or truncated
+    dimensions (see VECTOR_INDEX_TYPES). With a value, the
+    index is partial and only covers the rows where the model's
+    `partial_vector_index_column` equals it.
+    """
+    method = db_model.vector_index_method
+    if method not in VECTOR_INDEX_METHODS:
+        raise ValueError(
+            f"Unknown vector index method '{method}', "
+            f"expected one of {list(VECTOR_INDEX_METHODS)}"
+        )
+    embedding_field = db_model.get_embedding_field()
+    options = {
+        **VECTOR_INDEX_METHODS[method]["options"],
+        **(db_model.vector_index_options or {}),
+    }
+    name = vector_index_name(db_model)
+    partial = {}
+    if value is not None:
+        name = f"{name}_{re.sub(r'[^a-z0-9]+', '_', value.lower()).strip('_')}"
+        literal = value.replace("'", "''")
+        partial["postgresql_where"] = text(
+            f"{db_model.partial_vector_index_column} = '{literal}'"
+        )
+    if is_compact_index(db_model):
+        index = Index(
+            name,
+            text(f"({index_expression(db_model, embedding_field)}) {index_opclass(db_model)}"),
+            postgresql_using=method,
+            postgresql_with=options,
+            **partial,
+        )
+        # An index on a textual expression isn't bound to the table.
+        db_model.__table__.append_constraint(index)
+        return index
+    return Index(
+        name,
+        getattr(db_model, embedding_field),
+        postgresql_using=method,
+        postgresql_with=options,
+        postgresql_ops={
+            embedding_field: get_vector_metric(db_model.vector_metric)["opclass"]
+        },
+        **partial,
+    )
+
+
+def build_partial_vector_indexes(db_model) -> list[Index]:
+    """
+    Builds one partial ANN index per value of the model's
+    `partial_vector_index_column` listed by `get_partial_vector_index_values`,
+    so that searches filtered on a selective value don't lose results.
+    """
+    return [
+        build_vector_index(db_model, value)
+        for value in db_model.get_partial_vector_index_values()
+    ]
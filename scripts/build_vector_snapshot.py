@@ -0,0 +1,36 @@
+"""
+    This file builds and publishes a snapshot of the product embeddings for
+    the in-process vector search tier (VECTOR_SNAPSHOT_MODE). Run it after
+    each load: the workers stop using a snapshot once the catalog changes.
+"""
+
+import argparse
+import logging
+import sys
+sys.path.append(".")
+
+from config.main import config
+from models.product import Product
+from services.vector_snapshot import SNAPSHOT_DTYPES, build_snapshot
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--directory", default=config.VECTOR_SNAPSHOT_DIR)
+    parser.add_argument("--dtype", choices=SNAPSHOT_DTYPES, default="float32")
+    parser.add_argument(
+        "--lists", type=int, default=0,
+        help="IVF lists to partition the snapshot into, 0 for exact search",
+    )
+    parser.add_argument(
+        "--keep", type=int, default=2, help="snapshots kept in the directory"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    build_snapshot(
+        Product, args.directory, dtype=args.dtype, lists=args.lists, keep=args.keep
+    )
@@ -1,35 +1,103 @@
 """
-    This file loads the data from sample_products.json
-    and inserts it into the database.
+    This file loads the products of a JSON or JSONL file
+    (scripts/sample_products.json by default) and inserts them into the database.
 """
 
-import json
+import argparse
+import logging
 import sys
 sys.path.append(".")
 
 from models.product import Product
-from models.database import get_db_session
+from models.schema import migrate
 from services.embedding import Embedding
+from services.ingestion import IngestionPipeline
 
 embedding_service = Embedding()
 
 
-def load_data():
+def load_data(
+    path: str = "scripts/sample_products.json",
+    chunk_size: int = 500,
+    batch_tokens: int = 50_000,
+    batch_size: int = 512,
+    concurrency: int = 4,
+    checkpoint: str = None,
+    rebuild_index: bool = False,
+    sync: bool = False,
+    backfill_hashes: bool = False,
+):
     """
-    This function is used to load the data from sample_products.json
-    and insert it into the database.
+    This function is used to load the data from path and insert it into the
+    database. See services.ingestion.IngestionPipeline for the parameters.
+    With backfill_hashes, the content hash of the products loaded without one
+    is set from their current fields before the load.
     """
-    with open("scripts/sample_products.json", "r") as f: #pylint: disable=unspecified-encoding
-        data = json.load(f)
-        data = data["products"]
-    with get_db_session() as session:
-        for item in data:
-            product = Product(**item)
-            product.content = product.to_str()
-            product.embedding = embedding_service.generate(product.content)
-            session.add(product)
-        session.commit()
+    migrate()
+    pipeline = IngestionPipeline(
+        Product,
+        embedding_service,
+        chunk_size=chunk_size,
+        batch_tokens=batch_tokens,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        checkpoint_path=checkpoint,
+        sync=sync,
+    )
+    if backfill_hashes:
+        pipeline.backfill_content_hashes()
+    return pipeline.run(path, rebuild_index=rebuild_index)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", nargs="?", default="scripts/sample_products.json")
+    parser.add_argument(
+        "--chunk-size", type=int, default=500, help="records committed per transaction"
+    )
+    parser.add_argument(
+        "--batch-tokens", type=int, default=50_000,
+        help="estimated token budget of one embeddings request",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=512, help="max inputs per embeddings request"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="chunks embedded in parallel"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="progress file; rerunning with the same file resumes the load",
+    )
+    parser.add_argument(
+        "--rebuild-index", action="store_true",
+        help="drop the vector index during the load and rebuild it afterwards",
+    )
+    parser.add_argument(
+        "--sync", action="store_true",
+        help="upsert on sku and only re-embed products whose embedded text changed; "
+        "products loaded without a content hash are all re-embedded once, unless "
+        "--backfill-hashes is given",
+    )
+    parser.add_argument(
+        "--backfill-hashes", action="store_true",
+        help="first set the missing content hashes, keeping the current embeddings "
+        "of those products",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    load_data()
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    load_data(
+        args.path,
+        chunk_size=args.chunk_size,
+        batch_tokens=args.batch_tokens,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        checkpoint=args.checkpoint,
+        rebuild_index=args.rebuild_index,
+        sync=args.sync,
+        backfill_hashes=args.backfill_hashes,
+    )
@@ -0,0 +1,14 @@
+"""
+    This file creates or updates the database schema. Run it once before
+    starting the application and after each upgrade.
+"""
+
+import logging
+import sys
+sys.path.append(".")
+
+from models.schema import migrate
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate()
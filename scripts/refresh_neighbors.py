@@ -0,0 +1,45 @@
+"""
+    This file refreshes the precomputed neighbors of the products served by
+    /products/{id}/similar. Only the lists made stale by changed products are
+    recomputed; run it after each load, or keep it running with --interval.
+"""
+
+import argparse
+import logging
+import sys
+import time
+sys.path.append(".")
+
+from config.main import config
+from models.product import Product
+from services.neighbors import NeighborIndex
+from services.postgres_searcher import PostgresSearcher
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--k", type=int, default=config.NEIGHBORS_K, help="neighbors stored per product"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=config.NEIGHBORS_BATCH_SIZE,
+        help="products recomputed per transaction",
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="recompute the neighbors of all the products"
+    )
+    parser.add_argument(
+        "--interval", type=float,
+        help="keep running, refreshing every INTERVAL seconds",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    neighbor_index = NeighborIndex(PostgresSearcher(Product), args.k, args.batch_size)
+    neighbor_index.refresh(full=args.full)
+    while args.interval:
+        time.sleep(args.interval)
+        neighbor_index.refresh()
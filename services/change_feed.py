@@ -0,0 +1,232 @@
+"""
+    This module contains the listener of the catalog change feed.
+
+    The triggers of models.change_feed publish the ids of the changed
+    products on a Postgres channel. Each worker listens on it with a
+    dedicated connection, and merges the notifications received within a
+    debounce window into a `ChangeBatch`, so that a burst such as a bulk price
+    update is handled once. The batch is then passed to the handlers, which
+    invalidate or update what they built from the catalog.
+
+    Notifications sent while a worker is disconnected are lost. After a
+    reconnection, the handlers receive a full batch, meaning that anything
+    may have changed.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from typing import Callable, Union
+
+import psycopg
+from sqlalchemy.engine import make_url
+
+from config.main import config
+from models.change_feed import CHANGE_FEED_CHANNEL
+from services.metrics import change_feed_lag, stats_gauges
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeBatch:
+    """
+    The change notifications received within a debounce window. With full,
+    the changes aren't known and everything may have changed.
+    """
+
+    def __init__(self, events: list[dict], full: bool = False):
+        self.events = events
+        self.full = full or any(event["ids"] is None for event in events)
+        self.ids = sorted(
+            {product_id for event in events for product_id in event["ids"] or []}
+        )
+        self.embedding_ids = sorted(
+            {product_id for event in events for product_id in event["embedding_ids"] or []}
+        )
+        self.versions = sorted({event["version"] for event in events})
+        self.oldest_at = min((event["at"] for event in events), default=None)
+
+
+class ChangeFeedListener:
+    """
+    Listens to the change feed in the background of a worker and calls the
+    handlers with each batch of changes. The handlers are plain functions
+    run one after the other in a thread, a failing handler is logged and
+    doesn't prevent the others from running.
+
+    A batch is dispatched once no notification came for `debounce` seconds,
+    `max_delay` seconds after its first notification or with `max_events`
+    notifications, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        handlers: list[Callable[[ChangeBatch], None]],
+        debounce: float = 0.5,
+        max_delay: float = 5,
+        max_events: int = 10_000,
+        channel: str = CHANGE_FEED_CHANNEL,
+    ):
+        self.handlers = handlers
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_events = max_events
+        self.channel = channel
+        self.task: Union[asyncio.Task, None] = None
+        self.lock = threading.Lock()
+        self.connected = False
+        self.events = 0
+        self.batches = 0
+        self.reconnects = 0
+        self.lag = 0.0
+        self.version = 0
+
+    @classmethod
+    def from_config(cls, handlers: list[Callable[[ChangeBatch], None]]):
+        """
+        Builds the listener from the CHANGE_FEED_* settings, returns None
+        when it is disabled.
+        """
+        if not config.CHANGE_FEED_ENABLED:
+            return None
+        listener = cls(
+            handlers,
+            config.CHANGE_FEED_DEBOUNCE,
+            config.CHANGE_FEED_MAX_DELAY,
+            config.CHANGE_FEED_MAX_EVENTS,
+        )
+        stats_gauges(
+            "hybrid_search_change_feed",
+            "Statistics of the catalog change feed listener.",
+            listener,
+        )
+        return listener
+
+    @staticmethod
+    def conninfo() -> str:
+        url = make_url(config.SQLALCHEMY_DATABASE_URL).set(drivername="postgresql")
+        return url.render_as_string(hide_password=False)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        """
+        Listens until cancelled, reconnecting with an exponential backoff.
+        """
+        delay, listened = 1.0, False
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    self.conninfo(), autocommit=True
+                ) as connection:
+                    await connection.execute(f"LISTEN {self.channel}")
+                    self.connected, delay = True, 1.0
+                    if listened:
+                        # Changes made while disconnected weren't received.
+                        with self.lock:
+                            self.reconnects += 1
+                        await self.dispatch(ChangeBatch([], full=True))
+                    listened = True
+                    await self.consume(connection)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("The change feed connection failed, reconnecting")
+            finally:
+                self.connected = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    async def receive(self, connection, queue: asyncio.Queue):
+        try:
+            async for notify in connection.notifies():
+                queue.put_nowait(notify.payload)
+            queue.put_nowait(ConnectionError("The change feed connection was closed"))
+        except Exception as error:  # pylint: disable=broad-except
+            queue.put_nowait(error)
+
+    async def consume(self, connection):
+        """
+        Dispatches the batches of notifications until the connection fails.
+        Notifications keep being received while a batch is handled.
+        """
+        queue = asyncio.Queue()
+        receiver = asyncio.create_task(self.receive(connection, queue))
+        try:
+            while True:
+                await self.dispatch(ChangeBatch(await self.collect(queue)))
+        finally:
+            receiver.cancel()
+
+    async def collect(self, queue: asyncio.Queue) -> list[dict]:
+        """
+        Waits for a notification, then for the rest of its debounce window.
+        """
+        payloads = [await queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(payloads) < self.max_events:
+            timeout = min(self.debounce, deadline - loop.time())
+            if timeout <= 0:
+                break
+            try:
+                payloads.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        events = []
+        for payload in payloads:
+            if isinstance(payload, Exception):
+                raise payload
+            events.append(json.loads(payload))
+        return events
+
+    def handle(self, batch: ChangeBatch):
+        for handler in self.handlers:
+            try:
+                handler(batch)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Handling catalog changes with %s failed", handler)
+
+    async def dispatch(self, batch: ChangeBatch):
+        await asyncio.to_thread(self.handle, batch)
+        if batch.oldest_at is not None:
+            # From the oldest change of the batch to the end of its handling.
+            lag = max(time.time() - batch.oldest_at, 0.0)
+            change_feed_lag.observe(lag)
+        logger.info(
+            "Handled %d catalog changes (versions %s)%s",
+            len(batch.ids),
+            f"{batch.versions[0]}-{batch.versions[-1]}" if batch.versions else "-",
+            " after a reconnection" if not batch.events else "",
+        )
+        with self.lock:
+            self.events += len(batch.events)
+            self.batches += 1
+            if batch.oldest_at is not None:
+                self.lag = lag
+            if batch.versions:
+                self.version = max(self.version, batch.versions[-1])
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "connected": int(self.connected),
+                "events": self.events,
+                "batches": self.batches,
+                "reconnects": self.reconnects,
+                "lag_seconds": self.lag,
+                "version": self.version,
+            }
@@ -3,11 +3,21 @@
 """
 
 import logging
-import json
-from groq import Groq
+import time
+from functools import cached_property
+from groq import AsyncGroq, Groq
+from groq.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
 
-from services.postgres_searcher import PostgresSearcher
+from services.diversity import diversity_from_config
+from services.postgres_searcher import PostgresSearcher, embedding_util
+from services.metrics import cache_gauges, chat_tool_result_tokens, stats_gauges
+from services.semantic_cache import SemanticCache
+from services.tokens import estimate_tokens
+from services.tool_executor import ToolExecutor, ToolLoopBudget
+from services.tool_results import ToolResultSerializer
+from services.vector_snapshot import VectorSnapshotTier
 from config.main import config
+from models.database import get_async_db_session, get_db_session
 from models.product import Product
 
 logger = logging.getLogger(__name__)
@@ -31,25 +41,63 @@ class ChatService:
     """
 
     def __init__(self):
-        self.client = Groq(api_key=config.GROQ_API_KEY)
         self.model = "llama3-groq-70b-8192-tool-use-preview"
-        self.searcher = PostgresSearcher(Product)
+        vector_tier = VectorSnapshotTier.from_config(Product)
+        if vector_tier is not None:
+            stats_gauges(
+                "hybrid_search_vector_snapshot",
+                "Statistics of the in-process vector snapshot tier.",
+                vector_tier,
+            )
+        self.searcher = PostgresSearcher(Product, vector_tier=vector_tier)
+        self.diversity = diversity_from_config()
+        self.tool_result_serializer = ToolResultSerializer.from_config()
+        self.tool_executor = ToolExecutor(
+            {"search_products": self.search_products},
+            {"search_products": self.asearch_products},
+            max_workers=config.CHAT_TOOL_WORKERS,
+        )
+        self.semantic_cache = SemanticCache.from_config()
+        if self.semantic_cache is not None:
+            cache_gauges("semantic", self.semantic_cache)
+
+    @cached_property
+    def client(self):
+        return Groq(api_key=config.GROQ_API_KEY)
+
+    @cached_property
+    def async_client(self):
+        return AsyncGroq(api_key=config.GROQ_API_KEY)
 
     def search_products(self, search_query: str):
         """
         This function is used to search products based on the search_query.
         """
-        product_recommendations = []
-        response: list[Product] = self.searcher.search_and_embed(search_query)
-        product_recommendations.extend(response)
-        if not response:
-            return "No products found for the given search query."
-        response = "\n".join([i.content for i in response])
+        response: list[Product] = self.searcher.search_and_embed(
+            search_query, diversity=self.diversity
+        )
+        return self.format_search_result(response)
+
+    async def asearch_products(self, search_query: str):
+        """
+        Async counterpart of `search_products`.
+        """
+        response: list[Product] = await self.searcher.asearch_and_embed(
+            search_query, diversity=self.diversity
+        )
+        return self.format_search_result(response)
 
+    def format_search_result(self, response: list[Product]):
+        """
+        This function is used to build the tool result from the found products.
+        The LLM gets their compact serialization, see services/tool_results.py,
+        the products themselves are returned to the client.
+        """
+        product_recommendations = list(response)
         return (
-            "Retrieved the following products based on your search query:\n"
-            f"{response}"
-        ), product_recommendations
+            self.tool_result_serializer.serialize(product_recommendations),
+            product_recommendations,
+        )
 
     def search_tool_definition(self):
         """
@@ -77,59 +125,317 @@ class ChatService:
             },
         }
 
+    def tool_loop_budget(self):
+        return ToolLoopBudget(config.CHAT_MAX_ITERATIONS, config.CHAT_TIME_BUDGET)
+
     def generate_response(self, user_query):
         """
-        This function is used to generate response for the user query.
+        This function is used to generate response for the user query. All the
+        tool calls of an assistant turn are executed concurrently and the loop
+        is bounded by CHAT_MAX_ITERATIONS and CHAT_TIME_BUDGET. Answers are
+        served from the semantic cache when it is enabled, and only cached
+        when the loop wasn't degraded (see `ToolLoopBudget`).
         """
-        messages = [
-            {"role": "system", "content": PROMPT},
-            {"role": "user", "content": user_query},
-        ]
+        embedding, cached = self.cached_response(user_query)
+        if cached is not None:
+            return cached
+        messages = self.initial_messages(user_query)
+        budget = self.tool_loop_budget()
         product_recommendations = []
         while True:
+            tool_choice = budget.tool_choice()
+            started = time.perf_counter()
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
-                tool_choice="auto",
+                tool_choice=tool_choice,
+                tools=[self.search_tool_definition()],
+            )
+            llm_time = time.perf_counter() - started
+
+            response_message = response.choices[0].message
+
+            if not response_message.tool_calls or tool_choice == "none":
+                budget.record(llm_time, usage=response.usage)
+                break
+
+            tool_calls = self.handle_tool_calls(messages, response_message)
+            started = time.perf_counter()
+            results = self.tool_executor.execute(tool_calls, budget.remaining())
+            budget.record(
+                llm_time,
+                time.perf_counter() - started,
+                len(tool_calls),
+                response.usage,
+                ToolExecutor.failures(results),
+            )
+            product_recommendations = (
+                self.tool_executor.merge_products(results) or product_recommendations
+            )
+            self.append_tool_results(messages, tool_calls, results)
+
+        logger.info("Tool loop: %s", budget.summary())
+        if embedding is not None and response_message.content and not budget.degraded:
+            self.semantic_cache.set(
+                embedding,
+                user_query,
+                response_message.content,
+                [product.id for product in product_recommendations],
+            )
+        return response_message.content, product_recommendations
+
+    async def agenerate_response(self, user_query):
+        """
+        Async counterpart of `generate_response`. The Groq calls, the query
+        embedding and the search are all awaited, so a slow LLM call doesn't
+        block other requests served by the same worker.
+        """
+        embedding, cached = await self.acached_response(user_query)
+        if cached is not None:
+            return cached
+        messages = self.initial_messages(user_query)
+        budget = self.tool_loop_budget()
+        product_recommendations = []
+        while True:
+            tool_choice = budget.tool_choice()
+            started = time.perf_counter()
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                tool_choice=tool_choice,
                 tools=[self.search_tool_definition()],
             )
+            llm_time = time.perf_counter() - started
 
             response_message = response.choices[0].message
 
-            if response_message.tool_calls:
-                tool_calls = response_message.tool_calls
-                messages.append(
-                    {
-                        "role": "assistant",
-                        "tool_calls": [
-                            tool_call.model_dump() for tool_call in tool_calls
-                        ],
-                    }
-                )
-                tools_names = [tool_call.function.name for tool_call in tool_calls]
-                logger.info("Tools used: %s", tools_names)
-                tool_call = tool_calls[0]
-                try:
-                    logger.info("Calling tool: %s", tool_call.function.name)
-                    tool_name = tool_call.function.name
-                    tool_args = json.loads(tool_call.function.arguments)
-                    logger.info("Tool arguments: %s", tool_args)
-                    tool_result, product_recommendations = self.search_products(
-                        **tool_args
-                    )
-                except Exception as e:  # pylint: disable=broad-except
-                    tool_result = str(e)
-
-                logger.info("Tool result: %s", tool_result)
-                messages.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": tool_name,
-                        "content": tool_result,
-                    }
-                )
-            else:
+            if not response_message.tool_calls or tool_choice == "none":
+                budget.record(llm_time, usage=response.usage)
                 break
 
+            tool_calls = self.handle_tool_calls(messages, response_message)
+            started = time.perf_counter()
+            results = await self.tool_executor.aexecute(tool_calls, budget.remaining())
+            budget.record(
+                llm_time,
+                time.perf_counter() - started,
+                len(tool_calls),
+                response.usage,
+                ToolExecutor.failures(results),
+            )
+            product_recommendations = (
+                self.tool_executor.merge_products(results) or product_recommendations
+            )
+            self.append_tool_results(messages, tool_calls, results)
+
+        logger.info("Tool loop: %s", budget.summary())
+        if embedding is not None and response_message.content and not budget.degraded:
+            await self.semantic_cache.aset(
+                embedding,
+                user_query,
+                response_message.content,
+                [product.id for product in product_recommendations],
+            )
         return response_message.content, product_recommendations
+
+    async def astream_response(self, user_query):
+        """
+        Streaming counterpart of `agenerate_response`. Yields `(event, data)`
+        pairs: `products` with the product recommendations as soon as the
+        searches of a turn return, `token` for each piece of the final answer
+        and `done` with the full answer. The content of a turn is only known to
+        be the final answer once the turn ends without tool calls, so it is
+        streamed live when tools are disabled (tool_choice "none") and emitted
+        at the end of the turn otherwise.
+        """
+        embedding, cached = await self.acached_response(user_query)
+        if cached is not None:
+            response, product_recommendations = cached
+            if product_recommendations:
+                yield "products", product_recommendations
+            yield "token", response
+            yield "done", response
+            return
+        messages = self.initial_messages(user_query)
+        budget = self.tool_loop_budget()
+        product_recommendations = []
+        while True:
+            tool_choice = budget.tool_choice()
+            live = tool_choice == "none"
+            started = time.perf_counter()
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                tool_choice=tool_choice,
+                tools=[self.search_tool_definition()],
+                stream=True,
+            )
+
+            content, tool_calls, usage = [], {}, None
+            async for chunk in stream:
+                # Groq reports the usage in the last chunk, under x_groq.
+                usage = self.chunk_usage(chunk) or usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content.append(delta.content)
+                    if live:
+                        yield "token", delta.content
+                for tool_call_delta in delta.tool_calls or []:
+                    self.merge_tool_call_delta(tool_calls, tool_call_delta)
+            llm_time = time.perf_counter() - started
+
+            if not tool_calls or tool_choice == "none":
+                budget.record(llm_time, usage=usage)
+                if not live:
+                    for piece in content:
+                        yield "token", piece
+                break
+
+            response_message = ChatCompletionMessage(
+                role="assistant",
+                content="".join(content) or None,
+                tool_calls=[
+                    ChatCompletionMessageToolCall.model_validate(tool_calls[index])
+                    for index in sorted(tool_calls)
+                ],
+            )
+            tool_calls = self.handle_tool_calls(messages, response_message)
+            started = time.perf_counter()
+            results = await self.tool_executor.aexecute(tool_calls, budget.remaining())
+            budget.record(
+                llm_time,
+                time.perf_counter() - started,
+                len(tool_calls),
+                usage,
+                ToolExecutor.failures(results),
+            )
+            products = self.tool_executor.merge_products(results)
+            if products:
+                product_recommendations = products
+                yield "products", product_recommendations
+            self.append_tool_results(messages, tool_calls, results)
+
+        logger.info("Tool loop: %s", budget.summary())
+        response = "".join(content)
+        if embedding is not None and response and not budget.degraded:
+            await self.semantic_cache.aset(
+                embedding,
+                user_query,
+                response,
+                [product.id for product in product_recommendations],
+            )
+        yield "done", response
+
+    def cached_response(self, user_query):
+        """
+        Looks the user query up in the semantic cache. Returns its embedding
+        (None when the cache is disabled) and the cached answer with freshly
+        loaded products, so that prices and stock are current, or None.
+        """
+        if self.semantic_cache is None:
+            return None, None
+        embedding = embedding_util.generate(user_query, self.searcher.embed_dimensions)
+        entry = self.semantic_cache.get(embedding)
+        if entry is None:
+            return embedding, None
+        with get_db_session() as db_session:
+            products = self.searcher.hydrate(db_session, entry["product_ids"])
+        self.log_cache_hit(user_query, entry)
+        return embedding, (entry["response"], products)
+
+    async def acached_response(self, user_query):
+        """
+        Async counterpart of `cached_response`.
+        """
+        if self.semantic_cache is None:
+            return None, None
+        embedding = await embedding_util.agenerate(
+            user_query, self.searcher.embed_dimensions
+        )
+        entry = await self.semantic_cache.aget(embedding)
+        if entry is None:
+            return embedding, None
+        async with get_async_db_session() as db_session:
+            products = await self.searcher.ahydrate(db_session, entry["product_ids"])
+        self.log_cache_hit(user_query, entry)
+        return embedding, (entry["response"], products)
+
+    def log_cache_hit(self, user_query, entry):
+        logger.info(
+            "Semantic cache hit for %r: %r (similarity %.3f), %s",
+            user_query,
+            entry["query"],
+            entry["similarity"],
+            self.semantic_cache.stats(),
+        )
+
+    @staticmethod
+    def chunk_usage(chunk):
+        """
+        Returns the token usage of a streamed chunk, None on all the chunks
+        but the last one.
+        """
+        x_groq = getattr(chunk, "x_groq", None)
+        return getattr(x_groq, "usage", None) or getattr(chunk, "usage", None)
+
+    @staticmethod
+    def merge_tool_call_delta(tool_calls: dict, tool_call_delta):
+        """
+        Accumulates a streamed tool call fragment into tool_calls, keyed by the
+        index of the tool call. The arguments arrive as string fragments.
+        """
+        tool_call = tool_calls.setdefault(
+            tool_call_delta.index,
+            {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+        )
+        if tool_call_delta.id:
+            tool_call["id"] = tool_call_delta.id
+        if tool_call_delta.function is not None:
+            if tool_call_delta.function.name:
+                tool_call["function"]["name"] += tool_call_delta.function.name
+            if tool_call_delta.function.arguments:
+                tool_call["function"]["arguments"] += tool_call_delta.function.arguments
+
+    def initial_messages(self, user_query):
+        return [
+            {"role": "system", "content": PROMPT},
+            {"role": "user", "content": user_query},
+        ]
+
+    def handle_tool_calls(self, messages, response_message):
+        """
+        Appends the assistant tool calls to the messages and returns them.
+        """
+        tool_calls = response_message.tool_calls
+        messages.append(
+            {
+                "role": "assistant",
+                "tool_calls": [tool_call.model_dump() for tool_call in tool_calls],
+            }
+        )
+        tools_names = [tool_call.function.name for tool_call in tool_calls]
+        logger.info("Tools used: %s", tools_names)
+        for tool_call in tool_calls:
+            logger.info(
+                "Calling tool: %s(%s)", tool_call.function.name, tool_call.function.arguments
+            )
+        return tool_calls
+
+    def append_tool_results(self, messages, tool_calls, results):
+        for tool_call, (tool_result, _) in zip(tool_calls, results):
+            self.append_tool_result(messages, tool_call, tool_result)
+
+    def append_tool_result(self, messages, tool_call, tool_result):
+        tokens = estimate_tokens(tool_result)
+        chat_tool_result_tokens.observe(tokens)
+        logger.info("Tool result (~%d tokens): %s", tokens, tool_result)
+        messages.append(
+            {
+                "tool_call_id": tool_call.id,
+                "role": "tool",
+                "name": tool_call.function.name,
+                "content": tool_result,
+            }
+        )
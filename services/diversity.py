@@ -0,0 +1,123 @@
+"""
+    This module contains the diversity re-ranking of the search results.
+
+    The fused ranking often returns several variants of the same product. The
+    re-ranking takes a pool of the best fused candidates and picks the results
+    greedily by Maximal Marginal Relevance: the relevance of a candidate (its
+    fused score, min-max normalized over the pool) weighted by `mmr_lambda`,
+    minus its cosine similarity to the closest result already picked weighted
+    by `1 - mmr_lambda`. The results can also be capped to `max_per_group`
+    per value of a field, eg the category.
+
+    Each pick updates the penalties of all the candidates at once, with the
+    similarities of the picked candidate to the pool (one matrix-vector
+    product). Re-ranking a pool of 200 candidates takes about a millisecond
+    (see benchmarks/diversity.py). Loading the embeddings of the pool usually
+    costs more, it can be reduced by comparing only the first `dimensions`
+    of Matryoshka embeddings (eg text-embedding-3-small).
+"""
+
+from typing import Union
+
+import numpy as np
+
+from config.main import config
+
+
+def decode_vectors(values: list, dimensions: int) -> np.ndarray:
+    """
+    Decodes the binary form of pgvector vectors (`vector_send`: the 16-bit
+    dimensions and an unused 16-bit field, then big-endian float32 values)
+    into a float32 matrix, possibly truncated to their first dimensions.
+    Missing vectors are decoded as zeros.
+    """
+    vectors = np.zeros((len(values), dimensions), dtype=np.float32)
+    for i, value in enumerate(values):
+        if value is not None:
+            vectors[i] = np.frombuffer(value, dtype=">f4", offset=4)
+    return vectors
+
+
+class MMRDiversity:
+    """
+    Maximal Marginal Relevance re-ranking of the `pool` best candidates, see
+    the module docstring. mmr_lambda=1 keeps the fused order (with the group
+    caps only), lower values favor diversity. dimensions truncates the
+    embeddings compared, None compares them whole.
+    """
+
+    def __init__(
+        self,
+        mmr_lambda: float = 0.7,
+        pool: int = 200,
+        max_per_group: Union[int, None] = None,
+        group_field: str = "category",
+        dimensions: Union[int, None] = None,
+    ):
+        if not 0 <= mmr_lambda <= 1:
+            raise ValueError(f"mmr_lambda must be between 0 and 1, got {mmr_lambda}")
+        self.mmr_lambda = mmr_lambda
+        self.pool = pool
+        self.max_per_group = max_per_group
+        self.group_field = group_field
+        self.dimensions = dimensions
+
+    def rerank(
+        self,
+        scores: np.ndarray,
+        vectors: np.ndarray,
+        k: int,
+        groups: Union[np.ndarray, None] = None,
+    ) -> np.ndarray:
+        """
+        Returns the indices of the k candidates picked, in order. scores are
+        the fused scores of the candidates in rank order, vectors their
+        embeddings and groups their integer group codes. Fewer than k
+        candidates are returned when the group caps exclude the others.
+        """
+        count = len(scores)
+        k = min(k, count)
+        relevance = scores - scores.min() if count else scores
+        span = relevance.max() if count else 0.0
+        relevance = relevance / span if span > 0 else np.ones(count)
+        unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        gain = self.mmr_lambda * relevance
+        # The same penalty for all the candidates until the first pick.
+        redundancy = np.full(count, -1.0)
+        available = np.ones(count, dtype=bool)
+        capped = groups is not None and self.max_per_group is not None
+        group_counts = np.zeros(int(groups.max()) + 1 if capped and count else 0, dtype=int)
+        picked = []
+        for _ in range(k):
+            marginal = np.where(
+                available, gain - (1 - self.mmr_lambda) * redundancy, -np.inf
+            )
+            # Ties go to the best fused rank.
+            best = int(np.argmax(marginal))
+            if not available[best]:
+                break
+            picked.append(best)
+            available[best] = False
+            np.maximum(redundancy, unit @ unit[best], out=redundancy)
+            if capped:
+                group_counts[groups[best]] += 1
+                if group_counts[groups[best]] >= self.max_per_group:
+                    available &= groups != groups[best]
+        return np.array(picked, dtype=np.int64)
+
+
+def diversity_from_config() -> Union[MMRDiversity, None]:
+    """
+    Builds the re-ranking of the chat searches from the DIVERSITY_* settings,
+    returns None when it is disabled.
+    """
+    if config.DIVERSITY_MMR_LAMBDA is None and config.DIVERSITY_MAX_PER_GROUP is None:
+        return None
+    return MMRDiversity(
+        1.0 if config.DIVERSITY_MMR_LAMBDA is None else config.DIVERSITY_MMR_LAMBDA,
+        config.DIVERSITY_POOL,
+        config.DIVERSITY_MAX_PER_GROUP,
+        config.DIVERSITY_GROUP_FIELD,
+        config.DIVERSITY_DIMENSIONS,
+    )
@@ -1,26 +1,52 @@
 # pylint:disable=all
 
+import asyncio
 import logging
+from functools import cached_property
 from typing import (
     TypedDict,
     Union,
 )
 
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from config.main import config
+from services.metrics import stage
 
 logger = logging.getLogger(__name__)
 
 class Embedding:
-    def __init__(self):
+    def __init__(self, cache=None, cache_factory=None):
         """
         Initializes the Embedding object with Pinecone and OpenAI clients.
 
         :param api_key: API key for the OpenAI service.
         :param model_name: The name of the model to use for generating embeddings.
+        :param cache: Optional EmbeddingCache consulted before calling the API.
+        :param cache_factory: Optional callable creating the cache instead, eg
+            EmbeddingCache.from_config.
+
+        The API clients and the cache are created on first use.
         """
-        self.client = OpenAI(api_key=config.OPENAI_API_KEY)
         self.embedding_model_name = "text-embedding-3-small"
+        self.cache_factory = cache_factory or (lambda: cache)
+
+    @cached_property
+    def cache(self):
+        return self.cache_factory()
+
+    def stats(self) -> dict:
+        return self.cache.stats() if self.cache is not None else {}
+
+    @cached_property
+    def client(self):
+        return OpenAI(api_key=config.OPENAI_API_KEY)
+
+    @cached_property
+    def async_client(self):
+        return AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+
+    def cache_key(self, content, dimensions):
+        return self.cache.make_key(content, self.embedding_model_name, dimensions)
 
     def generate(self, content, dimensions=None):
         """
@@ -30,16 +56,15 @@ class Embedding:
         :return: A list representing the generated embedding.
         """
         content = content.replace("\n", " ").strip()
-        res = self.client.embeddings.create(
-            input=[content], model=self.embedding_model_name,
-            dimensions=dimensions if dimensions else 1536
+        dimensions = dimensions if dimensions else 1536
+        if self.cache is None:
+            return self.create([content], dimensions)[0]
+        return self.cache.get_or_compute(
+            self.cache_key(content, dimensions),
+            lambda: self.create([content], dimensions)[0],
         )
-        embed = res.data[
-            0
-        ].embedding  # Assuming the response contains a list of embeddings
-        return embed
 
-    def generate_multiple(self, contents):
+    def generate_multiple(self, contents, dimensions=None):
         """
         Generates embeddings for multiple pieces of content using the specified model.
 
@@ -47,9 +72,72 @@ class Embedding:
         :return: A list of embeddings corresponding to the input content.
         """
         contents = [content.replace("\n", " ").strip() for content in contents]
-        res = self.client.embeddings.create(
-            input=contents, model=self.embedding_model_name
+        dimensions = dimensions if dimensions else 1536
+        if self.cache is None:
+            return self.create(contents, dimensions)
+        keys = [self.cache_key(content, dimensions) for content in contents]
+        embeddings = self.cache.get_many(keys)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            created = self.create([contents[i] for i in missing], dimensions)
+            for i, embedding in zip(missing, created):
+                self.cache.save(keys[i], embedding)
+                embeddings[i] = embedding
+        return embeddings
+
+    def create(self, contents, dimensions):
+        with stage("embedding"):
+            res = self.client.embeddings.create(
+                input=contents, model=self.embedding_model_name, dimensions=dimensions
+            )
+        return [item.embedding for item in res.data]
+
+    async def agenerate(self, content, dimensions=None):
+        """
+        Async counterpart of `generate`, awaiting the embeddings API instead
+        of blocking the event loop.
+
+        :param content: The text content to generate an embedding for.
+        :return: A list representing the generated embedding.
+        """
+        content = content.replace("\n", " ").strip()
+        dimensions = dimensions if dimensions else 1536
+        if self.cache is None:
+            return (await self.acreate([content], dimensions))[0]
+
+        async def compute():
+            return (await self.acreate([content], dimensions))[0]
+
+        return await self.cache.aget_or_compute(
+            self.cache_key(content, dimensions), compute
         )
-        embeddings = [item.embedding for item in res.data]
+
+    async def agenerate_multiple(self, contents, dimensions=None):
+        """
+        Async counterpart of `generate_multiple`.
+
+        :param contents: A list of text content to generate embeddings for.
+        :return: A list of embeddings corresponding to the input content.
+        """
+        contents = [content.replace("\n", " ").strip() for content in contents]
+        dimensions = dimensions if dimensions else 1536
+        if self.cache is None:
+            return await self.acreate(contents, dimensions)
+        keys = [self.cache_key(content, dimensions) for content in contents]
+        embeddings = await asyncio.to_thread(self.cache.get_many, keys)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            created = await self.acreate([contents[i] for i in missing], dimensions)
+            for i, embedding in zip(missing, created):
+                embeddings[i] = embedding
+            await asyncio.to_thread(
+                lambda: [self.cache.save(keys[i], embeddings[i]) for i in missing]
+            )
         return embeddings
 
+    async def acreate(self, contents, dimensions):
+        with stage("embedding"):
+            res = await self.async_client.embeddings.create(
+                input=contents, model=self.embedding_model_name, dimensions=dimensions
+            )
+        return [item.embedding for item in res.data]
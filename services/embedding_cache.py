@@ -0,0 +1,282 @@
+"""
+    This module contains the query-embedding cache used by the Embedding service.
+
+    Embeddings are kept in a bounded in-process LRU with a TTL, optionally
+    backed by a shared store (a local SQLite file or a Postgres table) so that
+    all workers benefit from each other's API calls. Concurrent requests for
+    the same key are coalesced into a single embeddings API call.
+"""
+
+import asyncio
+import datetime
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from hashlib import sha256
+from typing import Callable, Union
+
+from config.main import config
+from models.database import get_db_session
+from models.embedding_cache import EmbeddingCacheEntry
+
+
+class ComputationCancelled(Exception):
+    """
+    Raised to the callers awaiting an embedding whose computation was
+    cancelled with the request computing it, they compute it again.
+    """
+
+
+class SQLiteEmbeddingStore:
+    """
+    Shared embedding store in a local SQLite file, for workers on one host.
+    """
+
+    def __init__(self, path: str, ttl: Union[float, None] = None):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache "
+            "(key TEXT PRIMARY KEY, embedding BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def get(self, key: str) -> Union[list[float], None]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT embedding, created_at FROM embedding_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+        if row is None or (self.ttl and row[1] + self.ttl < time.time()):
+            return None
+        return array("f", row[0]).tolist()
+
+    def set(self, key: str, embedding: list[float]):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?)",
+                (key, array("f", embedding).tobytes(), time.time()),
+            )
+            self.connection.commit()
+
+
+class PostgresEmbeddingStore:
+    """
+    Shared embedding store in the `embedding_cache` Postgres table, for
+    workers spread over several hosts.
+    """
+
+    def __init__(self, ttl: Union[float, None] = None):
+        self.ttl = ttl
+        self.db_model = EmbeddingCacheEntry
+
+    def get(self, key: str) -> Union[list[float], None]:
+        with get_db_session() as session:
+            entry = session.get(self.db_model, key)
+        if entry is None or (
+            self.ttl
+            and datetime.datetime.utcnow() - entry.created_at
+            > datetime.timedelta(seconds=self.ttl)
+        ):
+            return None
+        return list(entry.embedding)
+
+    def set(self, key: str, embedding: list[float]):
+        with get_db_session() as session:
+            session.merge(
+                self.db_model(
+                    key=key,
+                    embedding=embedding,
+                    created_at=datetime.datetime.utcnow(),
+                )
+            )
+            session.commit()
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of embeddings with a TTL and an optional shared store.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: Union[float, None] = 3600,
+        store=None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self.entries: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.inflight: dict[str, Future] = {}
+        self.async_inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self.coalesced = 0
+
+    @classmethod
+    def from_config(cls):
+        """
+        Builds the cache from the EMBEDDING_CACHE_* settings.
+        """
+        store = None
+        if config.EMBEDDING_CACHE_BACKEND == "sqlite":
+            store = SQLiteEmbeddingStore(
+                config.EMBEDDING_CACHE_PATH, config.EMBEDDING_CACHE_TTL
+            )
+        elif config.EMBEDDING_CACHE_BACKEND == "postgres":
+            store = PostgresEmbeddingStore(config.EMBEDDING_CACHE_TTL)
+        return cls(config.EMBEDDING_CACHE_SIZE, config.EMBEDDING_CACHE_TTL, store)
+
+    @staticmethod
+    def make_key(content: str, model: str, dimensions: int) -> str:
+        """
+        Builds the cache key from the normalized text (whitespace collapsed and
+        case folded), the model name and the embedding dimensions.
+        """
+        normalized = " ".join(content.split()).casefold()
+        return sha256(f"{model}:{dimensions}:{normalized}".encode()).hexdigest()
+
+    def get(self, key: str) -> Union[list[float], None]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, embedding = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self.entries[key]
+        return None
+
+    def set(self, key: str, embedding: list[float]):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[key] = (expires_at, embedding)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_many(self, keys: list[str]) -> list[Union[list[float], None]]:
+        """
+        Looks up several keys at once, in memory then in the shared store.
+        Returns None for the keys that must be computed.
+        """
+        embeddings = [self.get(key) for key in keys]
+        with self.lock:
+            self.misses += sum(embedding is None for embedding in embeddings)
+        return [
+            embedding if embedding is not None else self.lookup_store(key)
+            for key, embedding in zip(keys, embeddings)
+        ]
+
+    def save(self, key: str, embedding: list[float]):
+        self.set(key, embedding)
+        if self.store is not None:
+            self.store.set(key, embedding)
+
+    def get_or_compute(self, key: str, compute: Callable[[], list[float]]):
+        """
+        Returns the cached embedding for the key, or computes it. Threads
+        asking for a key that is already being computed wait for that result
+        instead of calling the API again.
+        """
+        embedding = self.get(key)
+        if embedding is not None:
+            return embedding
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = self.inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            embedding = self.lookup_store(key)
+            if embedding is None:
+                embedding = compute()
+                self.save(key, embedding)
+            future.set_result(embedding)
+            return embedding
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    async def aget_or_compute(self, key: str, compute):
+        """
+        Async counterpart of `get_or_compute`. compute is a coroutine function,
+        and the shared store is queried in a thread to keep the loop free.
+        When the caller computing the key is cancelled, the callers waiting
+        for it retry rather than being cancelled too.
+        """
+        while True:
+            embedding = self.get(key)
+            if embedding is not None:
+                return embedding
+            future = self.async_inflight.get(key)
+            if future is None:
+                break
+            with self.lock:
+                self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except ComputationCancelled:
+                # The request computing it went away, one of the callers
+                # waiting for it takes over.
+                continue
+        with self.lock:
+            self.misses += 1
+        future = self.async_inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            embedding = await asyncio.to_thread(self.lookup_store, key)
+            if embedding is None:
+                embedding = await compute()
+                await asyncio.to_thread(self.save, key, embedding)
+            future.set_result(embedding)
+            return embedding
+        except asyncio.CancelledError:
+            # Cancelling the shared future would cancel the waiting callers
+            # too, which didn't ask for it.
+            future.set_exception(ComputationCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when no other caller awaits it.
+            future.exception()
+            raise
+        finally:
+            self.async_inflight.pop(key, None)
+
+    def lookup_store(self, key: str) -> Union[list[float], None]:
+        if self.store is None:
+            return None
+        embedding = self.store.get(key)
+        if embedding is not None:
+            with self.lock:
+                self.store_hits += 1
+            self.set(key, embedding)
+        return embedding
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "store_hits": self.store_hits,
+                "coalesced": self.coalesced,
+            }
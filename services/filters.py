@@ -0,0 +1,201 @@
+"""
+    This module compiles search filters into parameterized SQL.
+
+    A filter is a dict such as
+    `{"column": "category", "comparison_operator": "=", "value": "Summer Wear"}`.
+    Values are always sent as bound parameters named after the position of the
+    filter, never interpolated, so that every query with the same filter shape
+    shares one SQL text and its prepared statement. Values must match the type
+    of their column, and a null value compared with `=` or `!=` is compiled to
+    `IS NULL` or `IS NOT NULL`.
+"""
+
+import datetime
+import decimal
+from typing import Union
+
+from sqlalchemy import ARRAY, String
+from sqlalchemy.dialects import postgresql
+
+SCALAR_OPERATORS = {"=", "!=", "<>", "<", "<=", ">", ">="}
+LIST_OPERATORS = {"in": "= ANY", "=": "= ANY", "not in": "<> ALL", "!=": "<> ALL"}
+ARRAY_OPERATORS = {"&&", "@>", "<@"}
+RANGE_OPERATORS = {"between"}
+
+
+class FilterCompiler:
+    """
+    Compiles filters on the columns of db_model into a SQL condition and its
+    parameters. Unknown columns and operators, and values not matching the
+    type of their column, are rejected.
+    """
+
+    def __init__(self, db_model, param_prefix: str = "filter"):
+        self.db_model = db_model
+        self.param_prefix = param_prefix
+        self.columns = db_model.__table__.columns
+
+    def compile(
+        self,
+        filters: Union[list[dict], None],
+        inline: Union[dict[str, set], None] = None,
+    ) -> tuple[str, dict]:
+        """
+        Returns the `AND`-ed condition of the filters (empty without filters)
+        and the parameters it binds. The filters are left unmodified.
+
+        inline maps a column to the known values that are written as literals
+        rather than parameters when compared with `=`, which lets the planner
+        match the predicate of partial indexes built for those values.
+        """
+        clauses, params = [], {}
+        for i, filter in enumerate(filters or []):
+            clause, clause_params = self.compile_filter(
+                f"{self.param_prefix}_{i}", filter, inline or {}
+            )
+            clauses.append(clause)
+            params.update(clause_params)
+        return " AND ".join(clauses), params
+
+    def compile_filter(
+        self, param: str, filter: dict, inline: dict[str, set]
+    ) -> tuple[str, dict]:
+        if (
+            not isinstance(filter, dict)
+            or not isinstance(filter.get("column"), str)
+            or not isinstance(filter.get("comparison_operator"), str)
+        ):
+            raise ValueError("Filter requires 'column' and 'comparison_operator'")
+        if "value" not in filter:
+            raise ValueError("Filter requires a 'value'")
+        column_name = filter["column"]
+        if column_name not in self.columns:
+            raise ValueError(
+                f"Unknown filter column '{column_name}' for {self.db_model.__name__}"
+            )
+        column = self.columns[column_name]
+        operator = filter["comparison_operator"].strip().lower()
+        value = filter["value"]
+        is_array = isinstance(column.type, ARRAY)
+
+        if operator in ARRAY_OPERATORS:
+            if not is_array or not isinstance(value, (list, tuple)):
+                raise ValueError(
+                    f"Operator '{operator}' requires an array column and a list value"
+                )
+            for item in value:
+                self.check_value(column, item, column.type.item_type)
+            return (
+                f"{column_name} {operator} CAST(:{param} AS {self.sql_type(column)})",
+                {param: list(value)},
+            )
+        if operator in RANGE_OPERATORS:
+            return self.compile_range(param, column, value)
+        if isinstance(value, (list, tuple)):
+            if operator not in LIST_OPERATORS or is_array:
+                raise ValueError(f"Operator '{operator}' does not accept a list value")
+            for item in value:
+                self.check_value(column, item)
+            return (
+                f"{column_name} {LIST_OPERATORS[operator]}"
+                f"(CAST(:{param} AS {self.sql_type(column)}[]))",
+                {param: list(value)},
+            )
+        if operator not in SCALAR_OPERATORS or is_array:
+            raise ValueError(
+                f"Unsupported filter operator '{operator}' on column '{column_name}'"
+            )
+        if value is None:
+            # `col = NULL` would match nothing.
+            if operator == "=":
+                return f"{column_name} IS NULL", {}
+            if operator in ("!=", "<>"):
+                return f"{column_name} IS NOT NULL", {}
+            raise ValueError(f"Operator '{operator}' does not accept a null value")
+        self.check_value(column, value)
+        if operator == "=" and value in inline.get(column_name, ()):
+            literal = str(value).replace("'", "''")
+            return f"{column_name} = '{literal}'", {}
+        return f"{column_name} {operator} :{param}", {param: value}
+
+    def compile_range(self, param: str, column, value) -> tuple[str, dict]:
+        """
+        Compiles `between` filters. Value is a [low, high] pair where either
+        bound may be None. Text columns holding ranges such as the "3-6" of
+        age_group match when their range overlaps the requested one, their
+        bounds must be integers.
+        """
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            raise ValueError("Operator 'between' requires a [low, high] value")
+        low, high = value
+        is_range_text = isinstance(column.type, String)
+        bound_types = (int,) if is_range_text else (int, float)
+        for bound in (low, high):
+            if bound is not None and (
+                isinstance(bound, bool) or not isinstance(bound, bound_types)
+            ):
+                raise ValueError(
+                    f"Operator 'between' on column '{column.name}' requires "
+                    f"{'integer' if is_range_text else 'numeric'} bounds"
+                )
+        if low is not None and high is not None and low > high:
+            raise ValueError("Operator 'between' requires low <= high")
+        params = {f"{param}_low": low, f"{param}_high": high}
+        if is_range_text:
+            # CASE rather than AND, which doesn't guarantee the regular
+            # expression is checked before the casts. The stored bounds are
+            # ordered, a "6-3" matches as "3-6".
+            bounds = [
+                f"CAST(split_part({column.name}, '-', {part}) AS INTEGER)"
+                for part in (1, 2)
+            ]
+            return (
+                f"(CASE WHEN {column.name} ~ '^[0-9]{{1,9}}-[0-9]{{1,9}}$' "
+                f"THEN int4range(least({bounds[0]}, {bounds[1]}), "
+                f"greatest({bounds[0]}, {bounds[1]}), '[]') END && "
+                f"int4range(CAST(:{param}_low AS INTEGER), "
+                f"CAST(:{param}_high AS INTEGER), '[]'))",
+                params,
+            )
+        clauses = []
+        if low is not None:
+            clauses.append(f"{column.name} >= :{param}_low")
+        if high is not None:
+            clauses.append(f"{column.name} <= :{param}_high")
+        if not clauses:
+            raise ValueError("Operator 'between' requires at least one bound")
+        return (
+            f"({' AND '.join(clauses)})",
+            {k: v for k, v in params.items() if v is not None},
+        )
+
+    @staticmethod
+    def value_types(column_type) -> tuple:
+        """
+        Returns the Python types of the values compared to a column of
+        column_type: numbers for numeric columns, strings for text columns
+        and ISO formatted strings for dates, none for the columns that can't
+        be filtered, eg vectors.
+        """
+        try:
+            python_type = column_type.python_type
+        except NotImplementedError:
+            return ()
+        if python_type in (int, float, decimal.Decimal):
+            return (int, float)
+        if python_type in (datetime.datetime, datetime.date):
+            return (str, python_type)
+        return (python_type,)
+
+    def check_value(self, column, value, column_type=None):
+        types = self.value_types(column.type if column_type is None else column_type)
+        if not isinstance(value, types) or (
+            isinstance(value, bool) and bool not in types
+        ):
+            raise ValueError(
+                f"Filter value {value!r} doesn't match the type of column '{column.name}'"
+            )
+
+    @staticmethod
+    def sql_type(column) -> str:
+        return column.type.compile(dialect=postgresql.dialect())
@@ -0,0 +1,106 @@
+"""
+    This module contains the fusion methods combining the vector and full-text
+    legs of the hybrid search into one score.
+
+    Each leg exposes `id`, `rank` and `score` (higher is better) columns in the
+    `vector_search` and `fulltext_search` CTEs of the hybrid query. A fusion
+    method returns the SQL expression of the fused score and the parameters it
+    binds, so tuning weights never changes the SQL text.
+"""
+
+from typing import Union
+
+from config.main import config
+
+LEGS = {"vector": "vector_search", "text": "fulltext_search"}
+
+
+class RRFFusion:
+    """
+    Weighted Reciprocal Rank Fusion: sum of `weight / (k + rank)` over the
+    legs returning the row.
+    """
+
+    def __init__(self, k: int = 60, vector_weight: float = 1.0, text_weight: float = 1.0):
+        self.k = k
+        self.weights = {"vector": vector_weight, "text": text_weight}
+
+    def score_sql(self) -> str:
+        return " + ".join(
+            f"CAST(:fusion_{leg}_weight AS FLOAT) * "
+            f"COALESCE(1.0 / (:fusion_k + {cte}.rank), 0.0)"
+            for leg, cte in LEGS.items()
+        )
+
+    def params(self) -> dict:
+        return {
+            "fusion_k": self.k,
+            **{f"fusion_{leg}_weight": weight for leg, weight in self.weights.items()},
+        }
+
+
+class ScoreFusion:
+    """
+    Weighted sum of the leg scores, normalized over the candidates of each leg
+    with min-max (to [0, 1]) or z-score normalization. Rows missing from a leg
+    get that leg's lowest normalized score.
+    """
+
+    normalizations = ("minmax", "zscore")
+
+    def __init__(
+        self,
+        normalization: str = "minmax",
+        vector_weight: float = 0.5,
+        text_weight: float = 0.5,
+    ):
+        if normalization not in self.normalizations:
+            raise ValueError(
+                f"Unknown score normalization '{normalization}', "
+                f"expected one of {self.normalizations}"
+            )
+        self.normalization = normalization
+        self.weights = {"vector": vector_weight, "text": text_weight}
+
+    def normalized_sql(self, cte: str) -> str:
+        score = f"COALESCE({cte}.score, MIN({cte}.score) OVER ())"
+        if self.normalization == "minmax":
+            normalized = (
+                f"({score} - MIN({cte}.score) OVER ()) / "
+                f"NULLIF(MAX({cte}.score) OVER () - MIN({cte}.score) OVER (), 0)"
+            )
+        else:
+            normalized = (
+                f"({score} - AVG({cte}.score) OVER ()) / "
+                f"NULLIF(STDDEV_POP({cte}.score) OVER (), 0)"
+            )
+        # All candidates scored alike: present rows get the top score.
+        return (
+            f"COALESCE({normalized}, "
+            f"CASE WHEN {cte}.score IS NULL THEN 0.0 ELSE 1.0 END)"
+        )
+
+    def score_sql(self) -> str:
+        return " + ".join(
+            f"CAST(:fusion_{leg}_weight AS FLOAT) * {self.normalized_sql(cte)}"
+            for leg, cte in LEGS.items()
+        )
+
+    def params(self) -> dict:
+        return {f"fusion_{leg}_weight": weight for leg, weight in self.weights.items()}
+
+
+def fusion_from_config(method: Union[str, None] = None):
+    """
+    Builds the fusion method from the FUSION_* settings.
+    """
+    method = method or config.FUSION_METHOD
+    if method == "rrf":
+        return RRFFusion(
+            config.RRF_K, config.FUSION_VECTOR_WEIGHT, config.FUSION_TEXT_WEIGHT
+        )
+    if method in ScoreFusion.normalizations:
+        return ScoreFusion(
+            method, config.FUSION_VECTOR_WEIGHT, config.FUSION_TEXT_WEIGHT
+        )
+    raise ValueError(f"Unknown fusion method '{method}'")
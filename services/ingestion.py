@@ -0,0 +1,399 @@
+"""
+    This module contains the bulk ingestion pipeline used to load product
+    catalogs into the database.
+
+    Products are streamed from a JSON or JSONL file, embedded in
+    token-budgeted batches with bounded concurrency and retries, and written
+    with multi-row INSERTs in chunked transactions. Progress is checkpointed
+    after every committed chunk so that an interrupted load can be resumed.
+"""
+
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Union
+
+import openai
+from sqlalchemy import ARRAY, String, bindparam, insert, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+
+from models.database import engine
+from models.vector_index import vector_index_name
+from services.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+def iter_json_array(file, read_size: int = 1 << 16) -> Iterator[dict]:
+    """
+    Incrementally decodes the first JSON array of the file, eg the products of
+    `{"products": [...]}` or a top-level list, without loading it in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    while "[" not in buffer:
+        chunk = file.read(read_size)
+        if not chunk:
+            return
+        buffer += chunk
+    buffer = buffer[buffer.index("[") + 1 :]
+    eof = False
+    while True:
+        buffer = buffer.lstrip().lstrip(",").lstrip()
+        if buffer.startswith("]"):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = file.read(read_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        buffer = buffer[end:]
+        yield item
+
+
+def iter_products(path: str) -> Iterator[dict]:
+    """
+    Streams the products of a JSONL file (one product per line) or of a JSON
+    document such as scripts/sample_products.json.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(f)
+
+
+def token_budget_batches(
+    contents: list[str], max_tokens: int, max_size: int
+) -> Iterator[list[int]]:
+    """
+    Groups the indexes of contents into batches holding at most max_size
+    contents and max_tokens estimated tokens.
+    """
+    batch, batch_tokens = [], 0
+    for i, content in enumerate(contents):
+        tokens = estimate_tokens(content)
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_size):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class IngestionPipeline:
+    """
+    Streams products from a file into the table of db_model.
+
+    In sync mode rows are upserted on the model's natural key, and only the
+    rows whose embedded text changed (per their content hash) are sent to the
+    embeddings API; the others become plain UPDATEs of the stored fields.
+    """
+
+    def __init__(
+        self,
+        db_model,
+        embedding,
+        chunk_size: int = 500,
+        batch_tokens: int = 50_000,
+        batch_size: int = 512,
+        concurrency: int = 4,
+        max_retries: int = 6,
+        checkpoint_path: Union[str, None] = None,
+        sync: bool = False,
+    ):
+        self.db_model = db_model
+        self.embedding = embedding
+        self.chunk_size = chunk_size
+        self.batch_tokens = batch_tokens
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.checkpoint_path = checkpoint_path
+        self.sync = sync
+        self.embedded = 0
+
+    def read_checkpoint(self, source: str) -> int:
+        """
+        Returns the number of records of source already committed.
+        """
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("source") != os.path.abspath(source):
+            return 0
+        return checkpoint["records"]
+
+    def write_checkpoint(self, source: str, records: int):
+        if not self.checkpoint_path:
+            return
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"source": os.path.abspath(source), "records": records}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def embed_with_retry(self, contents: list[str]) -> list[list[float]]:
+        attempt = 0
+        while True:
+            try:
+                return self.embedding.generate_multiple(contents)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = min(60.0, 2.0**attempt) * (1 + random.random())
+                logger.warning(
+                    "Embedding batch failed (%s), retrying in %.1fs", e, delay
+                )
+                time.sleep(delay)
+                attempt += 1
+
+    def prepare_chunk(self, items: list[dict]) -> list[dict]:
+        """
+        Builds the rows of a chunk, embedding their text in token-budgeted
+        batches. Items sharing a natural key are merged into the last one. In
+        sync mode rows whose content hash is unchanged are left without an
+        embedding, otherwise items already loaded are rejected before being
+        embedded.
+        """
+        key_field = self.db_model.get_natural_key_field()
+        embedding_field = self.db_model.get_embedding_field()
+        model_name = self.embedding.embedding_model_name
+        keyed = {}
+        for i, item in enumerate(items):
+            item = {**item}
+            item.setdefault(key_field, self.db_model.default_natural_key(item))
+            key = item[key_field] if item[key_field] is not None else (None, i)
+            # The last item of a natural key wins: a statement can't insert or
+            # update the same row twice.
+            keyed.pop(key, None)
+            keyed[key] = item
+        if not self.sync:
+            existing = self.existing_hashes(
+                [key for key in keyed if not isinstance(key, tuple)]
+            )
+            if existing:
+                raise ValueError(
+                    f"{len(existing)} products of the chunk are already loaded "
+                    f"(eg {key_field} {next(iter(existing))!r}), use --sync to "
+                    "update an existing catalog"
+                )
+        rows, texts = [], []
+        for item in keyed.values():
+            product = self.db_model(**item)
+            rows.append(
+                {
+                    **item,
+                    "content": product.to_str(),
+                    "content_hash": product.get_content_hash(model_name),
+                }
+            )
+            texts.append(product.to_embedding_str())
+
+        stale = list(range(len(rows)))
+        if self.sync:
+            existing = self.existing_hashes([row[key_field] for row in rows])
+            stale = [
+                i
+                for i, row in enumerate(rows)
+                if existing.get(row[key_field]) != row["content_hash"]
+            ]
+        for batch in token_budget_batches(
+            [texts[i] for i in stale], self.batch_tokens, self.batch_size
+        ):
+            embeddings = self.embed_with_retry([texts[stale[i]] for i in batch])
+            for i, embedding in zip(batch, embeddings):
+                rows[stale[i]][embedding_field] = embedding
+        return rows
+
+    def existing_hashes(self, keys: list[str]) -> dict[str, str]:
+        key_column = getattr(self.db_model, self.db_model.get_natural_key_field())
+        stmt = select(key_column, self.db_model.content_hash).where(
+            key_column == bindparam("keys", keys, type_=ARRAY(String)).any_()
+        )
+        with engine.connect() as connection:
+            return dict(connection.execute(stmt).fetchall())
+
+    def write_chunk(self, rows: list[dict]):
+        # Executed as multi-row INSERT ... VALUES statements by SQLAlchemy's
+        # insertmanyvalues batching, committed once per chunk.
+        embedding_field = self.db_model.get_embedding_field()
+        embedded = [row for row in rows if embedding_field in row]
+        unchanged = [row for row in rows if embedding_field not in row]
+        with engine.begin() as connection:
+            for group in (embedded, unchanged):
+                if not group:
+                    continue
+                columns = set().union(*group)
+                group = [
+                    {column: row.get(column) for column in columns} for row in group
+                ]
+                if self.sync:
+                    connection.execute(self.upsert_statement(columns), group)
+                    continue
+                try:
+                    connection.execute(insert(self.db_model.__table__), group)
+                except IntegrityError as e:
+                    # Loaded since the chunk was checked, eg by a previous
+                    # chunk of the same file.
+                    raise ValueError(
+                        f"Products of the chunk are already loaded ({e.orig}), use "
+                        "--sync to update an existing catalog"
+                    ) from e
+        self.embedded += len(embedded)
+
+    def upsert_statement(self, columns: set[str]):
+        key_field = self.db_model.get_natural_key_field()
+        stmt = pg_insert(self.db_model.__table__)
+        return stmt.on_conflict_do_update(
+            index_elements=[key_field],
+            set_={
+                column: stmt.excluded[column]
+                for column in columns
+                if column != key_field
+            },
+        )
+
+    def backfill_content_hashes(self, batch_size: int = 1000) -> int:
+        """
+        Sets the content hash of the embedded rows loaded without one, eg
+        before sync mode existed, so that the next sync keeps their current
+        embeddings instead of re-embedding the whole catalog. Returns the
+        number of rows updated.
+        """
+        table = self.db_model.__table__
+        fields = self.db_model.get_embedding_fields()
+        model_name = self.embedding.embedding_model_name
+        stmt = (
+            select(table.c.id, *(table.c[field] for field in fields))
+            .where(
+                table.c.content_hash.is_(None),
+                table.c[self.db_model.get_embedding_field()].is_not(None),
+                table.c.id > bindparam("after"),
+            )
+            .order_by(table.c.id)
+            .limit(batch_size)
+        )
+        update = (
+            table.update()
+            .where(table.c.id == bindparam("row_id"))
+            .values(content_hash=bindparam("hash"))
+        )
+        updated, after = 0, 0
+        while True:
+            with engine.begin() as connection:
+                rows = connection.execute(stmt, {"after": after}).mappings().fetchall()
+                if not rows:
+                    return updated
+                connection.execute(
+                    update,
+                    [
+                        {
+                            "row_id": row["id"],
+                            "hash": self.db_model(
+                                **{field: row[field] for field in fields}
+                            ).get_content_hash(model_name),
+                        }
+                        for row in rows
+                    ],
+                )
+            updated += len(rows)
+            after = rows[-1]["id"]
+            logger.info("Backfilled the content hash of %d rows", updated)
+
+    def drop_vector_index(self):
+        with engine.begin() as connection:
+            connection.execute(
+                text(f'DROP INDEX IF EXISTS "{vector_index_name(self.db_model)}"')
+            )
+
+    def create_vector_index(self):
+        for index in self.db_model.__table__.indexes:
+            if index.name == vector_index_name(self.db_model):
+                logger.info("Building index %s", index.name)
+                index.create(bind=engine, checkfirst=True)
+
+    def run(self, source: str, rebuild_index: bool = False) -> int:
+        """
+        Loads source and returns the number of records written. With
+        rebuild_index the ANN index is dropped during the load and rebuilt at
+        the end, which is much faster than maintaining it row by row.
+        """
+        skip = self.read_checkpoint(source)
+        if skip:
+            logger.info("Resuming %s after %d records", source, skip)
+        products = iter_products(source)
+        for _ in range(skip):
+            next(products, None)
+
+        if rebuild_index:
+            self.drop_vector_index()
+
+        started = time.monotonic()
+        written = 0
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for items in chunked(products, self.chunk_size):
+                pending.append((executor.submit(self.prepare_chunk, items), len(items)))
+                if len(pending) >= self.concurrency:
+                    written += self.commit_next(pending, source, skip, written, started)
+            while pending:
+                written += self.commit_next(pending, source, skip, written, started)
+
+        if rebuild_index:
+            self.create_vector_index()
+        logger.info(
+            "Loaded %d records in %.1fs", written, time.monotonic() - started
+        )
+        return written
+
+    def commit_next(
+        self, pending: deque, source: str, skip: int, written: int, started: float
+    ) -> int:
+        """
+        Writes the oldest prepared chunk, keeping the table in file order so
+        the checkpoint is a simple record count. Returns the number of
+        records of the chunk, merged duplicates included.
+        """
+        future, records = pending.popleft()
+        self.write_chunk(future.result())
+        written += records
+        self.write_checkpoint(source, skip + written)
+        elapsed = time.monotonic() - started
+        logger.info(
+            "Committed %d records (%.1f records/s, %d embedded)",
+            skip + written,
+            written / elapsed if elapsed else 0.0,
+            self.embedded,
+        )
+        return records
@@ -0,0 +1,383 @@
+"""
+    This module contains the metrics of the application, exported in the
+    Prometheus text format on the /metrics route.
+
+    The time spent in each stage of a request (embedding, SQL, LLM, tools...)
+    is recorded in a histogram and, for the current request, in a per-request
+    breakdown held in a context variable, which the HTTP middleware can send
+    back in a Server-Timing header.
+"""
+
+import contextvars
+import logging
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Union
+
+from config.main import config
+from models.database import pool_stats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+
+request_timings: contextvars.ContextVar[Union[dict, None]] = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+
+def format_labels(labelnames: tuple, labelvalues: tuple, extra: str = "") -> str:
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    labels = [
+        f'{name}="{escape(value)}"' for name, value in zip(labelnames, labelvalues)
+    ]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """
+    Base class of the metrics, the values are kept per label values.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values: dict[tuple, object] = {}
+
+    def label_values(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [
+            f"{self.name}_total{format_labels(self.labelnames, key)} {format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    """
+    Gauge read from a callback when the metrics are collected, the callback
+    returns a dict of label values tuples to values.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        callback: Union[Callable[[], dict], None] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.label_values(labels)] = value
+
+    def samples(self) -> list[str]:
+        if self.callback is not None:
+            try:
+                values = list(self.callback().items())
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Collecting %s failed", self.name)
+                values = []
+        else:
+            with self.lock:
+                values = list(self.values.items())
+        return [
+            f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.labelnames, key, le)} {cumulative}"
+                )
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        callback: Union[Callable[[], dict], None] = None,
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_duration = registry.histogram(
+    "hybrid_search_stage_duration_seconds",
+    "Time spent in each stage of a request.",
+    ("stage",),
+)
+http_request_duration = registry.histogram(
+    "hybrid_search_http_request_duration_seconds",
+    "Duration of the HTTP requests, until the response headers are sent.",
+    ("method", "route", "status"),
+)
+search_rows_scanned = registry.histogram(
+    "hybrid_search_search_rows_scanned",
+    "Rows read by the table and index scans of the sampled search queries.",
+    buckets=(10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000),
+)
+search_explains = registry.counter(
+    "hybrid_search_search_explain",
+    "Sampled EXPLAIN ANALYZE of the search queries, by use of the vector index.",
+    ("vector_index_used",),
+)
+chat_iterations = registry.counter(
+    "hybrid_search_chat_iterations",
+    "LLM calls made by the chat tool loop.",
+)
+chat_tool_calls = registry.counter(
+    "hybrid_search_chat_tool_calls",
+    "Tool calls executed by the chat tool loop.",
+)
+chat_tokens = registry.counter(
+    "hybrid_search_chat_tokens",
+    "Tokens of the LLM calls made by the chat tool loop, by kind.",
+    ("kind",),
+)
+chat_tool_result_tokens = registry.histogram(
+    "hybrid_search_chat_tool_result_tokens",
+    "Estimated tokens of the tool results sent back to the LLM.",
+    buckets=(50, 100, 200, 400, 800, 1_600, 3_200, 6_400),
+)
+change_feed_lag = registry.histogram(
+    "hybrid_search_change_feed_lag_seconds",
+    "Time from a catalog change to the end of its handling by the change feed.",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+
+def record_stage(stage_name: str, seconds: float):
+    """
+    Records the time spent in a stage, in the histogram and in the timings of
+    the current request. Stages run several times per request are summed.
+    """
+    stage_duration.observe(seconds, stage=stage_name)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage_name] = timings.get(stage_name, 0.0) + seconds
+
+
+@contextmanager
+def stage(stage_name: str):
+    """
+    Times the enclosed block as stage_name, see `record_stage`.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage_name, time.perf_counter() - started)
+
+
+def start_request_timings() -> dict:
+    timings = {}
+    request_timings.set(timings)
+    return timings
+
+
+def server_timing_header(timings: dict, total: float) -> str:
+    """
+    Formats the request timings as a Server-Timing header value.
+    """
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def should_explain() -> bool:
+    return (
+        config.METRICS_EXPLAIN_SAMPLE_RATE > 0
+        and random.random() < config.METRICS_EXPLAIN_SAMPLE_RATE
+    )
+
+
+def summarize_plan(plan: dict, vector_index: str) -> dict:
+    """
+    Summarizes an `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` plan: the rows read
+    by the scan nodes, the shared buffers hit and read, and whether the vector
+    index was scanned.
+    """
+    summary = {
+        "rows_scanned": 0,
+        "shared_hit_blocks": plan["Plan"].get("Shared Hit Blocks", 0),
+        "shared_read_blocks": plan["Plan"].get("Shared Read Blocks", 0),
+        "vector_index_used": False,
+        "execution_ms": plan.get("Execution Time"),
+        "planning_ms": plan.get("Planning Time"),
+    }
+    nodes = [plan["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get("Plans", []))
+        if node["Node Type"].endswith("Scan") and "Actual Rows" in node:
+            summary["rows_scanned"] += node["Actual Rows"] * node.get("Actual Loops", 1)
+            summary["rows_scanned"] += node.get("Rows Removed by Filter", 0) * node.get(
+                "Actual Loops", 1
+            )
+        if node.get("Index Name", "").startswith(vector_index):
+            summary["vector_index_used"] = True
+    return summary
+
+
+def record_plan(plan: dict, vector_index: str) -> dict:
+    summary = summarize_plan(plan, vector_index)
+    search_rows_scanned.observe(summary["rows_scanned"])
+    search_explains.inc(vector_index_used=str(summary["vector_index_used"]).lower())
+    logger.info("Search query plan: %s", summary)
+    return summary
+
+
+def pool_gauges() -> Gauge:
+    """
+    Registers gauges reading the state of the database connection pools.
+    """
+
+    def collect():
+        return {
+            (pool, state): value
+            for pool, stats in pool_stats().items()
+            for state, value in stats.items()
+            if state in ("size", "checked_out", "checked_in", "overflow")
+        }
+
+    return registry.gauge(
+        "hybrid_search_database_pool_connections",
+        "Connections of the database pools by state.",
+        ("pool", "state"),
+        collect,
+    )
+
+
+def stats_gauges(name: str, documentation: str, source) -> Gauge:
+    """
+    Registers gauges reading the numeric `stats()` counters of source.
+    """
+
+    def collect():
+        return {
+            (key,): value
+            for key, value in source.stats().items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+
+    return registry.gauge(name, documentation, ("stat",), collect)
+
+
+def cache_gauges(name: str, cache) -> Gauge:
+    """
+    Registers gauges reading the `stats()` counters of a cache.
+    """
+    return stats_gauges(
+        f"hybrid_search_{name}_cache", f"Statistics of the {name} cache.", cache
+    )
+
+
+pool_gauges()
@@ -0,0 +1,279 @@
+"""
+    This module contains the precomputed nearest neighbors of the products,
+    served to the "more like this" widgets by a plain index lookup.
+
+    The neighbors of a product are recomputed when its content hash changes,
+    as are the neighbor lists containing it and the lists it now belongs to.
+    Lists shortened by deleted products are recomputed as well, so that
+    running `NeighborIndex.refresh` periodically keeps the table current
+    (see scripts/refresh_neighbors.py).
+"""
+
+import datetime
+import logging
+from typing import Union
+
+from sqlalchemy import ARRAY, Integer, bindparam, delete, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import defer
+
+from config.main import config
+from models.database import engine, get_async_db_session
+from models.product_neighbor import ProductNeighbor, ProductNeighborState
+from services.ingestion import chunked
+from services.postgres_searcher import SearchResults
+
+logger = logging.getLogger(__name__)
+
+# Advisory lock held during a refresh, so that two refresh jobs never
+# compute the same lists concurrently.
+REFRESH_LOCK_KEY = 0x6E656967
+
+
+class NeighborIndex:
+    """
+    Precomputed top-k neighbors of the products of the searcher's model, by
+    the metric of its vector index.
+    """
+
+    def __init__(self, searcher, k: int = 20, batch_size: int = 200):
+        self.searcher = searcher
+        self.db_model = searcher.db_model
+        self.k = k
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_config(cls, searcher):
+        return cls(searcher, config.NEIGHBORS_K, config.NEIGHBORS_BATCH_SIZE)
+
+    def neighbors_query(self, product_id: int, top: int):
+        """
+        Selects the top precomputed neighbors of product_id in rank order,
+        through the primary key of the neighbors table.
+        """
+        return (
+            select(self.db_model, ProductNeighbor.rank, ProductNeighbor.score)
+            .join(ProductNeighbor, ProductNeighbor.neighbor_id == self.db_model.id)
+            .where(ProductNeighbor.product_id == product_id)
+            .order_by(ProductNeighbor.rank)
+            .limit(top)
+            .options(defer(getattr(self.db_model, self.db_model.get_embedding_field())))
+        )
+
+    async def aneighbors(self, product_id: int, top: int = 5) -> SearchResults:
+        """
+        Returns the precomputed neighbors of product_id, with the search info
+        of a vector search, or an empty list when they haven't been computed.
+        """
+        async with get_async_db_session() as db_session:
+            rows = (await db_session.execute(self.neighbors_query(product_id, top))).all()
+        items = SearchResults()
+        for item, rank, score in rows:
+            item.search_info = {
+                "score": score,
+                "vector_rank": rank,
+                "vector_score": score,
+                "text_rank": None,
+                "text_score": None,
+            }
+            items.append(item)
+        return items
+
+    def compute_statement(self):
+        """
+        Recomputes the neighbor lists of the :ids products with one vector
+        search per product, run in a LATERAL subquery.
+        """
+        table_name = self.db_model.__tablename__
+        embedding_field = self.db_model.get_embedding_field()
+        neighbors_query = self.searcher.build_vector_query(
+            "ann", "WHERE id <> source.id", embedding_sql=f"source.{embedding_field}"
+        )
+        return text(
+            f"""
+            INSERT INTO {ProductNeighbor.__tablename__}
+                (product_id, rank, neighbor_id, score)
+            SELECT source.id,
+                ROW_NUMBER() OVER (
+                    PARTITION BY source.id ORDER BY neighbors.score DESC, neighbors.id
+                ),
+                neighbors.id,
+                neighbors.score
+            FROM "{table_name}" source
+            CROSS JOIN LATERAL ({neighbors_query}) neighbors
+            WHERE source.id = ANY(:ids) AND source.{embedding_field} IS NOT NULL
+            """
+        )
+
+    def compute(self, connection, ids: list[int]) -> int:
+        """
+        Replaces the neighbor lists of the products ids, one transaction per
+        batch. Returns the number of lists computed.
+        """
+        statement = self.compute_statement()
+        params = {"candidates": self.k}
+        ann_candidates = self.searcher.initial_ann_candidates("ann", self.k, True)
+        if ann_candidates is not None:
+            params["ann_candidates"] = ann_candidates
+        for batch in chunked(ids, self.batch_size):
+            batch_ids = bindparam("ids", batch, type_=ARRAY(Integer))
+            with connection.begin():
+                for setting in self.searcher.index_settings(
+                    ef_search=max(ann_candidates or 0, self.k, 40)
+                ):
+                    connection.execute(*setting)
+                connection.execute(
+                    delete(ProductNeighbor).where(ProductNeighbor.product_id == batch_ids.any_())
+                )
+                connection.execute(statement, {**params, "ids": batch})
+                states = select(
+                    self.db_model.id,
+                    self.db_model.content_hash,
+                    bindparam("refreshed_at", datetime.datetime.utcnow()),
+                ).where(self.db_model.id == batch_ids.any_())
+                upsert = pg_insert(ProductNeighborState).from_select(
+                    ["product_id", "content_hash", "refreshed_at"], states
+                )
+                connection.execute(
+                    upsert.on_conflict_do_update(
+                        index_elements=["product_id"],
+                        set_={
+                            "content_hash": upsert.excluded.content_hash,
+                            "refreshed_at": upsert.excluded.refreshed_at,
+                        },
+                    )
+                )
+        return len(ids)
+
+    def changed_products(self, connection) -> list[int]:
+        """
+        Returns the products whose neighbors were never computed or were
+        computed from a previous version of their content.
+        """
+        table_name = self.db_model.__tablename__
+        embedding_field = self.db_model.get_embedding_field()
+        return list(
+            connection.execute(
+                text(
+                    f"""
+                    SELECT product.id FROM "{table_name}" product
+                    LEFT JOIN {ProductNeighborState.__tablename__} state
+                        ON state.product_id = product.id
+                    WHERE product.{embedding_field} IS NOT NULL
+                        AND (state.product_id IS NULL
+                            OR state.content_hash IS DISTINCT FROM product.content_hash)
+                    ORDER BY product.id
+                    """
+                )
+            ).scalars()
+        )
+
+    def lists_containing(self, connection, ids: list[int]) -> list[int]:
+        return list(
+            connection.execute(
+                select(ProductNeighbor.product_id)
+                .distinct()
+                .where(
+                    ProductNeighbor.neighbor_id
+                    == bindparam("ids", ids, type_=ARRAY(Integer)).any_()
+                )
+            ).scalars()
+        )
+
+    def short_lists(self, connection) -> list[int]:
+        """
+        Returns the products with fewer neighbors than they should have,
+        after some of their neighbors were deleted.
+        """
+        table_name = self.db_model.__tablename__
+        embedding_field = self.db_model.get_embedding_field()
+        return list(
+            connection.execute(
+                text(
+                    f"""
+                    SELECT state.product_id
+                    FROM {ProductNeighborState.__tablename__} state
+                    LEFT JOIN {ProductNeighbor.__tablename__} neighbor
+                        ON neighbor.product_id = state.product_id
+                    GROUP BY state.product_id
+                    HAVING COUNT(neighbor.product_id) < LEAST(:k, (
+                        SELECT COUNT(*) - 1 FROM "{table_name}"
+                        WHERE {embedding_field} IS NOT NULL
+                    ))
+                    """
+                ),
+                {"k": self.k},
+            ).scalars()
+        )
+
+    def promoted_lists(self, connection, ids: list[int]) -> list[int]:
+        """
+        Returns the products that the recomputed products ids now rank above
+        the last of their current neighbors. The similarity being symmetric,
+        these are found among the new neighbors of ids.
+        """
+        return list(
+            connection.execute(
+                text(
+                    f"""
+                    SELECT DISTINCT candidate.neighbor_id
+                    FROM {ProductNeighbor.__tablename__} candidate
+                    CROSS JOIN LATERAL (
+                        SELECT COUNT(*) AS size, MIN(score) AS last_score
+                        FROM {ProductNeighbor.__tablename__}
+                        WHERE product_id = candidate.neighbor_id
+                    ) current
+                    WHERE candidate.product_id = ANY(:ids)
+                        AND NOT candidate.neighbor_id = ANY(:ids)
+                        AND (current.size < :k OR current.last_score < candidate.score)
+                    """
+                ),
+                {"ids": ids, "k": self.k},
+            ).scalars()
+        )
+
+    def refresh(self, full: bool = False) -> Union[int, None]:
+        """
+        Recomputes the stale neighbor lists (all of them with full) and
+        returns their number, or None when another refresh is running.
+        """
+        with engine.connect() as connection:
+            locked = connection.execute(
+                text("SELECT pg_try_advisory_lock(:key)"), {"key": REFRESH_LOCK_KEY}
+            ).scalar()
+            connection.commit()
+            if not locked:
+                logger.info("Another neighbors refresh is running, skipping")
+                return None
+            try:
+                if full:
+                    with connection.begin():
+                        connection.execute(delete(ProductNeighborState))
+                with connection.begin():
+                    changed = self.changed_products(connection)
+                    stale = set(changed)
+                    if changed:
+                        stale.update(self.lists_containing(connection, changed))
+                    stale.update(self.short_lists(connection))
+                refreshed = self.compute(connection, sorted(stale))
+                if changed and not full:
+                    with connection.begin():
+                        promoted = self.promoted_lists(connection, sorted(stale))
+                    refreshed += self.compute(connection, promoted)
+            finally:
+                connection.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), {"key": REFRESH_LOCK_KEY}
+                )
+                connection.commit()
+        logger.info(
+            "Refreshed the neighbors of %d products (%d changed)", refreshed, len(changed)
+        )
+        return refreshed
+
+    def apply_changes(self, batch):
+        """
+        Handles a batch of the catalog change feed: refreshes the neighbors
+        when embeddings changed.
+        """
+        if batch.full or batch.embedding_ids:
+            self.refresh()
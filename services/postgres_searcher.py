@@ -4,14 +4,73 @@ database using a hybrid search strategy.
 """
 
 # pylint:disable=import-error,missing-function-docstring,missing-class-docstring,unsupported-binary-operation
+import asyncio
+import json
+import time
 from typing import Union
-from sqlalchemy import Float, Integer, column, select, text
-from sqlalchemy.orm import joinedload
+import numpy as np
+from sqlalchemy import ARRAY, Float, Integer, any_, bindparam, column, func, select, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import defer
 
+from config.main import config
 from services.embedding import Embedding
-from models.database import get_db_session
+from services.diversity import decode_vectors
+from services.embedding_cache import EmbeddingCache
+from services.filters import FilterCompiler
+from services.fusion import fusion_from_config
+from services.metrics import cache_gauges, record_plan, should_explain, stage
+from models.database import get_async_db_session, get_db_session, statement_timeout_ms
+from models.vector_index import (
+    distance_operator,
+    embedding_dimensions,
+    index_distance_sql,
+    is_compact_index,
+    similarity_sql,
+    vector_index_name,
+)
 
-embedding_util = Embedding()
+RANKING_COLUMNS = (
+    column("id", Integer),
+    column("score", Float),
+    column("vector_rank", Integer),
+    column("vector_score", Float),
+    column("text_rank", Integer),
+    column("text_score", Float),
+    column("vector_hits", Integer),
+)
+
+
+class SearchResults(list):
+    """
+    Ranked items of a search, with the facet counts of its candidates when
+    they were requested, eg `{"category": {"Summer Wear": 12}, ...}`.
+    """
+
+    def __init__(self, items=(), facets: Union[dict, None] = None):
+        super().__init__(items)
+        self.facets = facets
+
+
+class PlanCall:
+    """
+    Step of a search plan run in process rather than in the database, eg a
+    search of the vector snapshot. `run_plan` calls it, `arun_plan` runs it
+    in a thread so that it doesn't block the event loop.
+    """
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __call__(self):
+        return self.function(*self.args)
+
+
+# The cache, and its shared store, are only opened by the processes that
+# embed a query.
+embedding_util = Embedding(cache_factory=EmbeddingCache.from_config)
+cache_gauges("embedding", embedding_util)
 
 
 class PostgresSearcher:
@@ -22,121 +81,967 @@ class PostgresSearcher:
         self,
         db_model,
         embed_dimensions: Union[int, None] = 1536,
+        fusion=None,
+        vector_tier=None,
     ):
         self.db_model = db_model
         self.embed_dimensions = embed_dimensions
+        self.fusion = fusion or fusion_from_config()
+        # Optional in-process vector search, eg a
+        # services.vector_snapshot.VectorSnapshotTier.
+        self.vector_tier = vector_tier
+        self.filter_compiler = FilterCompiler(db_model)
+        self.estimates: dict[tuple, tuple[float, tuple[int, int]]] = {}
 
-    def build_filter_clause(self, filters) -> tuple[str, str]:
-        if filters is None:
-            return "", ""
-        filter_clauses = []
-        for filter in filters:
-            if isinstance(filter["value"], str):
-                filter["value"] = f"'{filter['value']}'"
-            elif isinstance(filter["value"], list):
-                comparison_operator = filter["comparison_operator"]
-                if comparison_operator != "&&":
-                    filter["value"] = (
-                        "(" + ",".join([f"'{v}'" for v in filter["value"]]) + ")"
-                    )
-                else:
-                    _vals = [f'"{v}"' for v in filter["value"]]
-                    filter["value"] = "'{" + ",".join(_vals) + "}'"
-            filter_clauses.append(
-                f"{filter['column']} {filter['comparison_operator']} {filter['value']}"
-            )
-        filter_clause = " AND ".join(filter_clauses)
-        if len(filter_clause) > 0:
-            return f"WHERE {filter_clause}", f"AND {filter_clause}"
-        return "", ""
+    def apply_changes(self, batch):
+        """
+        Handles a batch of the catalog change feed: drops the planner
+        estimates of the filters and updates the vector tier.
+        """
+        self.estimates.clear()
+        if self.vector_tier is not None:
+            self.vector_tier.apply_changes(batch)
 
-    def search(
+    def text_search_vector(self) -> str:
+        """
+        Returns the SQL expression of the tsvector searched by the full-text
+        leg. Models exposing a precomputed (and GIN indexed) tsvector column
+        through `get_text_search_vector_field` are searched on that column,
+        otherwise the text field is tokenized on the fly.
+        """
+        if hasattr(self.db_model, "get_text_search_vector_field"):
+            return self.db_model.get_text_search_vector_field()
+        return f"to_tsvector('english', {self.db_model.get_text_search_field()})"
+
+    def build_search_query(
         self,
         query_text: Union[str, None],
         query_vector: Union[list[float], list],
+        filters: Union[list[dict], None] = None,
+        vector_strategy: str = "ann",
+        ann_candidates: Union[int, None] = None,
         top: int = 5,
+        candidates: Union[int, None] = None,
+        fusion=None,
+        offset: int = 0,
+        facets: bool = False,
+    ):
+        """
+        Builds the ranking query and its parameters, shared by the sync and
+        async search paths. The legs fetch `candidates` rows each, the fusion
+        method combines them and the `top` rows after `offset` are returned
+        with their fused score and per-leg ranks and scores. The depth of the
+        legs doesn't depend on offset, so that all the pages of a query are
+        taken from the same fused ranking. A disabled leg is an empty CTE.
+        With facets, every row also carries the facet counts of all the fused
+        candidates (see `facets_sql`).
+        """
+        if query_text is None and len(query_vector) == 0:
+            raise ValueError("Both query text and query vector are empty")
+        fusion = fusion or self.fusion
+        candidates = max(candidates or config.SEARCH_CANDIDATES, top)
+
+        filter_clause, filter_params = self.compile_filters(filters, vector_strategy)
+        hybrid_query = self.ranking_sql(
+            query_text is not None,
+            len(query_vector) > 0,
+            filter_clause,
+            vector_strategy,
+            fusion,
+            facets=facets,
+        )
+
+        sql = text(hybrid_query).columns(
+            *RANKING_COLUMNS, *([column("facets", JSONB)] if facets else [])
+        )
+        params = {
+            "embedding": str(query_vector),
+            "query": query_text,
+            "candidates": candidates,
+            "top": top,
+            "offset": offset,
+            **fusion.params(),
+            **filter_params,
+        }
+        if facets:
+            params["price_facet_bounds"] = self.price_facet_bounds()
+        if ann_candidates is not None:
+            params["ann_candidates"] = ann_candidates
+        return sql, params
+
+    def build_batch_search_query(
+        self,
+        query_texts: Union[list[str], None],
+        query_vectors: Union[list[list[float]], None],
         filters: Union[list[dict], None] = None,
+        vector_strategy: str = "ann",
+        ann_candidates: Union[int, None] = None,
+        top: int = 5,
+        candidates: Union[int, None] = None,
+        fusion=None,
     ):
-        filter_clause_where, filter_clause_and = self.build_filter_clause(filters)
+        """
+        Builds the ranking query of a batch of searches sharing their filters:
+        the query vectors and texts are unnested and the ranking query of
+        `build_search_query` runs for each of them in a LATERAL subquery. The
+        rows are returned ordered by query_index, then by fused score.
+        """
+        if query_texts is None and query_vectors is None:
+            raise ValueError("Both query texts and query vectors are empty")
+        fusion = fusion or self.fusion
+        candidates = max(candidates or config.SEARCH_CANDIDATES, top)
+        size = len(query_texts if query_texts is not None else query_vectors)
 
-        table_name = self.db_model.__tablename__
-        embedding_field_name = self.db_model.get_embedding_field()
-        search_text_field_name = self.db_model.get_text_search_field()
+        filter_clause, filter_params = self.compile_filters(filters, vector_strategy)
+        ranking_query = self.ranking_sql(
+            query_texts is not None,
+            query_vectors is not None,
+            filter_clause,
+            vector_strategy,
+            fusion,
+            embedding_sql="queries.embedding",
+            query_sql="queries.query_text",
+        )
+        batch_query = f"""
+        SELECT CAST(queries.query_index - 1 AS INTEGER) AS query_index, ranked.*
+        FROM unnest(
+            CAST(:embeddings AS vector[]), CAST(:queries AS text[])
+        ) WITH ORDINALITY AS queries(embedding, query_text, query_index)
+        CROSS JOIN LATERAL ({ranking_query}) ranked
+        ORDER BY queries.query_index, ranked.score DESC, ranked.id
+        """
 
-        vector_query = f"""
-            SELECT id, RANK () OVER (ORDER BY {embedding_field_name} <=> :embedding) AS rank
-                FROM "{table_name}"
-                {filter_clause_where}
-                ORDER BY {embedding_field_name} <=> :embedding
-                LIMIT 20
+        sql = text(batch_query).columns(
+            column("query_index", Integer), *RANKING_COLUMNS
+        )
+        params = {
+            "embeddings": (
+                [str(vector) for vector in query_vectors]
+                if query_vectors is not None
+                else [None] * size
+            ),
+            "queries": query_texts if query_texts is not None else [None] * size,
+            "candidates": candidates,
+            "top": top,
+            "offset": 0,
+            **fusion.params(),
+            **filter_params,
+        }
+        if ann_candidates is not None:
+            params["ann_candidates"] = ann_candidates
+        return sql, params
+
+    def compile_filters(self, filters: Union[list[dict], None], vector_strategy: str):
+        inline = None
+        if vector_strategy == "partial":
+            inline = {
+                self.db_model.partial_vector_index_column: set(
+                    self.db_model.get_partial_vector_index_values()
+                )
+            }
+        return self.filter_compiler.compile(filters, inline)
+
+    def ranking_sql(
+        self,
+        text_enabled: bool,
+        vector_enabled: bool,
+        filter_clause: str,
+        vector_strategy: str,
+        fusion,
+        embedding_sql: str = ":embedding",
+        query_sql: str = ":query",
+        facets: bool = False,
+    ) -> str:
+        """
+        Returns the SQL of the ranking query. embedding_sql and query_sql are
+        the expressions of the query vector and text, bound parameters for a
+        single search and columns of the queries for a batch search.
+        """
+        filter_clause_where = f"WHERE {filter_clause}" if filter_clause else ""
+        filter_clause_and = f"AND {filter_clause}" if filter_clause else ""
+
+        table_name = self.db_model.__tablename__
+        search_vector = self.text_search_vector()
+        empty_leg = """
+            SELECT CAST(NULL AS INTEGER) AS id, CAST(NULL AS BIGINT) AS rank,
+                CAST(NULL AS FLOAT) AS score
+                WHERE false
             """
 
-        fulltext_query = f"""
-            SELECT id, RANK () OVER (ORDER BY ts_rank_cd(to_tsvector('english', {search_text_field_name}), query) DESC)
-                FROM "{table_name}", plainto_tsquery('english', :query) query
-                WHERE to_tsvector('english', {search_text_field_name}) @@ query {filter_clause_and}
-                ORDER BY ts_rank_cd(to_tsvector('english', {search_text_field_name}), query) DESC
-                LIMIT 20
+        vector_query = empty_leg
+        if vector_enabled:
+            vector_query = self.build_vector_query(
+                vector_strategy, filter_clause_where, embedding_sql
+            )
+
+        fulltext_query = empty_leg
+        if text_enabled:
+            fulltext_query = f"""
+            SELECT id, RANK () OVER (ORDER BY ts_rank_cd({search_vector}, query) DESC) AS rank,
+                ts_rank_cd({search_vector}, query) AS score
+                FROM "{table_name}", plainto_tsquery('english', {query_sql}) query
+                WHERE {search_vector} @@ query {filter_clause_and}
+                ORDER BY ts_rank_cd({search_vector}, query) DESC
+                LIMIT :candidates
             """
 
-        hybrid_query = f"""
+        ranking_query = f"""
         WITH vector_search AS (
             {vector_query}
         ),
         fulltext_search AS (
             {fulltext_query}
+        ),
+        fused AS (
+            SELECT
+                COALESCE(vector_search.id, fulltext_search.id) AS id,
+                {fusion.score_sql()} AS score,
+                vector_search.rank AS vector_rank,
+                vector_search.score AS vector_score,
+                fulltext_search.rank AS text_rank,
+                fulltext_search.score AS text_score,
+                COUNT(vector_search.id) OVER () AS vector_hits
+            FROM vector_search
+            FULL OUTER JOIN fulltext_search ON vector_search.id = fulltext_search.id
+        )
+        """
+        if not facets:
+            return f"""
+            {ranking_query}
+            SELECT * FROM fused
+            ORDER BY score DESC, id
+            LIMIT :top OFFSET :offset
+            """
+        # The facets row is kept when the page is empty, with a NULL id.
+        return f"""
+        {ranking_query},
+        page AS (
+            SELECT * FROM fused
+            ORDER BY score DESC, id
+            LIMIT :top OFFSET :offset
+        ),
+        facets AS (
+            {self.facets_sql()}
         )
-        SELECT
-            COALESCE(vector_search.id, fulltext_search.id) AS id,
-            COALESCE(1.0 / (:k + vector_search.rank), 0.0) +
-            COALESCE(1.0 / (:k + fulltext_search.rank), 0.0) AS score
-        FROM vector_search
-        FULL OUTER JOIN fulltext_search ON vector_search.id = fulltext_search.id
-        ORDER BY score DESC
-        LIMIT 20
+        SELECT page.*, facets.facets
+        FROM facets LEFT JOIN page ON true
+        ORDER BY page.score DESC, page.id
         """
 
-        if query_text is not None and len(query_vector) > 0:
-            sql = text(hybrid_query).columns(
-                column("id", Integer), column("score", Float)
+    def facets_sql(self) -> str:
+        """
+        Returns the query counting the fused candidates by value of each of
+        the model's `facet_fields` (by element for array columns) and by
+        price bucket, as a single JSON object.
+        """
+        table_name = self.db_model.__tablename__
+        columns = self.db_model.__table__.columns
+        counts = []
+        for field in self.db_model.facet_fields:
+            value = f'candidate_products."{field}"'
+            source = "candidate_products"
+            if isinstance(columns[field].type, ARRAY):
+                value = "facet_value"
+                source = f'candidate_products, unnest(candidate_products."{field}") facet_value'
+            counts.append(
+                f"""'{field}', COALESCE((
+                    SELECT jsonb_object_agg(value, count)
+                    FROM (
+                        SELECT CAST({value} AS TEXT) AS value, COUNT(*) AS count
+                        FROM {source}
+                        WHERE {value} IS NOT NULL
+                        GROUP BY 1
+                    ) counts
+                ), '{{}}')"""
             )
-        elif len(query_vector) > 0:
-            sql = text(vector_query).columns(
-                column("id", Integer), column("rank", Integer)
+        price = f'CAST(candidate_products."{self.db_model.price_facet_field}" AS NUMERIC)'
+        counts.append(
+            f"""'{self.db_model.price_facet_field}', COALESCE((
+                SELECT jsonb_object_agg(bucket, count)
+                FROM (
+                    SELECT width_bucket({price}, CAST(:price_facet_bounds AS NUMERIC[]))
+                        AS bucket, COUNT(*) AS count
+                    FROM candidate_products
+                    WHERE {price} IS NOT NULL
+                    GROUP BY 1
+                ) counts
+            ), '{{}}')"""
+        )
+        return f"""
+            WITH candidate_products AS (
+                SELECT "{table_name}".* FROM fused JOIN "{table_name}" USING (id)
             )
-        elif query_text is not None:
-            sql = text(fulltext_query).columns(
-                column("id", Integer), column("rank", Integer)
+            SELECT jsonb_build_object({", ".join(counts)}) AS facets
+        """
+
+    @staticmethod
+    def price_facet_bounds() -> list[float]:
+        return [float(bound) for bound in config.SEARCH_PRICE_FACET_BOUNDS.split(",")]
+
+    def format_facets(self, facets: Union[dict, None]) -> Union[dict, None]:
+        """
+        Orders the facet values by decreasing count, as JSONB objects don't
+        keep their keys in order, and labels the price buckets, eg `<10`,
+        `10-20` and `100+`, in increasing order.
+        """
+        if facets is None:
+            return None
+        formatted = {
+            field: dict(
+                sorted(facets.get(field, {}).items(), key=lambda item: (-item[1], item[0]))
             )
+            for field in self.db_model.facet_fields
+        }
+        bounds = [f"{bound:g}" for bound in self.price_facet_bounds()]
+        labels = (
+            [f"<{bounds[0]}"]
+            + [f"{low}-{high}" for low, high in zip(bounds, bounds[1:])]
+            + [f"{bounds[-1]}+"]
+        )
+        buckets = facets.get(self.db_model.price_facet_field, {})
+        formatted[self.db_model.price_facet_field] = {
+            label: buckets[str(i)] for i, label in enumerate(labels) if str(i) in buckets
+        }
+        return formatted
+
+    def build_vector_query(
+        self,
+        vector_strategy: str,
+        filter_clause_where: str,
+        embedding_sql: str = ":embedding",
+    ):
+        """
+        Builds the vector leg for one of the filtered search strategies:
+
+        - ann: filters applied to the rows returned by the ANN index scan.
+        - partial: same query, with the filtered value inlined so the planner
+          can pick the partial index built for it.
+        - exact: exact ranking of the pre-filtered rows, the ANN index is
+          bypassed (OFFSET 0 keeps the subquery from being flattened).
+        - iterative: the ANN index returns :ann_candidates rows which are then
+          filtered, the caller grows the candidates until enough rows remain.
+        - snapshot: the rows were ranked in process by the searcher's
+          vector_tier, their :snapshot_ids and :snapshot_scores are filtered.
+
+        With a compact ANN index (see models.vector_index.VECTOR_INDEX_TYPES)
+        the index orders the rows by their compact distance, and the
+        :ann_candidates it returns are reranked by the exact distance.
+        """
+        table_name = self.db_model.__tablename__
+        embedding_field_name = self.db_model.get_embedding_field()
+        operator = distance_operator(self.db_model)
+        distance = f"{embedding_field_name} {operator} {embedding_sql}"
+        index_distance = distance
+        if is_compact_index(self.db_model):
+            index_distance = index_distance_sql(
+                self.db_model, f"CAST({embedding_sql} AS vector)"
+            )
+
+        if vector_strategy == "snapshot":
+            return f"""
+            SELECT id, RANK () OVER (ORDER BY candidates.score DESC) AS rank,
+                candidates.score AS score
+                FROM unnest(
+                    CAST(:snapshot_ids AS INTEGER[]), CAST(:snapshot_scores AS FLOAT[])
+                ) AS candidates(id, score)
+                JOIN "{table_name}" USING (id)
+                {filter_clause_where}
+                ORDER BY candidates.score DESC
+                LIMIT :candidates
+            """
+        if vector_strategy in ("ann", "partial") and index_distance != distance:
+            return f"""
+            SELECT id, RANK () OVER (ORDER BY candidates.distance) AS rank,
+                {similarity_sql(self.db_model, "candidates.distance")} AS score
+                FROM (
+                    SELECT id, {distance} AS distance
+                    FROM "{table_name}"
+                    {filter_clause_where}
+                    ORDER BY {index_distance}
+                    LIMIT :ann_candidates
+                ) candidates
+                ORDER BY candidates.distance
+                LIMIT :candidates
+            """
+        if vector_strategy in ("ann", "partial"):
+            return f"""
+            SELECT id, RANK () OVER (ORDER BY {distance}) AS rank,
+                {similarity_sql(self.db_model, distance)} AS score
+                FROM "{table_name}"
+                {filter_clause_where}
+                ORDER BY {distance}
+                LIMIT :candidates
+            """
+        if vector_strategy == "exact":
+            return f"""
+            SELECT id, RANK () OVER (ORDER BY distance) AS rank,
+                {similarity_sql(self.db_model, "distance")} AS score
+                FROM (
+                    SELECT id, {distance} AS distance
+                    FROM "{table_name}"
+                    {filter_clause_where}
+                    OFFSET 0
+                ) filtered
+                ORDER BY distance
+                LIMIT :candidates
+            """
+        if vector_strategy == "iterative":
+            return f"""
+            SELECT id, RANK () OVER (ORDER BY candidates.distance) AS rank,
+                {similarity_sql(self.db_model, "candidates.distance")} AS score
+                FROM (
+                    SELECT id, {distance} AS distance
+                    FROM "{table_name}"
+                    ORDER BY {index_distance}
+                    LIMIT :ann_candidates
+                ) candidates
+                JOIN "{table_name}" USING (id)
+                {filter_clause_where}
+                ORDER BY candidates.distance
+                LIMIT :candidates
+            """
+        raise ValueError(f"Unknown vector search strategy '{vector_strategy}'")
+
+    def search_plan(
+        self,
+        query_text: Union[str, None],
+        query_vector: Union[list[float], list],
+        top: int = 5,
+        filters: Union[list[dict], None] = None,
+        load_embedding: bool = False,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+        candidates: Union[int, None] = None,
+        fusion=None,
+        offset: int = 0,
+        facets: bool = False,
+        diversity=None,
+    ):
+        """
+        Generator driving a search: it yields the `(statement, params)` to run
+        (or a `PlanCall`) and receives their results, so that the same logic
+        serves the sync (`run_plan`) and async (`arun_plan`) sessions. Returns the ranked rows
+        as `SearchResults`, skipping the first `offset` ones. With diversity
+        (see services.diversity), the rows are picked from a pool of the
+        best fused candidates. Neither the depth of the legs nor the pool
+        grow with offset: the pages of a query are cut from one ranking, and
+        end with it.
+        """
+        rank_top, rank_offset = top, offset
+        if diversity is not None:
+            rank_top, rank_offset = max(diversity.pool, top), 0
+        candidates = max(candidates or config.SEARCH_CANDIDATES, rank_top)
+        if len(query_vector) > 0 and candidates > (ef_search or 40):
+            # An HNSW scan returns at most ef_search rows (40 by default).
+            ef_search = candidates
+        # The statements stop at the deadline of the caller, if any, eg a
+        # timed out tool call, rather than keep a connection busy for nothing.
+        for setting in self.index_settings(ef_search, probes, statement_timeout_ms()):
+            yield setting
+
+        snapshot_hits, snapshot_candidates = None, candidates
+        if len(query_vector) > 0 and self.vector_tier is not None:
+            if filters:
+                # The snapshot isn't filtered, it over-fetches the candidates.
+                snapshot_candidates = min(
+                    candidates * 4, config.VECTOR_SEARCH_MAX_CANDIDATES
+                )
+            with stage("vector_snapshot"):
+                snapshot_hits = yield PlanCall(
+                    self.vector_tier.search, query_vector, snapshot_candidates
+                )
+        if snapshot_hits is not None:
+            vector_strategy, ann_candidates = "snapshot", None
         else:
-            raise ValueError("Both query text and query vector are empty")
+            vector_strategy, ann_candidates = yield from self.postgres_vector_strategy(
+                query_vector, filters, ef_search, candidates
+            )
 
-        results = []
-        with get_db_session() as db_session:
-            results = (
-                db_session.execute(
-                    sql,
-                    {"embedding": str(query_vector), "query": query_text, "k": 60},
+        while True:
+            sql, params = self.build_search_query(
+                query_text,
+                query_vector,
+                filters,
+                vector_strategy,
+                ann_candidates,
+                rank_top,
+                candidates,
+                fusion,
+                rank_offset,
+                facets,
+            )
+            if vector_strategy == "snapshot":
+                params["snapshot_ids"], params["snapshot_scores"] = snapshot_hits
+            with stage("search_rank"):
+                rows = (yield sql, params).fetchall()
+            if should_explain():
+                yield from self.explain(sql, params)
+            results = [row for row in rows if row.id is not None]
+            vector_hits = results[0].vector_hits if results else 0
+            if vector_strategy == "snapshot":
+                if (
+                    not filters
+                    or vector_hits >= candidates
+                    or len(snapshot_hits[0]) < snapshot_candidates
+                ):
+                    break
+                # Too few snapshot candidates passed the filters.
+                self.vector_tier.record_fallback()
+                vector_strategy, ann_candidates = yield from self.postgres_vector_strategy(
+                    query_vector, filters, ef_search, candidates
                 )
-            ).fetchall()
-
-        # Convert results to models
-        items = []
-        for id, _ in results[:top]:
-            with get_db_session() as db_session:
-                if table_name == "menu_item":
-                    item = db_session.execute(
-                        select(self.db_model)
-                        .where(self.db_model.id == id)
-                        .options(joinedload(self.db_model.options))
-                    )
-                else:
-                    item = db_session.execute(
-                        select(self.db_model).where(self.db_model.id == id)
-                    )
-                items.append(item.scalar())
+                continue
+            if vector_strategy != "iterative" or vector_hits >= candidates:
+                break
+            # Too few candidates survived the filters, widen the ANN scan and
+            # fall back to an exact search once the index can't return more.
+            if ann_candidates >= config.VECTOR_SEARCH_MAX_CANDIDATES:
+                vector_strategy = "exact"
+            else:
+                ann_candidates = min(
+                    ann_candidates * 4, config.VECTOR_SEARCH_MAX_CANDIDATES
+                )
+                for setting in self.index_settings(ef_search=ann_candidates):
+                    yield setting
+
+        items = SearchResults(
+            facets=self.format_facets(rows[0].facets) if facets and rows else None
+        )
+        if diversity is not None and results:
+            with stage("search_diversity"):
+                pool = (
+                    yield self.diversity_query(
+                        [row.id for row in results],
+                        diversity.group_field,
+                        diversity.dimensions,
+                    ),
+                    {},
+                ).all()
+                picked = self.diversify(diversity, results, pool, offset + top)
+                results = [results[i] for i in picked][offset:]
+        ids = [row.id for row in results]
+        if not ids:
+            return items
+        with stage("search_hydrate"):
+            loaded = (yield self.hydrate_query(ids, load_embedding), {}).scalars()
+            items.extend(self.order_by_rank(loaded, ids))
+        self.attach_search_info(items, results)
         return items
 
+    def postgres_vector_strategy(
+        self,
+        query_vector: Union[list[float], list],
+        filters: Union[list[dict], None],
+        ef_search: Union[int, None],
+        candidates: int,
+    ):
+        """
+        Picks the strategy of a vector leg searched in Postgres, yielding the
+        index settings it needs. Returns the strategy and its ann_candidates.
+        """
+        vector_strategy = "ann"
+        if len(query_vector) > 0 and filters:
+            with stage("search_plan"):
+                vector_strategy = yield from self.choose_vector_strategy(
+                    filters, ef_search, candidates
+                )
+        ann_candidates = self.initial_ann_candidates(
+            vector_strategy, candidates, len(query_vector) > 0
+        )
+        if ann_candidates is not None:
+            for setting in self.index_settings(
+                ef_search=max(ann_candidates, ef_search or 0)
+            ):
+                yield setting
+        return vector_strategy, ann_candidates
+
+    def initial_ann_candidates(
+        self, vector_strategy: str, candidates: int, vector_enabled: bool
+    ) -> Union[int, None]:
+        """
+        Returns the rows the ANN index scan starts with (:ann_candidates), or
+        None when the vector leg doesn't limit its index scan separately.
+        """
+        compact_index = vector_enabled and is_compact_index(self.db_model)
+        oversampling = max(config.VECTOR_RERANK_OVERSAMPLING, 1) if compact_index else 1
+        if vector_strategy == "iterative":
+            return min(candidates * 4 * oversampling, config.VECTOR_SEARCH_MAX_CANDIDATES)
+        if vector_strategy in ("ann", "partial") and compact_index:
+            # The compact index over-fetches the candidates to rerank.
+            return min(candidates * oversampling, config.VECTOR_SEARCH_MAX_CANDIDATES)
+        return None
+
+    def batch_search_plan(
+        self,
+        query_texts: Union[list[str], None],
+        query_vectors: Union[list[list[float]], None],
+        top: int = 5,
+        filters: Union[list[dict], None] = None,
+        load_embedding: bool = False,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+        candidates: Union[int, None] = None,
+        fusion=None,
+    ):
+        """
+        Search plan of a batch of searches (see `build_batch_search_query`):
+        all the queries are ranked by one statement and their products loaded
+        by another. Returns, for each query, its `(item, search_info)` pairs.
+        The search info is returned apart from the items as a product found by
+        several queries is the same object in all their results.
+        """
+        for setting in self.index_settings(ef_search, probes, statement_timeout_ms()):
+            yield setting
+
+        candidates = max(candidates or config.SEARCH_CANDIDATES, top)
+        vector_strategy = "ann"
+        if query_vectors is not None and filters:
+            with stage("search_plan"):
+                vector_strategy = yield from self.choose_vector_strategy(
+                    filters, ef_search, candidates
+                )
+        ann_candidates = self.initial_ann_candidates(
+            vector_strategy, candidates, query_vectors is not None
+        )
+        if vector_strategy == "iterative":
+            # The scan can't be widened per query, it starts at its widest.
+            ann_candidates = config.VECTOR_SEARCH_MAX_CANDIDATES
+        if ann_candidates is not None:
+            for setting in self.index_settings(
+                ef_search=max(ann_candidates, ef_search or 0)
+            ):
+                yield setting
+
+        sql, params = self.build_batch_search_query(
+            query_texts,
+            query_vectors,
+            filters,
+            vector_strategy,
+            ann_candidates,
+            top,
+            candidates,
+            fusion,
+        )
+        with stage("search_rank"):
+            results = (yield sql, params).fetchall()
+
+        items = {}
+        ids = list(dict.fromkeys(row.id for row in results))
+        if ids:
+            with stage("search_hydrate"):
+                items = {
+                    item.id: item
+                    for item in (
+                        yield self.hydrate_query(ids, load_embedding), {}
+                    ).scalars()
+                }
+        grouped = [[] for _ in params["queries"]]
+        for row in results:
+            if row.id in items:
+                grouped[row.query_index].append((items[row.id], self.search_info(row)))
+        return grouped
+
+    def explain(self, sql, params):
+        """
+        Runs the ranking query again under EXPLAIN (ANALYZE, BUFFERS) and
+        records the rows scanned and whether the vector index was used.
+        """
+        plan = (
+            yield text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql.element.text}"),
+            params,
+        ).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return record_plan(plan[0], vector_index_name(self.db_model))
+
+    @staticmethod
+    def attach_search_info(items, results):
+        """
+        Sets the fused score and the per-leg ranks and scores of each hit on
+        its `search_info` attribute.
+        """
+        rows = {row.id: row for row in results}
+        for item in items:
+            item.search_info = PostgresSearcher.search_info(rows[item.id])
+
+    @staticmethod
+    def search_info(row) -> dict:
+        return {
+            "score": row.score,
+            "vector_rank": row.vector_rank,
+            "vector_score": row.vector_score,
+            "text_rank": row.text_rank,
+            "text_score": row.text_score,
+        }
+
+    def choose_vector_strategy(
+        self,
+        filters: list[dict],
+        ef_search: Union[int, None] = None,
+        candidates: int = 20,
+    ):
+        """
+        Picks the vector leg strategy from the estimated selectivity of the
+        filters (see `build_vector_query`). Small filtered sets are ranked
+        exactly, filters served by a partial index use it, and filters the
+        ANN scan would mostly discard switch to growing candidate limits.
+        """
+        if self.partial_index_value(filters) is not None:
+            return "partial"
+        estimated_rows, total_rows = yield from self.estimate_filtered_rows(filters)
+        if estimated_rows <= config.EXACT_SEARCH_MAX_ROWS:
+            return "exact"
+        # Expected number of the ef_search rows returned by the HNSW scan
+        # that pass the filters.
+        expected_hits = (ef_search or 40) * estimated_rows / max(total_rows, 1)
+        return "ann" if expected_hits >= candidates else "iterative"
+
+    def partial_index_value(self, filters: list[dict]):
+        values = self.db_model.get_partial_vector_index_values()
+        for filter in filters:
+            # Malformed filters are rejected when compiled.
+            if (
+                isinstance(filter, dict)
+                and filter.get("column") == self.db_model.partial_vector_index_column
+                and filter.get("comparison_operator") == "="
+                and filter.get("value") in values
+            ):
+                return filter["value"]
+        return None
+
+    def estimate_filtered_rows(self, filters: list[dict]):
+        """
+        Returns the planner's estimate of the rows matching the filters and of
+        the table size, cached for a few minutes per filter values.
+        """
+        filter_clause, filter_params = self.filter_compiler.compile(filters)
+        key = (filter_clause, repr(sorted(filter_params.items())))
+        cached = self.estimates.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        table_name = self.db_model.__tablename__
+        plan = (
+            yield text(
+                f'EXPLAIN (FORMAT JSON) SELECT 1 FROM "{table_name}" '
+                f"WHERE {filter_clause}"
+            ),
+            filter_params,
+        ).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        total_rows = (
+            yield text(
+                "SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)"
+            ),
+            {"table": f'"{table_name}"'},
+        ).scalar()
+        estimate = (plan[0]["Plan"]["Plan Rows"], max(total_rows or 0, 1))
+
+        if len(self.estimates) >= 1024:
+            self.estimates.clear()
+        self.estimates[key] = (time.monotonic() + 300, estimate)
+        return estimate
+
+    @staticmethod
+    def run_plan(db_session, plan):
+        """
+        Runs a search plan on a sync session.
+        """
+        try:
+            step = next(plan)
+            while True:
+                if isinstance(step, PlanCall):
+                    step = plan.send(step())
+                else:
+                    step = plan.send(db_session.execute(*step))
+        except StopIteration as stop:
+            return stop.value
+
+    @staticmethod
+    async def arun_plan(db_session, plan):
+        """
+        Runs a search plan on an async session.
+        """
+        try:
+            step = next(plan)
+            while True:
+                if isinstance(step, PlanCall):
+                    step = plan.send(await asyncio.to_thread(step))
+                else:
+                    step = plan.send(await db_session.execute(*step))
+        except StopIteration as stop:
+            return stop.value
+
+    def search(
+        self,
+        query_text: Union[str, None],
+        query_vector: Union[list[float], list],
+        top: int = 5,
+        filters: Union[list[dict], None] = None,
+        load_embedding: bool = False,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+        candidates: Union[int, None] = None,
+        fusion=None,
+        offset: int = 0,
+        facets: bool = False,
+        diversity=None,
+    ):
+        plan = self.search_plan(
+            query_text,
+            query_vector,
+            top,
+            filters,
+            load_embedding,
+            ef_search,
+            probes,
+            candidates,
+            fusion,
+            offset,
+            facets,
+            diversity,
+        )
+        with get_db_session() as db_session:
+            return self.run_plan(db_session, plan)
+
+    async def asearch(
+        self,
+        query_text: Union[str, None],
+        query_vector: Union[list[float], list],
+        top: int = 5,
+        filters: Union[list[dict], None] = None,
+        load_embedding: bool = False,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+        candidates: Union[int, None] = None,
+        fusion=None,
+        offset: int = 0,
+        facets: bool = False,
+        diversity=None,
+    ):
+        """
+        Async counterpart of `search`, running on the async engine.
+        """
+        plan = self.search_plan(
+            query_text,
+            query_vector,
+            top,
+            filters,
+            load_embedding,
+            ef_search,
+            probes,
+            candidates,
+            fusion,
+            offset,
+            facets,
+            diversity,
+        )
+        async with get_async_db_session() as db_session:
+            return await self.arun_plan(db_session, plan)
+
+    def index_settings(
+        self,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+        statement_timeout: Union[int, None] = None,
+    ):
+        """
+        Returns the statements setting the HNSW `ef_search` and IVFFlat
+        `probes` for the current transaction only, trading recall for latency
+        on a per-query basis, and its `statement_timeout` in milliseconds.
+        """
+        settings = {
+            "hnsw.ef_search": ef_search,
+            "ivfflat.probes": probes,
+            "statement_timeout": statement_timeout,
+        }
+        return [
+            (
+                text("SELECT set_config(:name, :value, true)"),
+                {"name": name, "value": str(int(value))},
+            )
+            for name, value in settings.items()
+            if value is not None
+        ]
+
+    def diversity_query(
+        self, ids: list[int], group_field: str, dimensions: Union[int, None] = None
+    ):
+        """
+        Selects the group field and the binary embedding (`vector_send`) of
+        the candidates ids, which decodes much faster than its text form,
+        truncated to its first dimensions if given.
+        """
+        if group_field not in self.db_model.__table__.columns:
+            raise ValueError(f"Unknown diversity group field '{group_field}'")
+        embedding = func.vector_send(
+            getattr(self.db_model, self.db_model.get_embedding_field())
+        )
+        if dimensions:
+            # 4 bytes of header, then 4 bytes per dimension.
+            embedding = func.substring(embedding, 1, 4 + 4 * dimensions)
+        return select(
+            self.db_model.id, getattr(self.db_model, group_field), embedding
+        ).where(self.db_model.id == any_(bindparam("ids", ids, type_=ARRAY(Integer))))
+
+    def diversify(self, diversity, results: list, pool: list, k: int) -> list[int]:
+        """
+        Returns the indices of the ranked rows picked by the diversity
+        re-ranking, from the pool rows of `diversity_query`.
+        """
+        rows = {row[0]: row for row in pool}
+        missing = (None, None, None)
+        group_codes = None
+        if diversity.max_per_group is not None:
+            groups = [str(rows.get(row.id, missing)[1]) for row in results]
+            _, group_codes = np.unique(groups, return_inverse=True)
+        vectors = decode_vectors(
+            [rows.get(row.id, missing)[2] for row in results],
+            diversity.dimensions or embedding_dimensions(self.db_model),
+        )
+        scores = np.array([row.score for row in results], dtype=np.float32)
+        return diversity.rerank(scores, vectors, k, group_codes).tolist()
+
+    def hydrate_query(self, ids: list[int], load_embedding: bool = False):
+        """
+        Selects the rows for the ranked ids with a single `WHERE id = ANY(...)`
+        statement. The embedding column is deferred unless load_embedding is
+        True, as callers rarely need it.
+        """
+        stmt = select(self.db_model).where(
+            self.db_model.id == any_(bindparam("ids", ids, type_=ARRAY(Integer)))
+        )
+        if not load_embedding:
+            stmt = stmt.options(
+                defer(getattr(self.db_model, self.db_model.get_embedding_field()))
+            )
+        return stmt
+
+    def hydrate(self, db_session, ids: list[int], load_embedding: bool = False):
+        """
+        Loads the rows for the ranked ids and returns them in rank order.
+        """
+        if not ids:
+            return []
+        items = db_session.execute(self.hydrate_query(ids, load_embedding)).scalars()
+        return self.order_by_rank(items, ids)
+
+    async def ahydrate(
+        self, db_session, ids: list[int], load_embedding: bool = False
+    ):
+        if not ids:
+            return []
+        items = (
+            await db_session.execute(self.hydrate_query(ids, load_embedding))
+        ).scalars()
+        return self.order_by_rank(items, ids)
+
+    @staticmethod
+    def order_by_rank(items, ids: list[int]):
+        rows = {item.id: item for item in items}
+        return [rows[id] for id in ids if id in rows]
+
     def search_and_embed(
         self,
         query_text: Union[str, None] = None,
@@ -144,10 +1049,25 @@ class PostgresSearcher:
         enable_vector_search: bool = True,
         enable_text_search: bool = True,
         filters: Union[list[dict], None] = None,
+        load_embedding: bool = False,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+        candidates: Union[int, None] = None,
+        fusion=None,
+        offset: int = 0,
+        facets: bool = False,
+        diversity=None,
     ):
         """
         Search items by query text. Optionally converts the query text to a
-        vector if enable_vector_search is True.
+        vector if enable_vector_search is True. ef_search and probes tune the
+        recall of the HNSW and IVFFlat indexes for this query, candidates is
+        the number of rows fetched by each leg and fusion overrides the
+        searcher's fusion method (see services.fusion). offset skips the
+        first ranked rows and facets adds the facet counts of the candidates
+        to the results (see `SearchResults`). diversity re-ranks the results
+        for diversity, eg `MMRDiversity(0.7, max_per_group=2)` (see
+        services.diversity).
         """
         vector: list[float] = []
         if enable_vector_search and query_text is not None:
@@ -158,4 +1078,197 @@ class PostgresSearcher:
         if not enable_text_search:
             query_text = None
 
-        return self.search(query_text, vector, top, filters)
+        return self.search(
+            query_text,
+            vector,
+            top,
+            filters,
+            load_embedding=load_embedding,
+            ef_search=ef_search,
+            probes=probes,
+            candidates=candidates,
+            fusion=fusion,
+            offset=offset,
+            facets=facets,
+            diversity=diversity,
+        )
+
+    async def asearch_and_embed(
+        self,
+        query_text: Union[str, None] = None,
+        top: int = 5,
+        enable_vector_search: bool = True,
+        enable_text_search: bool = True,
+        filters: Union[list[dict], None] = None,
+        load_embedding: bool = False,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+        candidates: Union[int, None] = None,
+        fusion=None,
+        offset: int = 0,
+        facets: bool = False,
+        diversity=None,
+    ):
+        """
+        Async counterpart of `search_and_embed`. Neither the embedding call
+        nor the database round trips block the event loop.
+        """
+        vector: list[float] = []
+        if enable_vector_search and query_text is not None:
+            vector = await embedding_util.agenerate(
+                query_text,
+                self.embed_dimensions,
+            )
+        if not enable_text_search:
+            query_text = None
+
+        return await self.asearch(
+            query_text,
+            vector,
+            top,
+            filters,
+            load_embedding=load_embedding,
+            ef_search=ef_search,
+            probes=probes,
+            candidates=candidates,
+            fusion=fusion,
+            offset=offset,
+            facets=facets,
+            diversity=diversity,
+        )
+
+    def similar_plan(
+        self,
+        product_id: int,
+        top: int = 5,
+        filters: Union[list[dict], None] = None,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+    ):
+        """
+        Search plan ranking the products by the similarity of their embedding
+        to the stored embedding of product_id, which is left out. Returns None
+        when the product doesn't exist or has no embedding.
+        """
+        embedding_field = getattr(self.db_model, self.db_model.get_embedding_field())
+        vector = (
+            yield select(embedding_field).where(self.db_model.id == product_id), {}
+        ).scalar()
+        if vector is None:
+            return None
+        # One more row, in case the product itself is ranked.
+        items = yield from self.search_plan(
+            None, vector.tolist(), top + 1, filters, ef_search=ef_search, probes=probes
+        )
+        return SearchResults(
+            [item for item in items if item.id != product_id][:top], items.facets
+        )
+
+    def similar_to(
+        self,
+        product_id: int,
+        top: int = 5,
+        filters: Union[list[dict], None] = None,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+    ):
+        """
+        Returns the products most similar to product_id ("more like this"),
+        ranked by vector search on its stored embedding, so that no embedding
+        API call is made. Returns None when the product doesn't exist.
+        """
+        plan = self.similar_plan(product_id, top, filters, ef_search, probes)
+        with get_db_session() as db_session:
+            return self.run_plan(db_session, plan)
+
+    async def asimilar_to(
+        self,
+        product_id: int,
+        top: int = 5,
+        filters: Union[list[dict], None] = None,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+    ):
+        """
+        Async counterpart of `similar_to`.
+        """
+        plan = self.similar_plan(product_id, top, filters, ef_search, probes)
+        async with get_async_db_session() as db_session:
+            return await self.arun_plan(db_session, plan)
+
+    def search_many(
+        self,
+        query_texts: list[str],
+        top: int = 5,
+        enable_vector_search: bool = True,
+        enable_text_search: bool = True,
+        filters: Union[list[dict], None] = None,
+        load_embedding: bool = False,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+        candidates: Union[int, None] = None,
+        fusion=None,
+    ):
+        """
+        Runs search_and_embed for many query texts at once: the texts are
+        embedded with one API call and searched with one SQL statement. The
+        filters and options apply to all the queries. Returns a list with the
+        `(item, search_info)` pairs of each query, in the order of the texts.
+        """
+        if not query_texts:
+            return []
+        vectors = None
+        if enable_vector_search:
+            vectors = embedding_util.generate_multiple(
+                query_texts, self.embed_dimensions
+            )
+        plan = self.batch_search_plan(
+            query_texts if enable_text_search else None,
+            vectors,
+            top,
+            filters,
+            load_embedding,
+            ef_search,
+            probes,
+            candidates,
+            fusion,
+        )
+        with get_db_session() as db_session:
+            return self.run_plan(db_session, plan)
+
+    async def asearch_many(
+        self,
+        query_texts: list[str],
+        top: int = 5,
+        enable_vector_search: bool = True,
+        enable_text_search: bool = True,
+        filters: Union[list[dict], None] = None,
+        load_embedding: bool = False,
+        ef_search: Union[int, None] = None,
+        probes: Union[int, None] = None,
+        candidates: Union[int, None] = None,
+        fusion=None,
+    ):
+        """
+        Async counterpart of `search_many`.
+        """
+        if not query_texts:
+            return []
+        vectors = None
+        if enable_vector_search:
+            vectors = await embedding_util.agenerate_multiple(
+                query_texts, self.embed_dimensions
+            )
+        plan = self.batch_search_plan(
+            query_texts if enable_text_search else None,
+            vectors,
+            top,
+            filters,
+            load_embedding,
+            ef_search,
+            probes,
+            candidates,
+            fusion,
+        )
+        async with get_async_db_session() as db_session:
+            return await self.arun_plan(db_session, plan)
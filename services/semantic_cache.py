@@ -0,0 +1,320 @@
+"""
+    This module contains the semantic response cache of the chat service.
+
+    Answers are cached by the embedding of the user query, and a query whose
+    nearest cached neighbor is more similar than a threshold reuses its answer
+    and product ids. Entries expire after a TTL and whenever the catalog
+    version changes (see `CatalogVersionTracker`).
+"""
+
+import asyncio
+import datetime
+import json
+import threading
+import time
+from typing import Union
+
+import numpy as np
+from sqlalchemy import delete, select, text
+
+from config.main import config
+from models.catalog_version import catalog_version_sequence, current_version_sql
+from models.change_feed import CHANGE_FEED_CHANNEL
+from models.database import get_db_session
+from models.semantic_cache import SemanticCacheEntry
+
+
+class CatalogVersionTracker:
+    """
+    Reads the catalog version from its sequence (see models.catalog_version),
+    caching it in process for a few seconds so that a lookup doesn't cost a
+    query.
+    """
+
+    def __init__(self, ttl: float = 10):
+        self.ttl = ttl
+        self.version = 0
+        self.expires_at = 0.0
+
+    def current(self) -> int:
+        if self.expires_at > time.monotonic():
+            return self.version
+        with get_db_session() as session:
+            self.version = session.execute(text(f"SELECT {current_version_sql()}")).scalar()
+        self.expires_at = time.monotonic() + self.ttl
+        return self.version
+
+    def invalidate(self):
+        """
+        Forces the next `current` call to read the version again.
+        """
+        self.expires_at = 0.0
+
+    @staticmethod
+    def bump() -> int:
+        """
+        Advances the catalog version and returns it. The change feed
+        triggers advance it whenever the products change, this forces a bump
+        without changing them, eg after changes made with the triggers
+        disabled. The change feed listeners receive it as a full batch.
+        """
+        with get_db_session() as session:
+            version = session.execute(text(f"SELECT nextval('{catalog_version_sequence.name}')")).scalar()
+            payload = {
+                "op": "BUMP",
+                "version": version,
+                "xid": None,
+                "at": time.time(),
+                "ids": None,
+                "embedding_ids": None,
+            }
+            session.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": CHANGE_FEED_CHANNEL, "payload": json.dumps(payload)},
+            )
+            session.commit()
+        return version
+
+
+class MemorySemanticStore:
+    """
+    In-process store: the normalized query embeddings are kept in a matrix and
+    the nearest neighbor is found with a single matrix-vector product.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def valid(self, catalog_version: int, cutoff: float) -> np.ndarray:
+        return (self.versions == catalog_version) & (self.created_at >= cutoff)
+
+    def nearest(self, embedding: list[float], catalog_version: int, cutoff: float):
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self.lock:
+            if not self.entries:
+                return None, 0.0
+            similarities = np.where(
+                self.valid(catalog_version, cutoff), self.embeddings @ query, -np.inf
+            )
+            best = int(np.argmax(similarities))
+            if not np.isfinite(similarities[best]):
+                return None, 0.0
+            return self.entries[best], float(similarities[best])
+
+    def set(self, embedding: list[float], entry: dict, catalog_version: int, cutoff: float):
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self.lock:
+            keep = np.flatnonzero(self.valid(catalog_version, cutoff))
+            # Make room for the new entry by dropping the oldest ones.
+            keep = keep[max(len(keep) - self.max_size + 1, 0):]
+            self.entries = [self.entries[i] for i in keep] + [entry]
+            self.embeddings = np.vstack(
+                [self.embeddings[keep].reshape(len(keep), len(vector)), vector[None, :]]
+            )
+            self.versions = np.append(self.versions[keep], catalog_version)
+            self.created_at = np.append(self.created_at[keep], entry["created_at"])
+
+    def clear(self):
+        with self.lock:
+            self.entries: list[dict] = []
+            self.embeddings = np.empty((0, 0), dtype=np.float32)
+            self.versions = np.empty(0, dtype=np.int64)
+            self.created_at = np.empty(0, dtype=np.float64)
+
+    def size(self) -> int:
+        return len(self.entries)
+
+
+class PostgresSemanticStore:
+    """
+    Store in the `semantic_cache` table, shared by all the workers. The
+    nearest neighbor is found through its HNSW index.
+    """
+
+    def __init__(self):
+        self.db_model = SemanticCacheEntry
+
+    def nearest(self, embedding: list[float], catalog_version: int, cutoff: float):
+        distance = self.db_model.embedding.cosine_distance(embedding)
+        stmt = (
+            select(self.db_model, (1 - distance).label("similarity"))
+            .where(
+                self.db_model.catalog_version == catalog_version,
+                self.db_model.created_at > datetime.datetime.utcfromtimestamp(cutoff),
+            )
+            .order_by(distance)
+            .limit(1)
+        )
+        with get_db_session() as session:
+            row = session.execute(stmt).first()
+        if row is None:
+            return None, 0.0
+        entry, similarity = row
+        return {
+            "query": entry.query,
+            "response": entry.response,
+            "product_ids": list(entry.product_ids or []),
+            "catalog_version": entry.catalog_version,
+            "created_at": entry.created_at.replace(
+                tzinfo=datetime.timezone.utc
+            ).timestamp(),
+        }, similarity
+
+    def set(self, embedding: list[float], entry: dict, catalog_version: int, cutoff: float):
+        with get_db_session() as session:
+            # Expired and stale entries are purged as new ones come in.
+            session.execute(
+                delete(self.db_model).where(
+                    (self.db_model.catalog_version != catalog_version)
+                    | (
+                        self.db_model.created_at
+                        <= datetime.datetime.utcfromtimestamp(cutoff)
+                    )
+                )
+            )
+            session.add(
+                self.db_model(
+                    query=entry["query"],
+                    embedding=embedding,
+                    response=entry["response"],
+                    product_ids=entry["product_ids"],
+                    catalog_version=catalog_version,
+                    created_at=datetime.datetime.utcfromtimestamp(entry["created_at"]),
+                )
+            )
+            session.commit()
+
+    def clear(self):
+        with get_db_session() as session:
+            session.execute(delete(self.db_model))
+            session.commit()
+
+    def size(self) -> Union[int, None]:
+        return None
+
+
+class SemanticCache:
+    """
+    Caches chat answers by query embedding, see the module docstring.
+    """
+
+    def __init__(
+        self,
+        store,
+        threshold: float = 0.95,
+        ttl: Union[float, None] = 3600,
+        catalog_version: Union[CatalogVersionTracker, None] = None,
+    ):
+        self.store = store
+        self.threshold = threshold
+        self.ttl = ttl
+        self.catalog_version = catalog_version or CatalogVersionTracker()
+        # Entries created before the last change received from the change
+        # feed are ignored, see apply_changes.
+        self.changed_at = 0.0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @classmethod
+    def from_config(cls):
+        """
+        Builds the cache from the SEMANTIC_CACHE_* settings, returns None when
+        the cache is disabled.
+        """
+        if config.SEMANTIC_CACHE_BACKEND == "memory":
+            store = MemorySemanticStore(config.SEMANTIC_CACHE_SIZE)
+        elif config.SEMANTIC_CACHE_BACKEND == "postgres":
+            store = PostgresSemanticStore()
+        else:
+            return None
+        return cls(
+            store,
+            config.SEMANTIC_CACHE_THRESHOLD,
+            config.SEMANTIC_CACHE_TTL,
+            CatalogVersionTracker(config.CATALOG_VERSION_TTL),
+        )
+
+    def cutoff(self) -> float:
+        return max(time.time() - self.ttl if self.ttl else 0.0, self.changed_at)
+
+    def get(self, embedding: list[float]) -> Union[dict, None]:
+        """
+        Returns the cached entry (query, response and product ids) of the
+        nearest query, or None when it isn't similar enough.
+        """
+        entry, similarity = self.store.nearest(
+            embedding, self.catalog_version.current(), self.cutoff()
+        )
+        hit = entry is not None and similarity >= self.threshold
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return dict(entry, similarity=similarity) if hit else None
+
+    def set(
+        self,
+        embedding: list[float],
+        query: str,
+        response: Union[str, None],
+        product_ids: list[int],
+    ):
+        entry = {
+            "query": query,
+            "response": response,
+            "product_ids": list(product_ids),
+            "catalog_version": self.catalog_version.current(),
+            "created_at": time.time(),
+        }
+        self.store.set(embedding, entry, entry["catalog_version"], self.cutoff())
+        with self.lock:
+            self.stores += 1
+
+    async def aget(self, embedding: list[float]) -> Union[dict, None]:
+        return await asyncio.to_thread(self.get, embedding)
+
+    async def aset(
+        self,
+        embedding: list[float],
+        query: str,
+        response: Union[str, None],
+        product_ids: list[int],
+    ):
+        await asyncio.to_thread(self.set, embedding, query, response, product_ids)
+
+    def invalidate(self):
+        """
+        Drops all the entries, eg after the catalog has been changed in place.
+        """
+        self.store.clear()
+        self.catalog_version.invalidate()
+
+    def apply_changes(self, batch):  # pylint: disable=unused-argument
+        """
+        Handles a batch of the catalog change feed. The entries of the
+        previous catalog versions are ignored from the next lookup on,
+        rather than after CATALOG_VERSION_TTL. So are the entries created
+        before the batch was received: a version is taken before its
+        transaction commits, an entry created in between is keyed by the new
+        version but was answered from the previous catalog.
+        """
+        self.changed_at = time.time()
+        self.catalog_version.invalidate()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self.store.size(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
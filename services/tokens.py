@@ -0,0 +1,9 @@
+"""
+    This module contains the token estimate shared by the ingestion batches,
+    the chat tool loop and the serialization of the tool results.
+"""
+
+
+def estimate_tokens(content: str) -> int:
+    # Roughly 4 characters per token for English text with cl100k_base.
+    return len(content) // 4 + 1
@@ -0,0 +1,221 @@
+"""
+    This module contains the ToolExecutor, running the tool calls requested by
+    the LLM in one assistant turn concurrently.
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import zip_longest
+from typing import Callable, Union
+
+from models.database import statement_deadline
+from services.metrics import chat_iterations, chat_tokens, chat_tool_calls, record_stage
+
+logger = logging.getLogger(__name__)
+
+
+class ToolFailure(tuple):
+    """
+    Result of a tool call that failed or timed out: `(message, [])`, the
+    message being sent back to the LLM.
+    """
+
+    def __new__(cls, message: str):
+        return super().__new__(cls, (message, []))
+
+
+class ToolExecutor:
+    """
+    Runs tool calls concurrently, in threads for the sync tools and as tasks
+    for the async ones. A tool returns `(content, products)`: the content is
+    sent back to the LLM and the products of all calls are merged. Failed and
+    timed out calls return a `ToolFailure`.
+    """
+
+    def __init__(
+        self,
+        tools: dict[str, Callable],
+        async_tools: Union[dict[str, Callable], None] = None,
+        max_workers: int = 4,
+    ):
+        self.tools = tools
+        self.async_tools = async_tools or {}
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tool"
+        )
+
+    @staticmethod
+    def failure(message: str):
+        return ToolFailure(message)
+
+    @staticmethod
+    def failures(results: list) -> int:
+        return sum(isinstance(result, ToolFailure) for result in results)
+
+    @staticmethod
+    def deadline(timeout: Union[float, None]) -> Union[float, None]:
+        return time.monotonic() + timeout if timeout is not None else None
+
+    def call(self, tool_call, deadline: Union[float, None] = None):
+        # The database statements of the tool stop at the deadline, see
+        # models.database.statement_deadline.
+        statement_deadline.set(deadline)
+        tool = self.tools.get(tool_call.function.name)
+        if tool is None:
+            return self.failure(f"Unknown tool '{tool_call.function.name}'")
+        try:
+            return tool(**json.loads(tool_call.function.arguments))
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception("Tool %s failed", tool_call.function.name)
+            return self.failure(str(e))
+
+    async def acall(self, tool_call, deadline: Union[float, None] = None):
+        tool = self.async_tools.get(tool_call.function.name)
+        if tool is None:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.pool, contextvars.copy_context().run, self.call, tool_call, deadline
+            )
+        statement_deadline.set(deadline)
+        try:
+            return await tool(**json.loads(tool_call.function.arguments))
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception("Tool %s failed", tool_call.function.name)
+            return self.failure(str(e))
+
+    def execute(self, tool_calls: list, timeout: Union[float, None] = None):
+        """
+        Runs the tool calls in threads and returns their `(content, products)`
+        in the order of tool_calls. Calls still running after timeout seconds
+        are reported as timed out to the LLM. The ones not started yet are
+        cancelled, and the statements of the running ones stop at the same
+        deadline, so that abandoned calls don't hold the workers.
+        """
+        deadline = self.deadline(timeout)
+        # The context is copied so that the tools record their timings in the
+        # current request.
+        futures = [
+            self.pool.submit(contextvars.copy_context().run, self.call, tool_call, deadline)
+            for tool_call in tool_calls
+        ]
+        _, pending = wait(futures, timeout=timeout)
+        for future in pending:
+            future.cancel()
+        return [
+            future.result()
+            if future not in pending
+            else self.failure("The tool call timed out.")
+            for future in futures
+        ]
+
+    async def aexecute(self, tool_calls: list, timeout: Union[float, None] = None):
+        """
+        Async counterpart of `execute`, the timed out calls are cancelled.
+        """
+        deadline = self.deadline(timeout)
+        tasks = [
+            asyncio.ensure_future(self.acall(tool_call, deadline))
+            for tool_call in tool_calls
+        ]
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        return [
+            task.result() if task not in pending else self.failure("The tool call timed out.")
+            for task in tasks
+        ]
+
+    @staticmethod
+    def merge_products(results: list) -> list:
+        """
+        Merges the products of the tool results, interleaving them so that each
+        call is represented at the top, and drops the duplicates.
+        """
+        products, seen = [], set()
+        for product in (
+            product
+            for round_ in zip_longest(*(result[1] for result in results))
+            for product in round_
+            if product is not None
+        ):
+            if product.id not in seen:
+                seen.add(product.id)
+                products.append(product)
+        return products
+
+
+class ToolLoopBudget:
+    """
+    Bounds a tool loop by a number of LLM calls and a wall-clock budget, and
+    records the timings and token usage of each iteration. The loop is
+    degraded once a tool call failed or the final answer was forced, its
+    answer is then not worth caching.
+    """
+
+    def __init__(self, max_iterations: int, time_budget: float):
+        self.max_iterations = max_iterations
+        self.time_budget = time_budget
+        self.started = time.perf_counter()
+        self.iterations: list[dict] = []
+        self.degraded = False
+
+    def remaining(self) -> float:
+        return max(self.time_budget - (time.perf_counter() - self.started), 0)
+
+    def tool_choice(self) -> str:
+        """
+        Returns "auto" while the LLM may still call tools, "none" to request
+        the final answer on the last allowed iteration or once the time budget
+        is spent.
+        """
+        if len(self.iterations) + 1 >= self.max_iterations or not self.remaining():
+            self.degraded = True
+            return "none"
+        return "auto"
+
+    def record(
+        self,
+        llm_time: float,
+        tools_time: float = 0.0,
+        tool_calls: int = 0,
+        usage=None,
+        failed_calls: int = 0,
+    ):
+        """
+        Records an iteration. usage is the token usage reported for its LLM
+        call, if any, and failed_calls the tool calls that failed or timed out.
+        """
+        self.degraded = self.degraded or failed_calls > 0
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        self.iterations.append(
+            {
+                "iteration": len(self.iterations) + 1,
+                "llm_ms": round(llm_time * 1000, 1),
+                "tools_ms": round(tools_time * 1000, 1),
+                "tool_calls": tool_calls,
+                "failed_calls": failed_calls,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+            }
+        )
+        record_stage("llm", llm_time)
+        chat_iterations.inc()
+        chat_tokens.inc(prompt_tokens, kind="prompt")
+        chat_tokens.inc(completion_tokens, kind="completion")
+        if tool_calls:
+            record_stage("tools", tools_time)
+            chat_tool_calls.inc(tool_calls)
+        logger.info("Tool loop iteration: %s", self.iterations[-1])
+
+    def summary(self) -> dict:
+        return {
+            "iterations": self.iterations,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "prompt_tokens": sum(i["prompt_tokens"] for i in self.iterations),
+            "completion_tokens": sum(i["completion_tokens"] for i in self.iterations),
+            "degraded": self.degraded,
+        }
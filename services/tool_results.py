@@ -0,0 +1,181 @@
+"""
+    This module contains the serialization of the search tool results sent
+    back to the LLM.
+
+    The tool result is part of the prompt of every following LLM call of the
+    tool loop, so it is kept compact: a summary of the products found (count,
+    price range, categories, sizes, availability) and one line per product
+    with a few fields and a truncated description, within a token budget.
+    The products themselves are returned to the client separately.
+"""
+
+from collections import Counter
+from typing import Union
+
+from config.main import config
+from services.tokens import estimate_tokens
+
+DEFAULT_FIELDS = ("name", "category", "age_group", "price", "rating", "description")
+
+
+def truncate(value: str, max_chars: int) -> str:
+    """
+    Truncates value to max_chars at a word boundary.
+    """
+    value = " ".join(value.split())
+    if len(value) <= max_chars:
+        return value
+    cut = value[: max_chars - 1].rsplit(" ", 1)[0]
+    return cut.rstrip(",.;:") + "…"
+
+
+def counts(values) -> str:
+    return ", ".join(
+        f"{value} ({count})" for value, count in Counter(values).most_common()
+    )
+
+
+class ToolResultSerializer:
+    """
+    Serializes the products found by a search for the LLM, see the module
+    docstring. With compact=False, the full `content` of each product is
+    sent instead, without a budget.
+    """
+
+    def __init__(
+        self,
+        fields: tuple = DEFAULT_FIELDS,
+        description_chars: int = 160,
+        max_tokens: int = 400,
+        compact: bool = True,
+    ):
+        self.fields = tuple(fields)
+        self.description_chars = description_chars
+        self.max_tokens = max_tokens
+        self.compact = compact
+
+    @classmethod
+    def from_config(cls):
+        """
+        Builds the serializer from the CHAT_TOOL_RESULT_* settings.
+        """
+        return cls(
+            tuple(
+                field.strip()
+                for field in config.CHAT_TOOL_RESULT_FIELDS.split(",")
+                if field.strip()
+            ),
+            config.CHAT_TOOL_RESULT_DESCRIPTION_CHARS,
+            config.CHAT_TOOL_RESULT_MAX_TOKENS,
+            config.CHAT_TOOL_RESULT_FORMAT != "full",
+        )
+
+    def format_field(self, product, field: str) -> Union[str, None]:
+        value = getattr(product, field, None)
+        if value is None or value == "" or value == []:
+            return None
+        if field == "price":
+            return f"{value} {product.currency or ''}".strip()
+        if field == "rating":
+            return f"rating {value}"
+        if field == "description":
+            return truncate(str(value), self.description_chars)
+        if isinstance(value, (list, tuple)):
+            return ", ".join(str(item) for item in value)
+        return str(value)
+
+    def product_line(self, product) -> str:
+        values = (self.format_field(product, field) for field in self.fields)
+        return "- " + " | ".join(value for value in values if value is not None)
+
+    @staticmethod
+    def summary(products: list) -> list[str]:
+        """
+        Returns the lines aggregating the products: their count, price range
+        per currency, categories, age groups, sizes and availability.
+        """
+        lines = [f"Found {len(products)} products."]
+        prices = {}
+        for product in products:
+            if product.price is not None:
+                prices.setdefault(product.currency or "", []).append(product.price)
+        if prices:
+            lines.append(
+                "Price range: "
+                + ", ".join(
+                    f"{min(values)}-{max(values)} {currency}".strip()
+                    for currency, values in prices.items()
+                )
+            )
+        for label, field in (("Categories", "category"), ("Age groups", "age_group")):
+            values = [getattr(product, field) for product in products]
+            if any(values):
+                lines.append(f"{label}: {counts(value for value in values if value)}")
+        sizes = list(
+            dict.fromkeys(size for product in products for size in product.sizes or [])
+        )
+        if sizes:
+            lines.append(f"Sizes: {', '.join(sizes)}")
+        in_stock = sum(1 for product in products if (product.available_stock or 0) > 0)
+        lines.append(f"In stock: {in_stock} of {len(products)}")
+        return lines
+
+    def fits(self, lines: list[str]) -> bool:
+        return estimate_tokens("\n".join(lines)) <= self.max_tokens
+
+    def fit_line(self, lines: list[str], line: str, reserved: list[str]):
+        """
+        Returns line, truncated at a word boundary if needed, so that it fits
+        in the budget after lines and before the reserved lines. Returns None
+        when not even a word of its values fits.
+        """
+        if self.fits(lines + [line] + reserved):
+            return line
+        fitted, low, high = None, 1, len(line) - 1
+        while low <= high:
+            middle = (low + high) // 2
+            cut = truncate(line, middle)
+            if self.fits(lines + [cut] + reserved):
+                fitted, low = cut, middle + 1
+            else:
+                high = middle - 1
+        label = line.split(": ", 1)[0] + ": " if ": " in line else ""
+        return fitted if fitted and len(fitted) > len(label) + 1 else None
+
+    def serialize(self, products: list) -> str:
+        """
+        Returns the tool result of the products, at most max_tokens estimated
+        tokens in compact mode. The summary is trimmed to the budget, then the
+        products are listed while they fit, leaving room for the line that
+        counts the products past the budget.
+        """
+        if not products:
+            return "No products found for the given search query."
+        if not self.compact:
+            return (
+                "Retrieved the following products based on your search query:\n"
+                + "\n".join(product.content for product in products)
+            )
+        # The longest form of the last line, reserved until every product fits.
+        # The first line counts the products already, it goes before it.
+        trailer = [f"({len(products)} more products not listed)"]
+        lines = []
+        for line in self.summary(products):
+            line = self.fit_line(lines, line, trailer if lines else [])
+            if line is not None:
+                lines.append(line)
+        listed = 0
+        if self.fits(lines + ["Products:"] + trailer):
+            lines.append("Products:")
+            for product in products:
+                line = self.product_line(product)
+                last = listed == len(products) - 1
+                if not self.fits(lines + [line] + ([] if last else trailer)):
+                    break
+                lines.append(line)
+                listed += 1
+        if listed < len(products):
+            line = f"({len(products) - listed} more products not listed)"
+            if self.fits(lines + [line]):
+                lines.append(line)
+        return "\n".join(lines)
@@ -0,0 +1,591 @@
+"""
+    This module contains the in-process vector search tier.
+
+    The ids and embeddings of the products are snapshotted into NumPy files
+    (float16 or float32) that every worker memory-maps, so that the operating
+    system shares one copy of the matrix between all the processes. The
+    vector leg of a search can then be ranked in process, exactly or within
+    the nearest lists of an IVF partition, and only the candidate ids and
+    scores are sent to Postgres for the full-text fusion and the hydration.
+
+    Each snapshot is a set of files named after its version. A snapshot is
+    published by atomically replacing the CURRENT file with its version, and
+    the workers check it periodically and swap in the new snapshot. A snapshot
+    is only used while its catalog version is current (see
+    services.semantic_cache.CatalogVersionTracker), or made current by the
+    changes received from the change feed (see services.change_feed).
+"""
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Union
+
+import numpy as np
+from sqlalchemy import ARRAY, Integer, bindparam, select, text
+
+from config.main import config
+from models.catalog_version import current_version_sql
+from models.database import engine, pool_stats
+from models.vector_index import embedding_dimensions
+from services.semantic_cache import CatalogVersionTracker
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_METRICS = ("cosine", "ip", "l2")
+SNAPSHOT_DTYPES = ("float16", "float32")
+POINTER_FILE = "CURRENT"
+# Elements of the matrix converted to float32 at a time during a scan.
+SCAN_BLOCK_ELEMENTS = 1 << 22
+
+
+def snapshot_path(directory: str, version: str, name: str) -> str:
+    extension = "json" if name == "meta" else "npy"
+    return os.path.join(directory, f"{version}.{name}.{extension}")
+
+
+def similarities(vectors: np.ndarray, query: np.ndarray, metric: str, norms=None):
+    """
+    Returns the similarity of each row of vectors to the query, matching the
+    scores of the SQL vector leg (see models.vector_index.VECTOR_METRICS).
+    """
+    dots = vectors.astype(np.float32, copy=False) @ query
+    if metric == "l2":
+        return -np.sqrt(np.maximum(norms - 2 * dots + query @ query, 0.0))
+    return dots
+
+
+def nearest_lists(vectors: np.ndarray, centroids: np.ndarray, metric: str):
+    dots = vectors @ centroids.T
+    if metric == "l2":
+        return np.argmax(2 * dots - np.sum(centroids**2, axis=1), axis=1)
+    return np.argmax(dots, axis=1)
+
+
+def kmeans(sample: np.ndarray, lists: int, metric: str, iterations: int = 10):
+    """
+    Returns the centroids of the IVF lists, trained on a sample of the rows.
+    """
+    rng = np.random.default_rng(0)
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_lists(sample, centroids, metric)
+        counts = np.bincount(labels, minlength=lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        if metric == "cosine":
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+def top_k(ids: np.ndarray, scores: np.ndarray, k: int):
+    if len(scores) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[best], scores[best]
+    order = np.lexsort((ids, -scores))
+    return ids[order], scores[order]
+
+
+def build_snapshot(
+    db_model,
+    directory: str,
+    dtype: str = "float32",
+    lists: int = 0,
+    batch_size: int = 10_000,
+    keep: int = 2,
+) -> str:
+    """
+    Snapshots the ids and embeddings of db_model into directory, partitioned
+    into `lists` IVF lists when lists > 0, publishes it and removes all but
+    the `keep` latest snapshots. Returns the version of the snapshot. The
+    matrix is built in memory, in the snapshot dtype. float16 halves the
+    memory but its rows are converted to float32 at every scan, which makes
+    an exact scan several times slower.
+    """
+    metric = db_model.vector_metric
+    if metric not in SNAPSHOT_METRICS:
+        raise ValueError(f"Vector snapshots don't support the '{metric}' metric")
+    if dtype not in SNAPSHOT_DTYPES:
+        raise ValueError(f"Unknown snapshot dtype '{dtype}', expected one of {SNAPSHOT_DTYPES}")
+    os.makedirs(directory, exist_ok=True)
+    embedding = getattr(db_model, db_model.get_embedding_field())
+    dimensions = embedding_dimensions(db_model)
+
+    ids, blocks = [], []
+    with engine.connect().execution_options(isolation_level="REPEATABLE READ") as connection:
+        # Read first, in the snapshot of the rows: products changed during
+        # the build take a later version, which makes the snapshot stale
+        # rather than silently incomplete. The transactions before xmin are
+        # all in the snapshot.
+        catalog_version, xmin = connection.execute(
+            text(
+                f"SELECT {current_version_sql()}, "
+                "txid_snapshot_xmin(txid_current_snapshot())"
+            )
+        ).one()
+        rows = connection.execution_options(yield_per=batch_size).execute(
+            select(db_model.id, embedding)
+            .where(embedding.is_not(None))
+            .order_by(db_model.id)
+        )
+        for partition in rows.partitions():
+            ids.extend(row[0] for row in partition)
+            block = np.array([row[1] for row in partition], dtype=np.float32)
+            if metric == "cosine":
+                block /= np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+            blocks.append(block.astype(dtype))
+    version = f"{catalog_version}-{int(time.time() * 1000)}"
+    ids = np.array(ids, dtype=np.int64)
+    vectors = np.concatenate(blocks) if blocks else np.empty((0, dimensions), dtype)
+    del blocks
+
+    offsets = None
+    if lists > 0 and len(ids) >= lists:
+        sample = vectors[
+            np.random.default_rng(0).choice(len(ids), min(len(ids), lists * 64), replace=False)
+        ].astype(np.float32)
+        centroids = kmeans(sample, lists, metric)
+        step = max(1, SCAN_BLOCK_ELEMENTS // dimensions)
+        labels = np.concatenate(
+            [
+                nearest_lists(vectors[i : i + step].astype(np.float32), centroids, metric)
+                for i in range(0, len(ids), step)
+            ]
+        )
+        # The rows of each list are stored contiguously, in list order.
+        order = np.argsort(labels, kind="stable")
+        ids, vectors = ids[order], vectors[order]
+        offsets = np.searchsorted(labels[order], np.arange(lists + 1))
+        np.save(snapshot_path(directory, version, "centroids"), centroids)
+        np.save(snapshot_path(directory, version, "offsets"), offsets)
+
+    np.save(snapshot_path(directory, version, "ids"), ids)
+    np.save(snapshot_path(directory, version, "vectors"), vectors)
+    if metric == "l2":
+        norms = np.concatenate(
+            [
+                np.sum(vectors[i : i + batch_size].astype(np.float32) ** 2, axis=1)
+                for i in range(0, len(ids), batch_size)
+            ]
+            or [np.empty(0, np.float32)]
+        )
+        np.save(snapshot_path(directory, version, "norms"), norms)
+    meta = {
+        "version": version,
+        "catalog_version": catalog_version,
+        "xmin": xmin,
+        "table": db_model.__tablename__,
+        "metric": metric,
+        "dimensions": dimensions,
+        "dtype": dtype,
+        "rows": len(ids),
+        "lists": len(offsets) - 1 if offsets is not None else 0,
+        "created_at": datetime.datetime.utcnow().isoformat(),
+    }
+    with open(snapshot_path(directory, version, "meta"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    pointer = os.path.join(directory, POINTER_FILE)
+    with open(f"{pointer}.tmp", "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(f"{pointer}.tmp", pointer)
+    logger.info("Published vector snapshot %s (%d rows)", version, len(ids))
+
+    # Workers still mapping a removed snapshot keep reading it until they
+    # swap, the files only go away with the last mapping.
+    versions = sorted(
+        {name.split(".")[0] for name in os.listdir(directory) if name.endswith(".meta.json")},
+        key=lambda name: int(name.split("-")[1]),
+    )
+    for old_version in versions[:-keep]:
+        for name in os.listdir(directory):
+            if name.startswith(f"{old_version}."):
+                os.remove(os.path.join(directory, name))
+    return version
+
+
+class VectorSnapshot:
+    """
+    A published snapshot, memory-mapped read only.
+    """
+
+    def __init__(self, directory: str, version: str):
+        with open(snapshot_path(directory, version, "meta"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.version = version
+        self.catalog_version = self.meta["catalog_version"]
+        # Snapshots built before the xmin was recorded keep the whole overlay.
+        self.xmin = self.meta.get("xmin", 0)
+        self.metric = self.meta["metric"]
+        self.ids = np.load(snapshot_path(directory, version, "ids"), mmap_mode="r")
+        self.vectors = np.load(snapshot_path(directory, version, "vectors"), mmap_mode="r")
+        self.norms = None
+        if self.metric == "l2":
+            self.norms = np.load(snapshot_path(directory, version, "norms"), mmap_mode="r")
+        self.centroids = self.offsets = None
+        if self.meta["lists"]:
+            self.centroids = np.load(snapshot_path(directory, version, "centroids"))
+            self.offsets = np.load(snapshot_path(directory, version, "offsets"))
+
+    def ranges(self, query: np.ndarray, probes: int) -> list[tuple[int, int]]:
+        """
+        Returns the row ranges to scan: the `probes` nearest IVF lists, or
+        all the rows without IVF.
+        """
+        if self.centroids is None:
+            return [(0, len(self.ids))]
+        scores = similarities(self.centroids, query, self.metric, np.sum(self.centroids**2, axis=1))
+        nearest = np.argsort(-scores)[:probes]
+        return [(int(self.offsets[i]), int(self.offsets[i + 1])) for i in nearest]
+
+    def search(
+        self,
+        query_vector: list[float],
+        k: int,
+        probes: int = 8,
+        overlay: Union["SnapshotOverlay", None] = None,
+    ):
+        """
+        Returns the ids and similarity scores of the k rows most similar to
+        the query vector, best first. The rows of the overlay replace the
+        snapshot rows with the same ids.
+        """
+        query = np.asarray(query_vector, dtype=np.float32)
+        if self.metric == "cosine":
+            query = query / (np.linalg.norm(query) or 1.0)
+        step = max(1, SCAN_BLOCK_ELEMENTS // self.vectors.shape[1])
+        best_ids, best_scores = np.empty(0, np.int64), np.empty(0, np.float32)
+        if overlay:
+            best_ids, best_scores = top_k(
+                overlay.ids, similarities(overlay.vectors, query, self.metric, overlay.norms), k
+            )
+        for start, end in self.ranges(query, probes):
+            for block in range(start, end, step):
+                stop = min(block + step, end)
+                norms = self.norms[block:stop] if self.norms is not None else None
+                ids = self.ids[block:stop]
+                scores = similarities(self.vectors[block:stop], query, self.metric, norms)
+                if overlay:
+                    replaced = np.isin(ids, overlay.replaced)
+                    ids, scores = ids[~replaced], scores[~replaced]
+                best_ids, best_scores = top_k(
+                    np.concatenate([best_ids, ids]),
+                    np.concatenate([best_scores, scores]),
+                    k,
+                )
+        return best_ids, best_scores
+
+
+class SnapshotOverlay:
+    """
+    The embeddings changed since the snapshot was built, as received from
+    the change feed. Their rows replace the snapshot rows with the same ids,
+    and the snapshot rows of deleted products (or removed embeddings) are
+    hidden. An overlay is immutable, updates return a new one.
+    """
+
+    def __init__(self, metric: str, dimensions: int, entries: Union[dict, None] = None):
+        self.metric = metric
+        self.dimensions = dimensions
+        # Product id -> (id of the last transaction that changed it, vector
+        # or None when removed).
+        self.entries = entries or {}
+        self.replaced = np.array(sorted(self.entries), dtype=np.int64)
+        live = [
+            product_id
+            for product_id in self.replaced.tolist()
+            if self.entries[product_id][1] is not None
+        ]
+        self.ids = np.array(live, dtype=np.int64)
+        self.vectors = np.array(
+            [self.entries[product_id][1] for product_id in live], dtype=np.float32
+        ).reshape(len(live), dimensions)
+        self.norms = np.sum(self.vectors**2, axis=1) if metric == "l2" else None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def update(self, xids: dict, vectors: dict) -> "SnapshotOverlay":
+        """
+        Returns the overlay with the vectors (by product id, None when
+        removed) changed by the transactions xids (by product id).
+        """
+        entries = dict(self.entries)
+        for product_id, vector in vectors.items():
+            if vector is not None:
+                vector = np.asarray(vector, dtype=np.float32)
+                if self.metric == "cosine":
+                    vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+            xid = xids[product_id]
+            if product_id in entries:
+                # The notifications don't arrive in transaction id order.
+                xid = max(xid, entries[product_id][0])
+            entries[product_id] = (xid, vector)
+        return SnapshotOverlay(self.metric, self.dimensions, entries)
+
+    def since(self, xmin: int) -> "SnapshotOverlay":
+        """
+        Returns the overlay of a snapshot in which all the transactions
+        before xmin are visible, and so already contains their changes.
+        """
+        return SnapshotOverlay(
+            self.metric,
+            self.dimensions,
+            {
+                product_id: entry
+                for product_id, entry in self.entries.items()
+                if entry[0] >= xmin
+            },
+        )
+
+
+class VectorSnapshotTier:
+    """
+    Serves the vector leg of the searches from the latest published snapshot
+    of db_model. A background thread picks up new snapshots and checks the
+    catalog version every check_interval seconds, so that a search never
+    waits on the file system or the database to decide whether to use it.
+
+    With mode "overload", the tier is only used while the database pools are
+    busy (more than pool_threshold of their connections checked out).
+
+    The embeddings changed since the snapshot was built are applied to an
+    overlay by `apply_changes`, fed by the change feed, which keeps the
+    snapshot current until max_changes products have changed.
+    """
+
+    def __init__(
+        self,
+        db_model,
+        directory: str,
+        mode: str = "on",
+        probes: int = 8,
+        check_interval: float = 30,
+        pool_threshold: float = 0.8,
+        max_changes: int = 10_000,
+    ):
+        if mode not in ("on", "overload"):
+            raise ValueError(f"Unknown vector snapshot mode '{mode}'")
+        self.db_model = db_model
+        self.directory = directory
+        self.mode = mode
+        self.probes = probes
+        self.check_interval = check_interval
+        self.pool_threshold = pool_threshold
+        self.max_changes = max_changes
+        self.catalog_version = CatalogVersionTracker(ttl=0)
+        self.snapshot: Union[VectorSnapshot, None] = None
+        # The snapshot searches use, None while it is missing or stale.
+        self.active: Union[VectorSnapshot, None] = None
+        self.overlay: Union[SnapshotOverlay, None] = None
+        # Highest catalog version of the snapshot and the changes received.
+        self.applied_version: Union[int, None] = None
+        # Set when changes were missed, to the transaction id from which they
+        # are all contained in a new snapshot.
+        self.missed_xid: Union[int, None] = None
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock()
+        self.thread = None
+        self.searches = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def from_config(cls, db_model):
+        """
+        Builds the tier from the VECTOR_SNAPSHOT_* settings, returns None
+        when it is disabled.
+        """
+        if config.VECTOR_SNAPSHOT_MODE == "off":
+            return None
+        return cls(
+            db_model,
+            config.VECTOR_SNAPSHOT_DIR,
+            config.VECTOR_SNAPSHOT_MODE,
+            config.VECTOR_SNAPSHOT_PROBES,
+            config.VECTOR_SNAPSHOT_CHECK_INTERVAL,
+            config.VECTOR_SNAPSHOT_POOL_THRESHOLD,
+            config.VECTOR_SNAPSHOT_MAX_CHANGES,
+        )
+
+    def refresh(self):
+        """
+        Swaps in the published snapshot if it changed, and checks that it
+        and its overlay are at the current catalog version.
+        """
+        with self.update_lock:
+            pointer = os.path.join(self.directory, POINTER_FILE)
+            if not os.path.exists(pointer):
+                self.snapshot = self.active = self.overlay = self.applied_version = None
+                return
+            with open(pointer, "r", encoding="utf-8") as f:
+                version = f.read().strip()
+            snapshot = self.snapshot
+            if snapshot is None or snapshot.version != version:
+                snapshot = VectorSnapshot(self.directory, version)
+                if (
+                    snapshot.meta["table"] != self.db_model.__tablename__
+                    or snapshot.metric != self.db_model.vector_metric
+                    or snapshot.meta["dimensions"] != embedding_dimensions(self.db_model)
+                ):
+                    logger.warning(
+                        "Vector snapshot %s doesn't match the model, ignoring it", version
+                    )
+                    self.snapshot = self.active = None
+                    self.overlay = self.applied_version = None
+                    return
+                logger.info("Using vector snapshot %s (%d rows)", version, len(snapshot.ids))
+                if self.overlay is not None:
+                    # Keep the changes the snapshot may not contain.
+                    self.overlay = self.overlay.since(snapshot.xmin)
+                else:
+                    self.overlay = SnapshotOverlay(
+                        snapshot.metric, snapshot.meta["dimensions"]
+                    )
+                self.applied_version = max(self.applied_version or 0, snapshot.catalog_version)
+                if self.missed_xid is not None and snapshot.xmin >= self.missed_xid:
+                    self.missed_xid = None
+            current = self.is_current()
+            if not current and self.active is not None:
+                logger.info("Vector snapshot %s is stale, searching in Postgres", version)
+            self.snapshot = snapshot
+            # A single assignment, searches read it without the lock.
+            self.active = snapshot if current else None
+
+    def is_current(self) -> bool:
+        """
+        Whether the snapshot and its overlay contain all the changes: none
+        was missed, and the highest catalog version received is the last one
+        taken. A version taken by a transaction still running or rolled back
+        makes the snapshot stale until a later version is received.
+        """
+        return (
+            self.missed_xid is None
+            and self.applied_version >= self.catalog_version.current()
+        )
+
+    def fetch_embeddings(self, ids: list[int]) -> dict:
+        """
+        Returns the current embeddings of the products ids, None for the
+        deleted products and the products without an embedding.
+        """
+        embedding = getattr(self.db_model, self.db_model.get_embedding_field())
+        vectors = dict.fromkeys(ids)
+        with engine.connect() as connection:
+            rows = connection.execute(
+                select(self.db_model.id, embedding).where(
+                    self.db_model.id == bindparam("ids", ids, type_=ARRAY(Integer)).any_(),
+                    embedding.is_not(None),
+                )
+            )
+            vectors.update((row[0], row[1]) for row in rows)
+        return vectors
+
+    def miss_changes(self, missed_xid: int):
+        """
+        Drops the overlay after changes were missed. The snapshot stays stale
+        until one is built with all the transactions before missed_xid.
+        """
+        logger.info(
+            "Vector snapshot %s misses changes, searching in Postgres",
+            self.snapshot.version,
+        )
+        self.missed_xid = max(self.missed_xid or 0, missed_xid)
+        self.overlay = SnapshotOverlay(self.snapshot.metric, self.snapshot.meta["dimensions"])
+
+    def apply_changes(self, batch):
+        """
+        Applies a batch of the change feed (services.change_feed.ChangeBatch)
+        to the overlay. The embeddings are read again rather than taken from
+        the notifications, so the batches can be applied in any order. After
+        a TRUNCATE, a reconnection of the feed or past max_changes, the
+        snapshot stays stale until a new one is built.
+        """
+        with self.update_lock:
+            if self.snapshot is None:
+                return
+            if batch.versions:
+                # The catalog changed, search in Postgres until it is applied.
+                self.active = None
+            xids = {}
+            for event in batch.events:
+                for product_id in event["embedding_ids"] or []:
+                    xids[product_id] = max(xids.get(product_id, 0), event["xid"])
+            if batch.full:
+                with engine.connect() as connection:
+                    # All the transactions missed have an id below the xmax.
+                    self.miss_changes(
+                        connection.execute(
+                            text("SELECT txid_snapshot_xmax(txid_current_snapshot())")
+                        ).scalar()
+                    )
+            elif len(self.overlay) + len(xids) > self.max_changes:
+                # The changes dropped with the overlay, including the
+                # batch's, are all committed: a snapshot whose xmin is past
+                # their transactions contains them.
+                xid = max(
+                    [entry[0] for entry in self.overlay.entries.values()]
+                    + list(xids.values())
+                )
+                self.miss_changes(xid + 1)
+            elif xids:
+                self.overlay = self.overlay.update(xids, self.fetch_embeddings(sorted(xids)))
+            if batch.versions:
+                self.applied_version = max(self.applied_version, batch.versions[-1])
+            current = self.is_current()
+            self.active = self.snapshot if current else None
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Refreshing the vector snapshot failed")
+            time.sleep(self.check_interval)
+
+    def start(self):
+        # Started on first use, ie in the worker process after the fork.
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def overloaded(self) -> bool:
+        for stats in pool_stats().values():
+            capacity = stats["size"] + stats["max_overflow"]
+            if capacity and stats["checked_out"] >= self.pool_threshold * capacity:
+                return True
+        return False
+
+    def search(self, query_vector: list[float], k: int):
+        """
+        Returns the ids and scores of the k nearest rows, or None when the
+        vector leg must be searched in Postgres.
+        """
+        self.start()
+        snapshot, overlay = self.active, self.overlay
+        if snapshot is None or (self.mode == "overload" and not self.overloaded()):
+            return None
+        ids, scores = snapshot.search(query_vector, k, self.probes, overlay)
+        with self.lock:
+            self.searches += 1
+        return ids.tolist(), scores.tolist()
+
+    def record_fallback(self):
+        with self.lock:
+            self.fallbacks += 1
+
+    def stats(self) -> dict:
+        snapshot = self.active
+        with self.lock:
+            return {
+                "rows": len(snapshot.ids) if snapshot is not None else 0,
+                "current": int(snapshot is not None),
+                "changes": len(self.overlay) if self.overlay is not None else 0,
+                "searches": self.searches,
+                "fallbacks": self.fallbacks,
+            }
@@ -0,0 +1,84 @@
+"""
+    This module contains the warmup run when a worker starts: it loads the
+    indexes of the searched table into the shared buffers with pg_prewarm,
+    opens the connections of the pool and runs the configured queries to fill
+    the embedding cache and prepare the search statements.
+"""
+
+import asyncio
+import logging
+
+from sqlalchemy import text
+
+from config.main import config
+from models.database import get_async_db_session
+
+logger = logging.getLogger(__name__)
+
+# Advisory lock held by the worker prewarming, so that the workers started
+# together don't all read the same indexes.
+PREWARM_LOCK_KEY = 0x68796272
+
+
+async def prewarm(db_model):
+    """
+    Loads the indexes (and optionally the table) of db_model into the shared
+    buffers. Returns the number of blocks read, None when skipped.
+    """
+    relations = [index.name for index in db_model.__table__.indexes]
+    if config.WARMUP_PREWARM_TABLE:
+        relations.append(db_model.__tablename__)
+    async with get_async_db_session() as db_session:
+        available = (
+            await db_session.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm'")
+            )
+        ).scalar()
+        if not available:
+            logger.info("pg_prewarm is not installed, skipping the prewarm")
+            return None
+        locked = (
+            await db_session.execute(
+                text("SELECT pg_try_advisory_xact_lock(:key)"),
+                {"key": PREWARM_LOCK_KEY},
+            )
+        ).scalar()
+        if not locked:
+            logger.info("Another worker is prewarming, skipping the prewarm")
+            return None
+        blocks = (
+            await db_session.execute(
+                text(
+                    "SELECT coalesce(sum(pg_prewarm(oid)), 0) FROM pg_class "
+                    "WHERE relname = ANY(:relations)"
+                ),
+                {"relations": relations},
+            )
+        ).scalar()
+        await db_session.commit()
+    logger.info("Prewarmed %d blocks of %s", blocks, ", ".join(relations))
+    return blocks
+
+
+async def open_connections(count: int):
+    async def ping():
+        async with get_async_db_session() as db_session:
+            await db_session.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(ping() for _ in range(count)))
+
+
+async def warmup(searcher):
+    """
+    Warms the database and the caches up for the searcher. Failures are only
+    logged: a worker must start even if the database is briefly unavailable.
+    """
+    try:
+        await prewarm(searcher.db_model)
+        await open_connections(
+            min(config.WARMUP_CONNECTIONS, config.DATABASE_POOL_SIZE)
+        )
+        for query in filter(None, config.WARMUP_QUERIES.split(",")):
+            await searcher.asearch_and_embed(query.strip())
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Warmup failed, continuing without it")
@@ -0,0 +1,4 @@
+"""
+    This folder contains the unit tests of the application. They don't need a
+    database or API keys: python -m pytest
+"""
@@ -0,0 +1,20 @@
+"""
+    Shared test setup. The database engines are created when models.database
+    is imported, which needs a well-formed database URL but never connects.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name, value in {
+    "DATABASE_NAME": "postgres",
+    "DATABASE_USER": "postgres",
+    "DATABASE_PASSWORD": "postgres",
+    "DATABASE_URL": "localhost",
+    "DATABASE_PORT": "5432",
+    "OPENAI_API_KEY": "test",
+    "GROQ_API_KEY": "test",
+}.items():
+    os.environ.setdefault(name, value)
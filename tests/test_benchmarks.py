@@ -0,0 +1,62 @@
+"""
+    Tests of the offline benchmark helpers: the deterministic embedder, the
+    labeled synthetic catalog and the relevance metrics.
+"""
+
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from benchmarks.catalog import generate_catalog, generate_queries, relevance
+from benchmarks.embedding import DeterministicEmbedding
+from benchmarks.run import ideal_gains, ndcg, percentiles
+
+
+def test_deterministic_embedding():
+    embedding = DeterministicEmbedding(dimensions=64)
+    vector = np.array(embedding.generate("Warm wool hoodie"))
+    assert vector.shape == (64,)
+    assert np.linalg.norm(vector) == pytest.approx(1.0, abs=1e-6)
+    # Same tokens, case and punctuation aside, give the same embedding.
+    assert np.allclose(
+        DeterministicEmbedding(dimensions=64).generate("warm, wool HOODIE"), vector
+    )
+    related, unrelated = embedding.generate_multiple(["warm hoodie", "rain boots"])
+    assert vector @ related > vector @ unrelated
+
+
+def test_catalog_and_queries_are_reproducible():
+    assert list(generate_catalog(5, seed=3)) == list(generate_catalog(5, seed=3))
+    assert generate_queries(5, seed=3) == generate_queries(5, seed=3)
+    product, attributes = next(generate_catalog(1))
+    assert product["sku"] == "bench-0"
+    assert attributes["noun"].lower() in product["name"].lower()
+
+
+def test_relevance_grades():
+    query = {"noun": "hoodie", "adjective": "warm"}
+    assert relevance(query, {"noun": "hoodie", "adjective": "warm"}) == 2
+    assert relevance(query, {"noun": "hoodie", "adjective": "cozy"}) == 1
+    assert relevance(query, {"noun": "boots", "adjective": "warm"}) == 0
+
+
+def test_ndcg():
+    assert ndcg([2, 1, 0], [2, 1], k=3) == pytest.approx(1.0)
+    assert ndcg([1, 2, 0], [2, 1], k=3) < 1.0
+    assert ndcg([0, 0, 2], [2, 1], k=2) == 0.0
+    assert ndcg([0, 0], [], k=2) == 0.0
+
+
+def test_ideal_gains():
+    counts = Counter({("hoodie", "warm"): 2, ("hoodie", "cozy"): 5, ("boots", "warm"): 9})
+    query = {"noun": "hoodie", "adjective": "warm"}
+    assert ideal_gains(query, counts, k=4) == [2, 2, 1, 1]
+    assert ideal_gains(query, counts, k=1) == [2]
+
+
+def test_percentiles():
+    stats = percentiles([0.001 * i for i in range(1, 101)])
+    assert stats["p50"] == pytest.approx(50.5)
+    assert stats["p99"] == pytest.approx(99.01)
+    assert stats["mean"] == pytest.approx(50.5)
@@ -0,0 +1,155 @@
+"""
+    Tests of models.change_feed and services.change_feed.ChangeFeedListener.
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from models.change_feed import (
+    CHANGE_FEED_CHUNK_SIZE,
+    change_feed_function,
+    change_feed_triggers,
+)
+from models.product import Product
+from services.change_feed import ChangeBatch, ChangeFeedListener
+
+
+def chunk_events(ids, embedding_ids=(), version=1, at=1000.0, op="UPDATE"):
+    """
+    Returns the notifications published by the triggers for a statement
+    changing ids, one per CHANGE_FEED_CHUNK_SIZE ids.
+    """
+    return [
+        {
+            "op": op,
+            "version": version,
+            "xid": 42,
+            "at": at,
+            "ids": chunk,
+            "embedding_ids": [id for id in chunk if id in embedding_ids],
+        }
+        for start in range(0, len(ids), CHANGE_FEED_CHUNK_SIZE)
+        for chunk in [list(ids[start : start + CHANGE_FEED_CHUNK_SIZE])]
+    ]
+
+
+def test_function_notifies_the_ids_in_chunks():
+    sql = change_feed_function(Product)
+    assert CHANGE_FEED_CHUNK_SIZE == 250
+    assert "(cardinality(changed_ids) - 1) / 250 LOOP" in sql
+    assert "changed_ids[part * 250 + 1 : (part + 1) * 250]" in sql
+    # The version is taken once per statement, not per chunk.
+    assert sql.count("nextval(") == 1
+    # A chunk of 250 ids stays well below the 8000 bytes limit of NOTIFY.
+    ids = range(10**9, 10**9 + CHANGE_FEED_CHUNK_SIZE)
+    assert len(json.dumps(chunk_events(ids, embedding_ids=ids)[0])) < 8000
+
+
+def test_triggers_are_statement_level():
+    statements = change_feed_triggers(Product)
+    creates = [statement for statement in statements if statement.startswith("CREATE")]
+    assert len(creates) == 4
+    assert all("FOR EACH STATEMENT" in statement for statement in creates)
+    assert "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows" in creates[1]
+
+
+def test_chunks_of_a_statement_merge_into_one_batch():
+    events = chunk_events(list(range(1, 601)), embedding_ids=range(2, 601, 2), version=7)
+    assert [len(event["ids"]) for event in events] == [250, 250, 100]
+    batch = ChangeBatch(events)
+    assert not batch.full
+    assert batch.ids == list(range(1, 601))
+    assert batch.embedding_ids == list(range(2, 601, 2))
+    assert batch.versions == [7]
+
+
+def test_batch_merges_statements_and_truncates():
+    first = chunk_events([3, 1], version=5, at=1001.0)
+    second = chunk_events([2, 3], embedding_ids=[2], version=4, at=1000.0)
+    batch = ChangeBatch(first + second)
+    assert batch.ids == [1, 2, 3]
+    assert batch.embedding_ids == [2]
+    assert batch.versions == [4, 5]
+    assert batch.oldest_at == 1000.0
+    truncate = {**chunk_events([1], op="TRUNCATE")[0], "ids": None, "embedding_ids": None}
+    assert ChangeBatch(first + [truncate]).full
+    assert ChangeBatch([], full=True).oldest_at is None
+
+
+def collect(listener, payloads, late=()):
+    """
+    Runs listener.collect on a queue receiving payloads at once and late
+    after 0.2s.
+    """
+
+    async def run():
+        queue = asyncio.Queue()
+        for payload in payloads:
+            queue.put_nowait(payload)
+
+        async def send_late():
+            await asyncio.sleep(0.2)
+            for payload in late:
+                queue.put_nowait(payload)
+
+        sender = asyncio.create_task(send_late())
+        try:
+            return await listener.collect(queue), queue.qsize()
+        finally:
+            await sender
+
+    return asyncio.run(run())
+
+
+def test_collect_waits_for_the_debounce_window():
+    payloads = [json.dumps(event) for event in chunk_events(list(range(1, 601)))]
+    late = [json.dumps(chunk_events([700], version=2)[0])]
+    events, left = collect(ChangeFeedListener([], debounce=0.05), payloads, late)
+    assert [len(event["ids"]) for event in events] == [250, 250, 100]
+    assert left == 0
+    events, _ = collect(ChangeFeedListener([], debounce=0.5), payloads, late)
+    assert [event["version"] for event in events] == [1, 1, 1, 2]
+
+
+def test_collect_is_bounded_by_max_events_and_max_delay():
+    payloads = [json.dumps(event) for event in chunk_events(list(range(1, 601)))]
+    events, left = collect(ChangeFeedListener([], max_events=2), payloads)
+    assert len(events) == 2
+    assert left == 1
+    late = [json.dumps(chunk_events([700], version=2)[0])]
+    events, _ = collect(ChangeFeedListener([], debounce=1, max_delay=0.1), payloads, late)
+    assert len(events) == 3
+
+
+def test_collect_raises_the_connection_errors():
+    payloads = [json.dumps(chunk_events([1])[0]), ConnectionError("closed")]
+    with pytest.raises(ConnectionError):
+        collect(ChangeFeedListener([], debounce=0.05), payloads)
+
+
+def test_a_failing_handler_doesnt_stop_the_others(monkeypatch):
+    handled = []
+
+    def failing(batch):
+        raise RuntimeError("handler failed")
+
+    listener = ChangeFeedListener([failing, handled.append])
+    batch = ChangeBatch(chunk_events([1, 2], version=9, at=1000.0))
+    monkeypatch.setattr("services.change_feed.time.time", lambda: 1002.5)
+    asyncio.run(listener.dispatch(batch))
+    assert handled == [batch]
+    assert listener.stats() == {
+        "connected": 0,
+        "events": 1,
+        "batches": 1,
+        "reconnects": 0,
+        "lag_seconds": 2.5,
+        "version": 9,
+    }
+    # The batch of a reconnection keeps the lag and version.
+    asyncio.run(listener.dispatch(ChangeBatch([], full=True)))
+    assert handled[-1].full
+    assert listener.stats()["lag_seconds"] == 2.5
+    assert listener.stats()["version"] == 9
@@ -0,0 +1,140 @@
+"""
+    Tests of the streamed chat answers, against a scripted LLM stream.
+"""
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+from services.chat import ChatService
+from services.tool_executor import ToolExecutor, ToolLoopBudget
+
+
+def chunk(content=None, tool_call=None):
+    tool_calls = None
+    if tool_call is not None:
+        name, arguments = tool_call
+        tool_calls = [
+            SimpleNamespace(
+                index=0,
+                id="call-1",
+                function=SimpleNamespace(name=name, arguments=json.dumps(arguments)),
+            )
+        ]
+    delta = SimpleNamespace(content=content, tool_calls=tool_calls)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+
+class ScriptedCompletions:
+    """
+    Returns one scripted stream of chunks per call and records the
+    tool_choice of each call.
+    """
+
+    def __init__(self, turns):
+        self.turns = list(turns)
+        self.tool_choices = []
+
+    async def create(self, tool_choice, **kwargs):
+        self.tool_choices.append(tool_choice)
+
+        async def stream(chunks):
+            for item in chunks:
+                yield item
+
+        return stream(self.turns.pop(0))
+
+
+def chat_service(turns, max_iterations=3):
+    product = SimpleNamespace(id=1)
+
+    async def search_products(search_query):
+        return f"Found {search_query}", [product]
+
+    service = ChatService.__new__(ChatService)
+    completions = ScriptedCompletions(turns)
+    service.async_client = SimpleNamespace(
+        chat=SimpleNamespace(completions=completions)
+    )
+    service.model = "test-model"
+    service.semantic_cache = None
+    service.tool_executor = ToolExecutor({}, {"search_products": search_products})
+    service.tool_loop_budget = lambda: ToolLoopBudget(max_iterations, 20)
+    return service, completions
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+def test_stream_skips_the_content_of_tool_call_turns():
+    service, completions = chat_service(
+        [
+            [
+                chunk("Let me search"),
+                chunk(" for that."),
+                chunk(tool_call=("search_products", {"search_query": "hats"})),
+            ],
+            [chunk("I found"), chunk(" 1 hat.")],
+        ]
+    )
+    events = asyncio.run(collect(service.astream_response("hats")))
+    assert completions.tool_choices == ["auto", "auto"]
+    assert [event for event, _ in events] == ["products", "token", "token", "done"]
+    assert [data for event, data in events if event == "token"] == ["I found", " 1 hat."]
+    assert events[-1] == ("done", "I found 1 hat.")
+
+
+def test_stream_of_the_forced_final_answer():
+    service, completions = chat_service(
+        [
+            [chunk(tool_call=("search_products", {"search_query": "hats"}))],
+            [chunk("Here"), chunk(" they are.")],
+        ],
+        max_iterations=2,
+    )
+    events = asyncio.run(collect(service.astream_response("hats")))
+    assert completions.tool_choices == ["auto", "none"]
+    assert [data for event, data in events if event == "token"] == ["Here", " they are."]
+    assert events[-1] == ("done", "Here they are.")
+
+
+class RecordingCache:
+    def __init__(self):
+        self.stored = []
+
+    async def aset(self, embedding, query, response, product_ids):
+        self.stored.append((query, response, product_ids))
+
+
+async def cache_miss(user_query):
+    return [1.0, 0.0], None
+
+
+def test_answers_are_cached():
+    service, _ = chat_service(
+        [
+            [chunk(tool_call=("search_products", {"search_query": "hats"}))],
+            [chunk("1 hat.")],
+        ]
+    )
+    service.semantic_cache = RecordingCache()
+    service.acached_response = cache_miss
+    asyncio.run(collect(service.astream_response("hats")))
+    assert service.semantic_cache.stored == [("hats", "1 hat.", [1])]
+
+
+def test_degraded_answers_are_not_cached():
+    # The final answer is forced by the iteration limit.
+    service, _ = chat_service(
+        [
+            [chunk(tool_call=("search_products", {"search_query": "hats"}))],
+            [chunk("1 hat.")],
+        ],
+        max_iterations=2,
+    )
+    service.semantic_cache = RecordingCache()
+    service.acached_response = cache_miss
+    events = asyncio.run(collect(service.astream_response("hats")))
+    assert events[-1] == ("done", "1 hat.")
+    assert service.semantic_cache.stored == []
@@ -0,0 +1,55 @@
+"""
+    Tests of the connection pools of models.database, which are created
+    without connecting.
+"""
+
+import pytest
+
+from config.main import config
+from models import database
+from models.product import Product
+from services.postgres_searcher import PostgresSearcher
+
+
+@pytest.mark.parametrize("engine", [database.engine, database.async_engine.sync_engine])
+def test_pools_follow_the_settings(engine):
+    assert engine.url.drivername == "postgresql+psycopg"
+    assert engine.pool.size() == config.DATABASE_POOL_SIZE
+    assert engine.pool.timeout() == config.DATABASE_POOL_TIMEOUT
+    assert engine.pool._max_overflow == config.DATABASE_MAX_OVERFLOW
+    assert engine.pool._recycle == config.DATABASE_POOL_RECYCLE
+    assert engine.pool._pre_ping
+
+
+def test_both_engines_share_the_url():
+    assert database.engine.url == database.async_engine.url
+
+
+def test_prepare_threshold_is_passed_to_psycopg():
+    connect_args = database.engine_options["connect_args"]
+    assert connect_args == {"prepare_threshold": config.DATABASE_PREPARE_THRESHOLD}
+
+
+def test_pool_stats():
+    stats = database.pool_stats()
+    assert set(stats) == {"database", "async_database"}
+    for pool in stats.values():
+        assert pool == {
+            "size": config.DATABASE_POOL_SIZE,
+            "checked_out": 0,
+            "checked_in": 0,
+            "overflow": -config.DATABASE_POOL_SIZE,
+            "max_overflow": config.DATABASE_MAX_OVERFLOW,
+            "timeout": config.DATABASE_POOL_TIMEOUT,
+        }
+
+
+def test_index_settings_are_transaction_local():
+    # Nothing outlives the transaction, eg behind PgBouncer in transaction mode.
+    settings = PostgresSearcher(Product).index_settings(ef_search=80, probes=None)
+    assert [(str(sql), params) for sql, params in settings] == [
+        (
+            "SELECT set_config(:name, :value, true)",
+            {"name": "hnsw.ef_search", "value": "80"},
+        )
+    ]
@@ -0,0 +1,78 @@
+"""
+    Tests of the MMR re-ranking of services.diversity.
+"""
+
+import numpy as np
+import pytest
+
+from services.diversity import MMRDiversity, decode_vectors
+
+
+def encode_vector(vector: list[float]) -> bytes:
+    # The binary form of pgvector vectors, see benchmarks/diversity.py.
+    header = np.array([len(vector), 0], dtype=">i2").tobytes()
+    return header + np.array(vector, dtype=">f4").tobytes()
+
+
+# Candidates 0 and 1 are near duplicates, 2 and 3 point elsewhere.
+VECTORS = np.array(
+    [[1.0, 0.0, 0.0], [0.99, 0.1, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]],
+    dtype=np.float32,
+)
+SCORES = np.array([1.0, 0.9, 0.8, 0.5], dtype=np.float32)
+
+
+def test_decode_vectors():
+    values = [encode_vector([1.5, -2.0, 0.25]), None]
+    decoded = decode_vectors(values, 3)
+    assert decoded.dtype == np.float32
+    assert decoded.tolist() == [[1.5, -2.0, 0.25], [0.0, 0.0, 0.0]]
+    assert decode_vectors([], 3).shape == (0, 3)
+
+
+@pytest.mark.parametrize("mmr_lambda", [-0.1, 1.5])
+def test_invalid_lambda(mmr_lambda):
+    with pytest.raises(ValueError, match="mmr_lambda"):
+        MMRDiversity(mmr_lambda)
+
+
+def test_lambda_one_keeps_the_fused_order():
+    picked = MMRDiversity(1.0).rerank(SCORES, VECTORS, 4)
+    assert picked.tolist() == [0, 1, 2, 3]
+
+
+def test_lower_lambda_skips_near_duplicates():
+    picked = MMRDiversity(0.5).rerank(SCORES, VECTORS, 3)
+    assert picked.tolist() == [0, 2, 3]
+
+
+def test_equal_scores_keep_the_best_rank_first():
+    scores = np.full(4, 0.3, dtype=np.float32)
+    assert MMRDiversity(1.0).rerank(scores, VECTORS, 4).tolist() == [0, 1, 2, 3]
+
+
+def test_group_caps():
+    groups = np.array([0, 0, 0, 1])
+    diversity = MMRDiversity(1.0, max_per_group=2)
+    assert diversity.rerank(SCORES, VECTORS, 4, groups).tolist() == [0, 1, 3]
+    # Without group codes the cap doesn't apply.
+    assert diversity.rerank(SCORES, VECTORS, 4).tolist() == [0, 1, 2, 3]
+
+
+def test_k_larger_than_the_pool():
+    assert MMRDiversity(0.7).rerank(SCORES[:2], VECTORS[:2], 10).tolist() == [0, 1]
+    empty = MMRDiversity(0.7, max_per_group=1).rerank(
+        np.array([], dtype=np.float32),
+        np.zeros((0, 3), dtype=np.float32),
+        5,
+        np.array([], dtype=np.int64),
+    )
+    assert empty.tolist() == []
+
+
+def test_missing_vectors():
+    vectors = VECTORS.copy()
+    vectors[1] = 0
+    picked = MMRDiversity(0.5).rerank(SCORES, vectors, 4)
+    assert sorted(picked.tolist()) == [0, 1, 2, 3]
+    assert picked[0] == 0
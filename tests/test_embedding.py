@@ -0,0 +1,46 @@
+"""
+    Tests of the creation of the query-embedding cache of services.embedding.
+"""
+
+import os
+import subprocess
+import sys
+
+from services.embedding import Embedding
+from services.embedding_cache import EmbeddingCache
+
+
+def test_cache_is_created_on_first_use():
+    created = []
+
+    def factory():
+        created.append(EmbeddingCache(ttl=None))
+        return created[-1]
+
+    embedding = Embedding(cache_factory=factory)
+    assert created == []
+    assert embedding.stats()["size"] == 0
+    assert embedding.cache is created[0]
+    assert len(created) == 1
+
+
+def test_without_cache():
+    assert Embedding().cache is None
+    assert Embedding().stats() == {}
+    cache = EmbeddingCache()
+    assert Embedding(cache).cache is cache
+
+
+def test_importing_the_searcher_opens_no_store(tmp_path):
+    path = tmp_path / "embedding_cache.sqlite3"
+    env = dict(
+        os.environ, EMBEDDING_CACHE_BACKEND="sqlite", EMBEDDING_CACHE_PATH=str(path)
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run(
+        [sys.executable, "-c", "import services.postgres_searcher"],
+        cwd=root,
+        env=env,
+        check=True,
+    )
+    assert not path.exists()
@@ -0,0 +1,138 @@
+"""
+    Tests of services.embedding_cache.EmbeddingCache.
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from services import embedding_cache
+from services.embedding_cache import EmbeddingCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(embedding_cache.time, "monotonic", clock)
+    return clock
+
+
+def test_make_key_normalizes_text():
+    key = EmbeddingCache.make_key("Red  Summer\tDress ", "model", 256)
+    assert key == EmbeddingCache.make_key("red summer dress", "model", 256)
+    assert key != EmbeddingCache.make_key("red summer dress", "model", 512)
+    assert key != EmbeddingCache.make_key("red summer dress", "other", 256)
+    assert key != EmbeddingCache.make_key("red dress", "model", 256)
+
+
+def test_lru_eviction():
+    cache = EmbeddingCache(max_size=2, ttl=None)
+    cache.set("a", [1.0])
+    cache.set("b", [2.0])
+    # Reading a makes b the least recently used entry.
+    assert cache.get("a") == [1.0]
+    cache.set("c", [3.0])
+    assert cache.get("b") is None
+    assert cache.get("a") == [1.0]
+    assert cache.get("c") == [3.0]
+    assert cache.stats()["size"] == 2
+
+
+def test_ttl_expiry(clock):
+    cache = EmbeddingCache(max_size=4, ttl=60)
+    cache.set("a", [1.0])
+    clock.now += 59
+    assert cache.get("a") == [1.0]
+    clock.now += 2
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_get_many_counts_misses():
+    cache = EmbeddingCache(ttl=None)
+    cache.set("a", [1.0])
+    assert cache.get_many(["a", "b"]) == [[1.0], None]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_get_or_compute_coalesces_threads():
+    cache = EmbeddingCache(ttl=None)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return [1.0]
+
+    results = []
+    def run():
+        results.append(cache.get_or_compute("k", compute))
+
+    owner = threading.Thread(target=run)
+    owner.start()
+    started.wait(5)
+    waiter = threading.Thread(target=run)
+    waiter.start()
+    while cache.stats()["coalesced"] == 0:
+        time.sleep(0.001)
+    release.set()
+    owner.join()
+    waiter.join()
+    assert results == [[1.0], [1.0]]
+    assert len(calls) == 1
+
+
+def test_aget_or_compute_coalesces():
+    cache = EmbeddingCache(ttl=None)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return [1.0]
+
+    async def main():
+        return await asyncio.gather(
+            *(cache.aget_or_compute("k", compute) for _ in range(3))
+        )
+
+    assert asyncio.run(main()) == [[1.0]] * 3
+    assert len(calls) == 1
+    assert cache.stats()["coalesced"] == 2
+
+
+def test_aget_or_compute_waiter_retries_after_owner_cancellation():
+    cache = EmbeddingCache(ttl=None)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05 if len(calls) == 1 else 0)
+        return [float(len(calls))]
+
+    async def main():
+        owner = asyncio.create_task(cache.aget_or_compute("k", compute))
+        while not calls:
+            await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.aget_or_compute("k", compute))
+        await asyncio.sleep(0)
+        owner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        return await waiter
+
+    assert asyncio.run(main()) == [2.0]
+    assert len(calls) == 2
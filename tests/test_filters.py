@@ -0,0 +1,178 @@
+"""
+    Tests of services.filters.FilterCompiler.
+"""
+
+import pytest
+
+from models.product import Product
+from services.filters import FilterCompiler
+
+
+@pytest.fixture
+def compiler():
+    return FilterCompiler(Product)
+
+
+def test_no_filters(compiler):
+    assert compiler.compile(None) == ("", {})
+    assert compiler.compile([]) == ("", {})
+
+
+def test_scalar_operators_bind_parameters(compiler):
+    clause, params = compiler.compile(
+        [
+            {"column": "category", "comparison_operator": "=", "value": "Summer Wear"},
+            {"column": "price", "comparison_operator": " <= ", "value": 30},
+        ]
+    )
+    assert clause == "category = :filter_0 AND price <= :filter_1"
+    assert params == {"filter_0": "Summer Wear", "filter_1": 30}
+
+
+def test_list_values(compiler):
+    clause, params = compiler.compile(
+        [
+            {"column": "category", "comparison_operator": "IN", "value": ["a", "b"]},
+            {"column": "rating", "comparison_operator": "!=", "value": (1, 2)},
+        ]
+    )
+    assert clause == (
+        "category = ANY(CAST(:filter_0 AS VARCHAR[])) "
+        "AND rating <> ALL(CAST(:filter_1 AS INTEGER[]))"
+    )
+    assert params == {"filter_0": ["a", "b"], "filter_1": [1, 2]}
+
+
+def test_array_operators(compiler):
+    clause, params = compiler.compile(
+        [{"column": "sizes", "comparison_operator": "&&", "value": ["S", "M"]}]
+    )
+    assert clause == "sizes && CAST(:filter_0 AS VARCHAR[])"
+    assert params == {"filter_0": ["S", "M"]}
+
+
+def test_same_shape_shares_sql(compiler):
+    first = compiler.compile([{"column": "price", "comparison_operator": ">", "value": 1}])
+    second = compiler.compile([{"column": "price", "comparison_operator": ">", "value": 9}])
+    assert first[0] == second[0]
+    assert first[1] != second[1]
+
+
+def test_param_prefix():
+    clause, params = FilterCompiler(Product, "f").compile(
+        [{"column": "price", "comparison_operator": ">", "value": 1}]
+    )
+    assert clause == "price > :f_0"
+    assert params == {"f_0": 1}
+
+
+def test_inline_literals(compiler):
+    filters = [{"column": "category", "comparison_operator": "=", "value": "Kid's"}]
+    assert compiler.compile(filters, inline={"category": {"Kid's"}}) == (
+        "category = 'Kid''s'",
+        {},
+    )
+    # Values not listed, or other operators, stay parameters.
+    assert compiler.compile(filters, inline={"category": {"Other"}})[1] == {
+        "filter_0": "Kid's"
+    }
+    assert compiler.compile(
+        [{"column": "category", "comparison_operator": "!=", "value": "Kid's"}],
+        inline={"category": {"Kid's"}},
+    )[1] == {"filter_0": "Kid's"}
+
+
+def test_filters_are_not_modified(compiler):
+    filters = [{"column": "category", "comparison_operator": " IN ", "value": ("a",)}]
+    compiler.compile(filters)
+    assert filters == [{"column": "category", "comparison_operator": " IN ", "value": ("a",)}]
+
+
+def test_between_on_range_text(compiler):
+    clause, params = compiler.compile(
+        [{"column": "age_group", "comparison_operator": "between", "value": [3, 6]}]
+    )
+    assert clause.startswith("(CASE WHEN age_group ~ ")
+    assert "least(" in clause and "greatest(" in clause
+    assert "int4range(CAST(:filter_0_low AS INTEGER), CAST(:filter_0_high AS INTEGER)" in clause
+    assert params == {"filter_0_low": 3, "filter_0_high": 6}
+
+
+def test_between_on_numbers(compiler):
+    assert compiler.compile(
+        [{"column": "price", "comparison_operator": "between", "value": [2.5, 10]}]
+    ) == (
+        "(price >= :filter_0_low AND price <= :filter_0_high)",
+        {"filter_0_low": 2.5, "filter_0_high": 10},
+    )
+    assert compiler.compile(
+        [{"column": "price", "comparison_operator": "between", "value": [None, 10]}]
+    ) == ("(price <= :filter_0_high)", {"filter_0_high": 10})
+
+
+@pytest.mark.parametrize(
+    "filter, message",
+    [
+        ({"column": "nope", "comparison_operator": "=", "value": 1}, "Unknown filter column"),
+        ({"column": "price", "comparison_operator": "like", "value": 1}, "Unsupported"),
+        ({"column": "price", "comparison_operator": "<", "value": [1, 2]}, "list value"),
+        ({"column": "sizes", "comparison_operator": "=", "value": "S"}, "Unsupported"),
+        ({"column": "sizes", "comparison_operator": "in", "value": ["S"]}, "list value"),
+        ({"column": "category", "comparison_operator": "&&", "value": ["a"]}, "array column"),
+        ({"column": "sizes", "comparison_operator": "@>", "value": "S"}, "array column"),
+        ({"comparison_operator": "=", "value": 1}, "requires 'column'"),
+        ({"column": "price", "value": 1}, "requires 'column'"),
+        ({"column": "price", "comparison_operator": 1, "value": 1}, "requires 'column'"),
+        ({"column": "price", "comparison_operator": "="}, "requires a 'value'"),
+        ("price = 1", "requires 'column'"),
+        ({"column": "price", "comparison_operator": "between", "value": 3}, "[low, high]"),
+        ({"column": "price", "comparison_operator": "between", "value": [1]}, "[low, high]"),
+        ({"column": "price", "comparison_operator": "between", "value": [None, None]}, "one bound"),
+        ({"column": "price", "comparison_operator": "between", "value": [5, 1]}, "low <= high"),
+        ({"column": "price", "comparison_operator": "between", "value": ["1", 5]}, "numeric"),
+        ({"column": "price", "comparison_operator": "between", "value": [True, 5]}, "numeric"),
+        ({"column": "age_group", "comparison_operator": "between", "value": [6, 3]}, "low <= high"),
+        ({"column": "age_group", "comparison_operator": "between", "value": [2.5, 4]}, "integer"),
+        ({"column": "category", "comparison_operator": "=", "value": 3}, "type of column"),
+        ({"column": "price", "comparison_operator": "<", "value": "30"}, "type of column"),
+        ({"column": "price", "comparison_operator": "=", "value": True}, "type of column"),
+        ({"column": "category", "comparison_operator": "=", "value": {"a": 1}}, "type of column"),
+        ({"column": "category", "comparison_operator": "in", "value": ["a", 1]}, "type of column"),
+        ({"column": "category", "comparison_operator": "in", "value": ["a", None]}, "type of column"),
+        ({"column": "sizes", "comparison_operator": "&&", "value": [1]}, "type of column"),
+        ({"column": "embedding", "comparison_operator": "=", "value": "x"}, "type of column"),
+        ({"column": "price", "comparison_operator": "<", "value": None}, "null value"),
+    ],
+)
+def test_rejected_filters(compiler, filter, message):
+    with pytest.raises(ValueError, match=message.replace("[", r"\[")):
+        compiler.compile([filter])
+
+
+def test_numbers_compared_to_integer_columns(compiler):
+    assert compiler.compile(
+        [{"column": "price", "comparison_operator": "<", "value": 29.99}]
+    ) == ("price < :filter_0", {"filter_0": 29.99})
+
+
+def test_dates_as_iso_strings(compiler):
+    assert compiler.compile(
+        [{"column": "created_at", "comparison_operator": ">=", "value": "2024-01-01"}]
+    ) == ("created_at >= :filter_0", {"filter_0": "2024-01-01"})
+
+
+def test_null_values(compiler):
+    assert compiler.compile(
+        [
+            {"column": "age_group", "comparison_operator": "=", "value": None},
+            {"column": "rating", "comparison_operator": "!=", "value": None},
+        ]
+    ) == ("age_group IS NULL AND rating IS NOT NULL", {})
+
+
+def test_unhashable_values_with_inline_literals(compiler):
+    with pytest.raises(ValueError, match="type of column"):
+        compiler.compile(
+            [{"column": "category", "comparison_operator": "=", "value": {"a": 1}}],
+            inline={"category": {"Kid's"}},
+        )
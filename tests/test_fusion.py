@@ -0,0 +1,70 @@
+"""
+    Tests of the fusion methods of services.fusion.
+"""
+
+import pytest
+
+from config.main import config
+from services.fusion import RRFFusion, ScoreFusion, fusion_from_config
+
+
+def test_rrf_params():
+    fusion = RRFFusion(k=10, vector_weight=2.0, text_weight=0.5)
+    assert fusion.params() == {
+        "fusion_k": 10,
+        "fusion_vector_weight": 2.0,
+        "fusion_text_weight": 0.5,
+    }
+
+
+def test_rrf_sql_sums_both_legs():
+    sql = RRFFusion().score_sql()
+    assert "COALESCE(1.0 / (:fusion_k + vector_search.rank), 0.0)" in sql
+    assert "COALESCE(1.0 / (:fusion_k + fulltext_search.rank), 0.0)" in sql
+    assert "CAST(:fusion_vector_weight AS FLOAT)" in sql
+    assert "CAST(:fusion_text_weight AS FLOAT)" in sql
+
+
+def test_weights_never_change_the_sql():
+    assert RRFFusion(60, 1.0, 1.0).score_sql() == RRFFusion(5, 3.0, 0.1).score_sql()
+    assert (
+        ScoreFusion("zscore", 0.5, 0.5).score_sql()
+        == ScoreFusion("zscore", 0.9, 0.1).score_sql()
+    )
+
+
+def test_score_fusion_params():
+    assert ScoreFusion("minmax", 0.7, 0.3).params() == {
+        "fusion_vector_weight": 0.7,
+        "fusion_text_weight": 0.3,
+    }
+
+
+@pytest.mark.parametrize(
+    "normalization, aggregates",
+    [("minmax", ("MIN(", "MAX(")), ("zscore", ("AVG(", "STDDEV_POP("))],
+)
+def test_score_fusion_normalization(normalization, aggregates):
+    sql = ScoreFusion(normalization).score_sql()
+    for aggregate in aggregates:
+        assert f"{aggregate}vector_search.score) OVER ()" in sql
+        assert f"{aggregate}fulltext_search.score) OVER ()" in sql
+    # Rows missing from a leg get its lowest score.
+    assert "COALESCE(vector_search.score, MIN(vector_search.score) OVER ())" in sql
+
+
+def test_score_fusion_rejects_unknown_normalization():
+    with pytest.raises(ValueError, match="Unknown score normalization"):
+        ScoreFusion("softmax")
+
+
+def test_fusion_from_config():
+    rrf = fusion_from_config("rrf")
+    assert isinstance(rrf, RRFFusion)
+    assert rrf.params()["fusion_k"] == config.RRF_K
+    assert rrf.params()["fusion_vector_weight"] == config.FUSION_VECTOR_WEIGHT
+    zscore = fusion_from_config("zscore")
+    assert isinstance(zscore, ScoreFusion) and zscore.normalization == "zscore"
+    assert isinstance(fusion_from_config(), (RRFFusion, ScoreFusion))
+    with pytest.raises(ValueError, match="Unknown fusion method"):
+        fusion_from_config("borda")
@@ -0,0 +1,233 @@
+"""
+    Tests of services.ingestion. The database reads and writes of the
+    pipeline are replaced by stubs.
+"""
+
+import io
+import json
+import time
+
+import httpx
+import openai
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from models.product import Product
+from services.ingestion import (
+    IngestionPipeline,
+    chunked,
+    iter_json_array,
+    token_budget_batches,
+)
+
+PRODUCTS = [
+    {"sku": "A-1", "name": "Summer Dress", "sizes": ["S", "M"]},
+    {"sku": "B-2", "name": "Rain [Coat], \"Kids\"", "price": 25.5},
+    {"sku": "C-3", "name": "Hat", "nested": {"tags": [1, 2, {"x": "]"}]}},
+]
+
+
+@pytest.mark.parametrize("read_size", [1, 7, 1 << 16])
+@pytest.mark.parametrize(
+    "document",
+    [PRODUCTS, {"products": PRODUCTS}, {"count": 3, "products": PRODUCTS}],
+)
+def test_iter_json_array(document, read_size):
+    for indent in (None, 2):
+        text = json.dumps(document, indent=indent)
+        assert list(iter_json_array(io.StringIO(text), read_size)) == PRODUCTS
+
+
+@pytest.mark.parametrize("text", ["", "{}", "[]", '{"products": []}', "  [ \n ]"])
+def test_iter_json_array_without_items(text):
+    assert list(iter_json_array(io.StringIO(text), 2)) == []
+
+
+def test_iter_json_array_is_lazy():
+    items = iter_json_array(io.StringIO('[{"a": 1}, {"b": 2}, {broken'), 4)
+    assert next(items) == {"a": 1}
+    assert next(items) == {"b": 2}
+    with pytest.raises(json.JSONDecodeError):
+        next(items)
+
+
+def test_token_budget_batches():
+    contents = ["a" * 40, "b" * 40, "c" * 4, "d" * 100, "e"]
+    # 11, 11, 2, 26 and 1 estimated tokens.
+    assert list(token_budget_batches(contents, max_tokens=24, max_size=10)) == [
+        [0, 1, 2],
+        [3],
+        [4],
+    ]
+    assert list(token_budget_batches(contents, max_tokens=1000, max_size=2)) == [
+        [0, 1],
+        [2, 3],
+        [4],
+    ]
+    assert list(token_budget_batches([], max_tokens=10, max_size=2)) == []
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked(iter([]), 2)) == []
+
+
+class FakeEmbedding:
+    embedding_model_name = "test-model"
+
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.batches = []
+
+    def generate_multiple(self, contents):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.batches.append(contents)
+        return [[float(len(content))] for content in contents]
+
+
+def catalog(tmp_path, names):
+    path = tmp_path / "catalog.jsonl"
+    path.write_text(
+        "".join(
+            json.dumps({"sku": name.lower(), "name": name, "sizes": ["S"]})
+            + "\n"
+            for name in names
+        )
+    )
+    return str(path)
+
+
+@pytest.fixture
+def written(monkeypatch):
+    chunks = []
+    monkeypatch.setattr(IngestionPipeline, "existing_hashes", lambda self, keys: {})
+    monkeypatch.setattr(
+        IngestionPipeline, "write_chunk", lambda self, rows: chunks.append(rows)
+    )
+    return chunks
+
+
+def test_run_resumes_after_the_checkpoint(tmp_path, written):
+    source = catalog(tmp_path, ["A", "B", "C", "D", "E"])
+    checkpoint = str(tmp_path / "load.checkpoint")
+    pipeline = IngestionPipeline(
+        Product, FakeEmbedding(), chunk_size=2, checkpoint_path=checkpoint
+    )
+    pipeline.write_checkpoint(source, 3)
+
+    assert pipeline.run(source) == 2
+    assert [[row["sku"] for row in rows] for rows in written] == [["d", "e"]]
+    with open(checkpoint, encoding="utf-8") as f:
+        assert json.load(f)["records"] == 5
+    # Nothing left to load.
+    assert pipeline.run(source) == 0
+
+
+def test_checkpoint_of_another_source_is_ignored(tmp_path, written):
+    source = catalog(tmp_path, ["A", "B"])
+    pipeline = IngestionPipeline(
+        Product, FakeEmbedding(), checkpoint_path=str(tmp_path / "load.checkpoint")
+    )
+    pipeline.write_checkpoint(str(tmp_path / "other.jsonl"), 2)
+
+    assert pipeline.read_checkpoint(source) == 0
+    assert pipeline.run(source) == 2
+
+
+def test_sync_only_embeds_changed_products(monkeypatch, written):
+    embedding = FakeEmbedding()
+    pipeline = IngestionPipeline(Product, embedding, sync=True)
+    items = [
+        {"sku": "a", "name": "A", "sizes": ["S"], "price": 10},
+        {"sku": "b", "name": "B", "sizes": ["M"]},
+        {"sku": "c", "name": "C", "sizes": ["L"]},
+    ]
+    unchanged = Product(**{**items[0], "price": 99}).get_content_hash("test-model")
+    monkeypatch.setattr(
+        IngestionPipeline,
+        "existing_hashes",
+        lambda self, keys: {"a": unchanged, "b": "stale"},
+    )
+
+    rows = pipeline.prepare_chunk(items)
+
+    assert [row["sku"] for row in rows] == ["a", "b", "c"]
+    assert "embedding" not in rows[0]
+    assert rows[0]["price"] == 10
+    assert all("embedding" in row for row in rows[1:])
+    assert embedding.batches == [
+        [Product(**item).to_embedding_str() for item in items[1:]]
+    ]
+
+
+def test_duplicate_keys_keep_the_last_item(written):
+    pipeline = IngestionPipeline(Product, FakeEmbedding(), sync=True)
+    rows = pipeline.prepare_chunk(
+        [
+            {"name": "Hat", "sizes": [], "price": 1},
+            {"name": "Cap", "sizes": []},
+            {"name": "HAT", "sizes": [], "price": 2},
+        ]
+    )
+    assert [(row["sku"], row.get("price")) for row in rows] == [
+        ("cap", None),
+        ("hat", 2),
+    ]
+
+
+def test_load_without_sync_rejects_loaded_products(monkeypatch):
+    embedding = FakeEmbedding()
+    monkeypatch.setattr(
+        IngestionPipeline, "existing_hashes", lambda self, keys: {"a": "hash"}
+    )
+    with pytest.raises(ValueError, match="use --sync"):
+        IngestionPipeline(Product, embedding).prepare_chunk(
+            [{"sku": "a", "name": "A", "sizes": []}]
+        )
+    assert embedding.batches == []
+
+
+def test_embed_with_retry(monkeypatch):
+    delays = []
+    monkeypatch.setattr(time, "sleep", delays.append)
+    error = openai.APIConnectionError(request=httpx.Request("POST", "http://test"))
+    embedding = FakeEmbedding(failures=[error, error])
+
+    pipeline = IngestionPipeline(Product, embedding, max_retries=2)
+    assert pipeline.embed_with_retry(["abc"]) == [[3.0]]
+    assert len(delays) == 2
+    assert 1 <= delays[0] <= 2 and 2 <= delays[1] <= 4
+
+    embedding.failures = [error] * 3
+    with pytest.raises(openai.APIConnectionError):
+        pipeline.embed_with_retry(["abc"])
+
+
+def test_upsert_statement_updates_all_but_the_key():
+    stmt = IngestionPipeline(Product, FakeEmbedding(), sync=True).upsert_statement(
+        {"sku", "name", "content_hash"}
+    )
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    assert "ON CONFLICT (sku) DO UPDATE SET" in sql
+    assert "name = excluded.name" in sql
+    assert "content_hash = excluded.content_hash" in sql
+    assert "sku = excluded.sku" not in sql
+
+
+def test_rebuild_index_wraps_the_load(tmp_path, monkeypatch, written):
+    calls = []
+    monkeypatch.setattr(
+        IngestionPipeline, "drop_vector_index", lambda self: calls.append("drop")
+    )
+    monkeypatch.setattr(
+        IngestionPipeline, "create_vector_index", lambda self: calls.append("create")
+    )
+    monkeypatch.setattr(
+        IngestionPipeline,
+        "write_chunk",
+        lambda self, rows: calls.append(len(rows)),
+    )
+    pipeline = IngestionPipeline(Product, FakeEmbedding(), chunk_size=2)
+    pipeline.run(catalog(tmp_path, ["A", "B", "C"]), rebuild_index=True)
+    assert calls == ["drop", 2, 1, "create"]
@@ -0,0 +1,145 @@
+"""
+    Tests of the Prometheus rendering of services.metrics.
+"""
+
+import math
+
+from services.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsRegistry,
+    format_labels,
+    format_value,
+    record_stage,
+    request_timings,
+    server_timing_header,
+    start_request_timings,
+    summarize_plan,
+)
+
+
+def test_format_value():
+    assert format_value(3) == "3"
+    assert format_value(2.0) == "2"
+    assert format_value(0.25) == "0.25"
+    assert format_value(math.inf) == "+Inf"
+    assert format_value(-math.inf) == "-Inf"
+
+
+def test_format_labels():
+    assert format_labels((), ()) == ""
+    assert format_labels(("stage",), ("sql",)) == '{stage="sql"}'
+    assert format_labels(("a", "b"), ("1", "2"), 'le="5"') == '{a="1",b="2",le="5"}'
+    assert format_labels(("route",), ('a"b\\c\nd',)) == '{route="a\\"b\\\\c\\nd"}'
+
+
+def test_counter_render():
+    counter = Counter("requests", "Requests served.", ("method",))
+    counter.inc(method="GET")
+    counter.inc(2, method="GET")
+    counter.inc(0.5, method="POST")
+    assert counter.render() == (
+        "# HELP requests Requests served.\n"
+        "# TYPE requests counter\n"
+        'requests_total{method="GET"} 3\n'
+        'requests_total{method="POST"} 0.5'
+    )
+
+
+def test_counter_missing_labels_are_empty():
+    counter = Counter("requests", "Requests served.", ("method", "status"))
+    counter.inc(method="GET")
+    assert counter.samples() == ['requests_total{method="GET",status=""} 1']
+
+
+def test_histogram_render():
+    histogram = Histogram("latency", "Latency.", ("stage",), buckets=(1, 0.1))
+    histogram.observe(0.05, stage="sql")
+    histogram.observe(0.5, stage="sql")
+    histogram.observe(3, stage="sql")
+    assert histogram.render().splitlines() == [
+        "# HELP latency Latency.",
+        "# TYPE latency histogram",
+        'latency_bucket{stage="sql",le="0.1"} 1',
+        'latency_bucket{stage="sql",le="1"} 2',
+        'latency_bucket{stage="sql",le="+Inf"} 3',
+        'latency_sum{stage="sql"} 3.55',
+        'latency_count{stage="sql"} 3',
+    ]
+
+
+def test_gauge_render():
+    gauge = Gauge("connections", "Connections.", ("pool", "state"))
+    gauge.set(4, pool="search", state="idle")
+    assert gauge.samples() == ['connections{pool="search",state="idle"} 4']
+    gauge = Gauge("size", "Size.", callback=lambda: {(): 12})
+    assert gauge.samples() == ["size 12"]
+
+
+def test_gauge_callback_errors_are_skipped():
+    def collect():
+        raise RuntimeError("database down")
+
+    assert Gauge("size", "Size.", callback=collect).samples() == []
+
+
+def test_registry_render():
+    registry = MetricsRegistry()
+    registry.counter("a", "A.").inc()
+    registry.gauge("b", "B.", callback=lambda: {(): 1})
+    assert registry.render() == (
+        "# HELP a A.\n# TYPE a counter\na_total 1\n"
+        "# HELP b B.\n# TYPE b gauge\nb 1\n"
+    )
+
+
+def test_request_timings():
+    token = request_timings.set(None)
+    try:
+        record_stage("sql", 0.1)
+        timings = start_request_timings()
+        record_stage("sql", 0.01)
+        record_stage("sql", 0.02)
+        record_stage("embedding", 0.2)
+        assert timings == {"sql": 0.03, "embedding": 0.2}
+        assert server_timing_header(timings, 0.25) == (
+            "sql;dur=30.0, embedding;dur=200.0, total;dur=250.0"
+        )
+    finally:
+        request_timings.reset(token)
+
+
+def test_summarize_plan():
+    plan = {
+        "Plan": {
+            "Node Type": "Limit",
+            "Shared Hit Blocks": 10,
+            "Shared Read Blocks": 2,
+            "Plans": [
+                {
+                    "Node Type": "Index Scan",
+                    "Index Name": "product_embedding_idx",
+                    "Actual Rows": 40,
+                    "Actual Loops": 1,
+                },
+                {
+                    "Node Type": "Bitmap Heap Scan",
+                    "Actual Rows": 5,
+                    "Actual Loops": 2,
+                    "Rows Removed by Filter": 3,
+                },
+            ],
+        },
+        "Execution Time": 1.5,
+        "Planning Time": 0.2,
+    }
+    assert summarize_plan(plan, "product_embedding") == {
+        "rows_scanned": 56,
+        "shared_hit_blocks": 10,
+        "shared_read_blocks": 2,
+        "vector_index_used": True,
+        "execution_ms": 1.5,
+        "planning_ms": 0.2,
+    }
+    assert not summarize_plan(plan, "other_index")["vector_index_used"]
@@ -0,0 +1,54 @@
+"""
+    Tests of the precomputed product neighbors of services.neighbors.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from models.product import Product
+from services.neighbors import NeighborIndex
+from services.postgres_searcher import PostgresSearcher
+
+
+@pytest.fixture
+def neighbor_index():
+    return NeighborIndex(PostgresSearcher(Product), k=3)
+
+
+def test_neighbors_query(neighbor_index):
+    stmt = neighbor_index.neighbors_query(5, top=2)
+    sql = " ".join(str(stmt.compile(dialect=postgresql.dialect())).split())
+    assert (
+        'JOIN product_neighbor ON product_neighbor.neighbor_id = "Product".id '
+        "WHERE product_neighbor.product_id = %(product_id_1)s "
+        "ORDER BY product_neighbor.rank LIMIT %(param_1)s"
+    ) in sql
+    assert '"Product".embedding' not in sql.split(" FROM ")[0]
+    assert stmt.compile().params == {"product_id_1": 5, "param_1": 2}
+
+
+def test_compute_statement_searches_each_product(neighbor_index):
+    sql = " ".join(neighbor_index.compute_statement().text.split())
+    assert "CROSS JOIN LATERAL (" in sql
+    assert "WHERE id <> source.id ORDER BY embedding <=> source.embedding" in sql
+    assert "WHERE source.id = ANY(:ids) AND source.embedding IS NOT NULL" in sql
+    assert "PARTITION BY source.id ORDER BY neighbors.score DESC, neighbors.id" in sql
+
+
+@pytest.mark.parametrize(
+    "batch, refreshed",
+    [
+        (SimpleNamespace(full=False, embedding_ids=set()), False),
+        (SimpleNamespace(full=False, embedding_ids={3}), True),
+        (SimpleNamespace(full=True, embedding_ids=set()), True),
+    ],
+)
+def test_changed_embeddings_refresh_the_neighbors(
+    neighbor_index, monkeypatch, batch, refreshed
+):
+    calls = []
+    monkeypatch.setattr(neighbor_index, "refresh", lambda: calls.append(True))
+    neighbor_index.apply_changes(batch)
+    assert calls == ([True] if refreshed else [])
@@ -0,0 +1,542 @@
+"""
+    Tests of the statements built by services.postgres_searcher, compiled for
+    PostgreSQL without a database.
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from sqlalchemy import Select
+from sqlalchemy.dialects import postgresql
+
+from config.main import config
+from models.product import Product
+from services.fusion import ScoreFusion
+from services.postgres_searcher import PostgresSearcher
+
+
+def compile_sql(stmt) -> str:
+    return " ".join(str(stmt.compile(dialect=postgresql.dialect())).split())
+
+
+def ranking_row(id, score=1.0, vector_hits=0, query_index=0, facets=None):
+    return SimpleNamespace(
+        id=id,
+        score=score,
+        vector_rank=None,
+        vector_score=None,
+        text_rank=None,
+        text_score=None,
+        vector_hits=vector_hits,
+        query_index=query_index,
+        facets=facets,
+    )
+
+
+class Result:
+    def __init__(self, rows=(), value=None):
+        self.rows = list(rows)
+        self.value = value
+
+    def fetchall(self):
+        return self.rows
+
+    def all(self):
+        return self.rows
+
+    def scalars(self):
+        return self.rows
+
+    def scalar(self):
+        return self.value
+
+
+class ScriptedSession:
+    """
+    Stands in for a database session running a search plan: the ranking
+    statements return the scripted rankings in turn, the planner estimates
+    are `estimate` out of `total_rows`, every ranked id is loaded and the
+    stored embedding of a product is `embedding`.
+    """
+
+    def __init__(
+        self, rankings=(), estimate=100, total_rows=1_000_000, embedding=None
+    ):
+        self.rankings = list(rankings)
+        self.estimate = estimate
+        self.total_rows = total_rows
+        self.embedding = embedding
+        self.statements = []
+
+    def execute(self, stmt, params=None):
+        if isinstance(stmt, Select) and "ids" not in stmt.compile().params:
+            self.statements.append(("embedding", None))
+            return Result(value=self.embedding)
+        if isinstance(stmt, Select):
+            ids = stmt.compile().params["ids"]
+            self.statements.append(("hydrate", {"ids": ids}))
+            return Result([SimpleNamespace(id=id) for id in ids])
+        sql = " ".join(str(stmt).split())
+        self.statements.append((sql, params))
+        if sql.startswith("SELECT set_config"):
+            return Result()
+        if sql.startswith("EXPLAIN (FORMAT JSON)"):
+            return Result(value=[{"Plan": {"Plan Rows": self.estimate}}])
+        if "reltuples" in sql:
+            return Result(value=self.total_rows)
+        return Result(self.rankings.pop(0))
+
+    def settings(self) -> list[tuple[str, str]]:
+        return [
+            (params["name"], params["value"])
+            for sql, params in self.statements
+            if sql.startswith("SELECT set_config")
+        ]
+
+    def rankings_params(self) -> list[dict]:
+        return [params for sql, params in self.statements if "fused AS" in sql]
+
+
+@pytest.fixture
+def searcher():
+    return PostgresSearcher(Product)
+
+
+def test_hydrate_query_selects_all_ids_at_once(searcher):
+    stmt = searcher.hydrate_query([3, 1, 2])
+    sql = compile_sql(stmt)
+    assert sql.count("SELECT") == 1
+    assert 'WHERE "Product".id = ANY (%(ids)s::INTEGER[])' in sql
+    assert stmt.compile().params == {"ids": [3, 1, 2]}
+
+
+def test_hydrate_query_defers_the_embedding(searcher):
+    selected = compile_sql(searcher.hydrate_query([1])).split(" FROM ")[0]
+    assert '"Product".embedding' not in selected
+    selected = compile_sql(searcher.hydrate_query([1], True)).split(" FROM ")[0]
+    assert '"Product".embedding' in selected
+
+
+def test_order_by_rank_skips_missing_ids():
+    items = [SimpleNamespace(id=i) for i in (1, 2, 3)]
+    ranked = PostgresSearcher.order_by_rank(items, [3, 4, 1])
+    assert [item.id for item in ranked] == [3, 1]
+
+
+def test_hydrate_without_ids_skips_the_query(searcher):
+    assert searcher.hydrate(None, []) == []
+
+
+def test_text_leg_searches_the_stored_tsvector(searcher):
+    sql = " ".join(searcher.ranking_sql(True, False, "", "ann", searcher.fusion).split())
+    assert "ts_rank_cd(content_tsv, query)" in sql
+    assert "WHERE content_tsv @@ query" in sql
+    assert "to_tsvector" not in sql
+
+
+def test_text_leg_tokenizes_models_without_a_tsvector():
+    class Model:
+        __tablename__ = "Model"
+
+        @staticmethod
+        def get_text_search_field():
+            return "body"
+
+    searcher = PostgresSearcher.__new__(PostgresSearcher)
+    searcher.db_model = Model
+    assert searcher.text_search_vector() == "to_tsvector('english', body)"
+
+
+def test_stored_tsvector_and_its_gin_index():
+    column = Product.__table__.c.content_tsv
+    assert column.computed.persisted
+    assert "to_tsvector('english', coalesce(content, ''))" in str(column.computed.sqltext)
+    index = next(
+        index
+        for index in Product.__table__.indexes
+        if index.name == "gin_index_product_content_tsv"
+    )
+    assert [indexed.name for indexed in index.columns] == ["content_tsv"]
+    assert index.dialect_options["postgresql"]["using"] == "gin"
+
+
+def test_vector_leg_orders_by_the_indexed_distance(searcher):
+    sql = " ".join(searcher.build_vector_query("ann", "").split())
+    assert "ORDER BY embedding <=> :embedding LIMIT :candidates" in sql
+    assert "1 - (embedding <=> :embedding) AS score" in sql
+
+
+@pytest.mark.parametrize(
+    "strategy, expected",
+    [
+        (
+            "ann",
+            'FROM "Product" WHERE price < 5 '
+            "ORDER BY embedding <=> :embedding LIMIT :candidates",
+        ),
+        (
+            "exact",
+            "WHERE price < 5 OFFSET 0 ) filtered ORDER BY distance LIMIT :candidates",
+        ),
+        (
+            "iterative",
+            'LIMIT :ann_candidates ) candidates JOIN "Product" USING (id) '
+            "WHERE price < 5",
+        ),
+    ],
+)
+def test_vector_leg_strategies(searcher, strategy, expected):
+    sql = " ".join(searcher.build_vector_query(strategy, "WHERE price < 5").split())
+    assert expected in sql
+
+
+def test_unknown_vector_strategy(searcher):
+    with pytest.raises(ValueError, match="Unknown vector search strategy 'nearest'"):
+        searcher.build_vector_query("nearest", "")
+
+
+def test_partial_strategy_inlines_the_indexed_value(searcher, monkeypatch):
+    monkeypatch.setattr(config, "PARTIAL_VECTOR_INDEX_VALUES", "Summer Wear, Shoes")
+    filters = [{"column": "category", "comparison_operator": "=", "value": "Shoes"}]
+    assert searcher.compile_filters(filters, "partial") == ("category = 'Shoes'", {})
+    assert searcher.compile_filters(filters, "ann") == (
+        "category = :filter_0",
+        {"filter_0": "Shoes"},
+    )
+    session = ScriptedSession()
+    plan = searcher.choose_vector_strategy(filters)
+    assert PostgresSearcher.run_plan(session, plan) == "partial"
+    assert session.statements == []
+
+
+@pytest.mark.parametrize(
+    "estimate, expected",
+    [
+        (20_000, "exact"),
+        # 40 ef_search rows with half of them passing the filters.
+        (500_000, "ann"),
+        (100_000, "iterative"),
+    ],
+)
+def test_vector_strategy_follows_the_estimated_rows(searcher, estimate, expected):
+    filters = [{"column": "price", "comparison_operator": "<", "value": 5}]
+    session = ScriptedSession(estimate=estimate)
+    plan = searcher.choose_vector_strategy(filters, candidates=20)
+    assert PostgresSearcher.run_plan(session, plan) == expected
+
+
+def test_estimates_are_cached_per_filter(searcher):
+    filters = [{"column": "price", "comparison_operator": "<", "value": 5}]
+    session = ScriptedSession()
+    for _ in range(2):
+        PostgresSearcher.run_plan(session, searcher.estimate_filtered_rows(filters))
+    assert len(session.statements) == 2
+    searcher.apply_changes([])
+    PostgresSearcher.run_plan(session, searcher.estimate_filtered_rows(filters))
+    assert len(session.statements) == 4
+
+
+def test_iterative_search_widens_the_scan(searcher, monkeypatch):
+    monkeypatch.setattr(config, "VECTOR_SEARCH_MAX_CANDIDATES", 1000)
+    filters = [{"column": "price", "comparison_operator": "<", "value": 5}]
+    session = ScriptedSession(
+        [
+            [ranking_row(1, vector_hits=3)],
+            [ranking_row(1, vector_hits=8)],
+            [ranking_row(1, vector_hits=9)],
+            [ranking_row(1, vector_hits=9)],
+            [ranking_row(1, vector_hits=9)],
+        ],
+        estimate=100_000,
+    )
+    plan = searcher.search_plan(None, [0.0] * 4, top=5, filters=filters, candidates=10)
+    items = PostgresSearcher.run_plan(session, plan)
+
+    assert [item.id for item in items] == [1]
+    assert [params["ann_candidates"] for params in session.rankings_params()] == [
+        40,
+        160,
+        640,
+        1000,
+        1000,
+    ]
+    assert ("hnsw.ef_search", "640") in session.settings()
+    # The last ranking is exact, once the scan can't be widened further.
+    last_ranking = [sql for sql, _ in session.statements if "fused AS" in sql][-1]
+    assert "OFFSET 0" in last_ranking
+
+
+def test_search_query_params(searcher, monkeypatch):
+    monkeypatch.setattr(config, "SEARCH_CANDIDATES", 20)
+    sql, params = searcher.build_search_query("hat", [0.5, 0.25], top=5)
+    assert params == {
+        "embedding": "[0.5, 0.25]",
+        "query": "hat",
+        "candidates": 20,
+        "top": 5,
+        "offset": 0,
+        **searcher.fusion.params(),
+    }
+    assert [column.name for column in sql.selected_columns] == [
+        "id",
+        "score",
+        "vector_rank",
+        "vector_score",
+        "text_rank",
+        "text_score",
+        "vector_hits",
+    ]
+    # The legs fetch at least the top rows.
+    assert searcher.build_search_query("hat", [], top=50)[1]["candidates"] == 50
+
+
+def test_search_query_fusion_override(searcher):
+    fusion = ScoreFusion("zscore", 0.8, 0.2)
+    sql, params = searcher.build_search_query("hat", [0.5], fusion=fusion, candidates=7)
+    assert params["candidates"] == 7
+    assert params["fusion_vector_weight"] == 0.8
+    assert "fusion_k" not in params
+    assert fusion.score_sql() in sql.element.text
+
+
+def test_search_query_disabled_legs(searcher):
+    text_only = " ".join(searcher.build_search_query("hat", [])[0].element.text.split())
+    assert "<=>" not in text_only
+    assert "WITH vector_search AS ( SELECT CAST(NULL AS INTEGER) AS id" in text_only
+    vector_only = " ".join(searcher.build_search_query(None, [0.5])[0].element.text.split())
+    assert "plainto_tsquery" not in vector_only
+    with pytest.raises(ValueError, match="Both query text and query vector are empty"):
+        searcher.build_search_query(None, [])
+
+
+def test_compact_index_candidates_are_reranked(searcher, monkeypatch):
+    monkeypatch.setattr(Product, "vector_index_type", "bit")
+    monkeypatch.setattr(config, "VECTOR_RERANK_OVERSAMPLING", 4)
+    sql = " ".join(searcher.build_vector_query("ann", "WHERE price < 5").split())
+    assert (
+        "SELECT id, embedding <=> :embedding AS distance FROM \"Product\" "
+        "WHERE price < 5 ORDER BY CAST(binary_quantize(embedding) AS bit(1536)) <~> "
+        "CAST(binary_quantize(CAST(:embedding AS vector)) AS bit(1536)) "
+        "LIMIT :ann_candidates ) candidates ORDER BY candidates.distance "
+        "LIMIT :candidates"
+    ) in sql
+    assert searcher.initial_ann_candidates("ann", 20, True) == 80
+    assert searcher.initial_ann_candidates("iterative", 20, True) == 320
+    assert searcher.initial_ann_candidates("exact", 20, True) is None
+    # The text search alone doesn't scan the index.
+    assert searcher.initial_ann_candidates("ann", 20, False) is None
+
+
+def test_full_index_candidates(searcher):
+    assert searcher.initial_ann_candidates("ann", 20, True) is None
+    assert searcher.initial_ann_candidates("iterative", 20, True) == 80
+
+
+def test_batch_search_query(searcher, monkeypatch):
+    monkeypatch.setattr(config, "SEARCH_CANDIDATES", 20)
+    sql, params = searcher.build_batch_search_query(
+        ["red hat", "rain boots"], [[0.5], [0.25]], top=3
+    )
+    text = " ".join(sql.element.text.split())
+    assert (
+        "FROM unnest( CAST(:embeddings AS vector[]), CAST(:queries AS text[]) ) "
+        "WITH ORDINALITY AS queries(embedding, query_text, query_index) "
+        "CROSS JOIN LATERAL (" in text
+    )
+    assert "ORDER BY embedding <=> queries.embedding" in text
+    assert "plainto_tsquery('english', queries.query_text)" in text
+    assert text.endswith("ORDER BY queries.query_index, ranked.score DESC, ranked.id")
+    assert params == {
+        "embeddings": ["[0.5]", "[0.25]"],
+        "queries": ["red hat", "rain boots"],
+        "candidates": 20,
+        "top": 3,
+        "offset": 0,
+        **searcher.fusion.params(),
+    }
+    assert sql.selected_columns[0].name == "query_index"
+
+
+def test_batch_search_query_without_a_leg(searcher):
+    _, params = searcher.build_batch_search_query(None, [[0.5], [0.25]])
+    assert params["queries"] == [None, None]
+    _, params = searcher.build_batch_search_query(["a", "b"], None)
+    assert params["embeddings"] == [None, None]
+    with pytest.raises(ValueError, match="Both query texts and query vectors are empty"):
+        searcher.build_batch_search_query(None, None)
+
+
+def test_batch_search_plan_groups_the_rows_by_query(searcher):
+    session = ScriptedSession(
+        [
+            [
+                ranking_row(7, score=0.9, query_index=0),
+                ranking_row(3, score=0.5, query_index=0),
+                ranking_row(3, score=0.8, query_index=2),
+            ]
+        ]
+    )
+    plan = searcher.batch_search_plan(["a", "b", "c"], None, top=2)
+    grouped = PostgresSearcher.run_plan(session, plan)
+
+    assert [[(item.id, info["score"]) for item, info in hits] for hits in grouped] == [
+        [(7, 0.9), (3, 0.5)],
+        [],
+        [(3, 0.8)],
+    ]
+    # One ranking statement, then one statement loading each product once.
+    assert [sql for sql, _ in session.statements][-1] == "hydrate"
+    assert session.statements[-1][1] == {"ids": [7, 3]}
+    assert len(session.rankings_params()) == 1
+
+
+def test_pages_share_the_candidate_depth(searcher):
+    pages = [
+        searcher.build_search_query("hat", [0.5], top=11, candidates=200, offset=offset)[1]
+        for offset in (0, 10, 180)
+    ]
+    assert {params["candidates"] for params in pages} == {200}
+    assert [params["offset"] for params in pages] == [0, 10, 180]
+
+
+def test_search_query_with_facets(searcher, monkeypatch):
+    monkeypatch.setattr(config, "SEARCH_PRICE_FACET_BOUNDS", "10,20")
+    sql, params = searcher.build_search_query("hat", [0.5], facets=True)
+    text = " ".join(sql.element.text.split())
+    assert params["price_facet_bounds"] == [10.0, 20.0]
+    assert list(sql.selected_columns)[-1].name == "facets"
+    # The facets count the fused candidates, and are kept on an empty page.
+    assert (
+        'WITH candidate_products AS ( SELECT "Product".* FROM fused '
+        'JOIN "Product" USING (id) )' in text
+    )
+    assert "unnest(candidate_products.\"sizes\") facet_value" in text
+    assert "FROM facets LEFT JOIN page ON true" in text
+
+
+def test_format_facets(searcher, monkeypatch):
+    monkeypatch.setattr(config, "SEARCH_PRICE_FACET_BOUNDS", "10,20.5")
+    facets = searcher.format_facets(
+        {
+            "category": {"Shoes": 2, "Hats": 5, "Bags": 2},
+            "sizes": {"S": 1},
+            "price": {"0": 1, "2": 4},
+        }
+    )
+    assert facets == {
+        "category": {"Hats": 5, "Bags": 2, "Shoes": 2},
+        "age_group": {},
+        "sizes": {"S": 1},
+        "price": {"<10": 1, "20.5+": 4},
+    }
+    assert list(facets["category"]) == ["Hats", "Bags", "Shoes"]
+    assert searcher.format_facets(None) is None
+
+
+def test_search_plan_pages(searcher):
+    session = ScriptedSession(
+        [[ranking_row(4, facets={"price": {"1": 2}}), ranking_row(9)]]
+    )
+    plan = searcher.search_plan("hat", [], top=2, offset=2, candidates=50, facets=True)
+    items = PostgresSearcher.run_plan(session, plan)
+    assert [item.id for item in items] == [4, 9]
+    assert items.facets["price"] == {"10-20": 2}
+    assert items[0].search_info["score"] == 1.0
+    (params,) = session.rankings_params()
+    assert (params["top"], params["offset"], params["candidates"]) == (2, 2, 50)
+
+
+def test_empty_page_keeps_the_facets(searcher):
+    session = ScriptedSession([[ranking_row(None, facets={"category": {"Hats": 1}})]])
+    plan = searcher.search_plan("hat", [], top=2, offset=40, facets=True)
+    items = PostgresSearcher.run_plan(session, plan)
+    assert list(items) == []
+    assert items.facets["category"] == {"Hats": 1}
+    assert [sql for sql, _ in session.statements if sql == "hydrate"] == []
+
+
+def test_diversified_pages_are_cut_from_one_pool(searcher, monkeypatch):
+    diversity = SimpleNamespace(pool=6, group_field="category", dimensions=None)
+    picked = []
+
+    def diversify(diversity, results, pool, k):
+        picked.append(k)
+        return list(range(min(k, len(results))))[::-1]
+
+    monkeypatch.setattr(searcher, "diversify", diversify)
+    # The ranking, then the embeddings of the pool, unused by the stub.
+    session = ScriptedSession([[ranking_row(id) for id in range(1, 7)], []])
+    plan = searcher.search_plan("hat", [], top=2, offset=2, diversity=diversity)
+    items = PostgresSearcher.run_plan(session, plan)
+
+    (params,) = session.rankings_params()
+    assert (params["top"], params["offset"]) == (6, 0)
+    assert picked == [4]
+    # Reranked order 4, 3, 2, 1, page 2.
+    assert [item.id for item in items] == [2, 1]
+
+
+def test_similar_plan_leaves_the_product_out(searcher):
+    session = ScriptedSession(
+        [[ranking_row(5), ranking_row(2), ranking_row(8)]], embedding=np.ones(4)
+    )
+    items = PostgresSearcher.run_plan(session, searcher.similar_plan(5, top=2))
+    assert [item.id for item in items] == [2, 8]
+    (params,) = session.rankings_params()
+    # One more row, in case the product ranks first, and no text leg.
+    assert params["top"] == 3
+    assert params["query"] is None
+    assert params["embedding"] == "[1.0, 1.0, 1.0, 1.0]"
+
+
+def test_similar_plan_of_a_missing_product(searcher):
+    session = ScriptedSession()
+    assert PostgresSearcher.run_plan(session, searcher.similar_plan(5)) is None
+    assert session.statements == [("embedding", None)]
+
+
+class StubVectorTier:
+    def __init__(self, hits):
+        self.hits = hits
+        self.requested = []
+        self.fallbacks = 0
+
+    def search(self, query_vector, k):
+        self.requested.append(k)
+        return self.hits
+
+    def record_fallback(self):
+        self.fallbacks += 1
+
+
+def test_vector_leg_from_the_snapshot():
+    tier = StubVectorTier(([4, 2], [0.9, 0.8]))
+    searcher = PostgresSearcher(Product, vector_tier=tier)
+    session = ScriptedSession([[ranking_row(4), ranking_row(2)]])
+    plan = searcher.search_plan("hat", [0.5], top=2, candidates=10)
+    items = PostgresSearcher.run_plan(session, plan)
+
+    assert [item.id for item in items] == [4, 2]
+    assert tier.requested == [10]
+    (params,) = session.rankings_params()
+    assert (params["snapshot_ids"], params["snapshot_scores"]) == ([4, 2], [0.9, 0.8])
+
+
+def test_filtered_snapshot_search_falls_back_to_postgres(monkeypatch):
+    monkeypatch.setattr(config, "VECTOR_SEARCH_MAX_CANDIDATES", 1000)
+    # The snapshot returned all the 40 candidates asked, 3 passed the filters.
+    tier = StubVectorTier((list(range(40)), [1.0] * 40))
+    searcher = PostgresSearcher(Product, vector_tier=tier)
+    filters = [{"column": "price", "comparison_operator": "<", "value": 5}]
+    session = ScriptedSession(
+        [[ranking_row(1, vector_hits=3)], [ranking_row(1, vector_hits=3)]], estimate=50
+    )
+    plan = searcher.search_plan(None, [0.5], top=2, filters=filters, candidates=10)
+    PostgresSearcher.run_plan(session, plan)
+
+    assert tier.requested == [40]
+    assert tier.fallbacks == 1
+    first, second = [sql for sql, _ in session.statements if "fused AS" in sql]
+    assert "snapshot_ids" in first
+    assert "OFFSET 0" in second
@@ -0,0 +1,269 @@
+"""
+    Tests of the API endpoints, with stubbed services in place of the ones
+    created by the application lifespan.
+"""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.router import api_router, get_chat_service, get_neighbor_index, get_searcher
+from config.main import config
+from services.postgres_searcher import SearchResults
+
+
+class StubProduct(SimpleNamespace):
+    def to_dict(self):
+        return {"id": self.id, "name": self.name}
+
+
+@pytest.fixture
+def app():
+    app = FastAPI()
+    app.include_router(api_router)
+    return app
+
+
+def parse_events(body: str) -> list[tuple[str, object]]:
+    events = []
+    for message in body.strip().split("\n\n"):
+        event, data = message.split("\n")
+        assert event.startswith("event: ") and data.startswith("data: ")
+        events.append((event[len("event: ") :], json.loads(data[len("data: ") :])))
+    return events
+
+
+def test_chat_stream_events(app):
+    class StubChatService:
+        async def astream_response(self, query):
+            yield "products", [StubProduct(id=1, name=query)]
+            yield "token", "Found\n"
+            yield "token", "a hat."
+            yield "done", "Found\na hat."
+
+    app.dependency_overrides[get_chat_service] = StubChatService
+    response = TestClient(app).post("/chat/stream", json={"query": "hat"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.headers["cache-control"] == "no-cache"
+    assert parse_events(response.text) == [
+        ("products", [{"id": 1, "name": "hat"}]),
+        ("token", "Found\n"),
+        ("token", "a hat."),
+        ("done", "Found\na hat."),
+    ]
+
+
+def test_chat_stream_reports_errors(app):
+    class FailingChatService:
+        async def astream_response(self, query):
+            yield "token", "Partial"
+            raise RuntimeError("LLM unavailable")
+
+    app.dependency_overrides[get_chat_service] = FailingChatService
+    response = TestClient(app).post("/chat/stream", json={"query": "hat"})
+    assert parse_events(response.text) == [
+        ("token", "Partial"),
+        ("error", "Error generating the response."),
+    ]
+
+
+class StubBatchSearcher:
+    def __init__(self, fail_after=None):
+        self.chunks = []
+        self.fail_after = fail_after
+
+    async def asearch_many(self, queries, top, **options):
+        if len(self.chunks) == self.fail_after:
+            raise RuntimeError("database unavailable")
+        self.chunks.append(queries)
+        return [
+            [(StubProduct(id=i, name=query), {"score": 1.0 / (i + 1)}) for i in range(top)]
+            for query in queries
+        ]
+
+
+def test_batch_search_streams_one_line_per_query(app, monkeypatch):
+    monkeypatch.setattr(config, "SEARCH_BATCH_SIZE", 2)
+    searcher = StubBatchSearcher()
+    app.dependency_overrides[get_searcher] = lambda: searcher
+    response = TestClient(app).post(
+        "/search/batch", json={"queries": ["hat", "boots", "scarf"], "top": 1}
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.text.endswith("\n")
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {
+            "query_index": i,
+            "query": query,
+            "products": [{"id": 0, "name": query, "search_info": {"score": 1.0}}],
+        }
+        for i, query in enumerate(["hat", "boots", "scarf"])
+    ]
+    assert searcher.chunks == [["hat", "boots"], ["scarf"]]
+
+
+def test_batch_search_ends_with_an_error_line(app, monkeypatch):
+    monkeypatch.setattr(config, "SEARCH_BATCH_SIZE", 2)
+    app.dependency_overrides[get_searcher] = lambda: StubBatchSearcher(fail_after=1)
+    response = TestClient(app).post(
+        "/search/batch", json={"queries": ["hat", "boots", "scarf"]}
+    )
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line.get("query_index") for line in lines] == [0, 1, None]
+    assert lines[-1] == {"error": "Error searching the products."}
+
+
+def test_batch_search_needs_a_leg(app):
+    app.dependency_overrides[get_searcher] = StubBatchSearcher
+    response = TestClient(app).post(
+        "/search/batch",
+        json={
+            "queries": ["hat"],
+            "enable_vector_search": False,
+            "enable_text_search": False,
+        },
+    )
+    assert response.status_code == 422
+    assert TestClient(app).post("/search/batch", json={"queries": []}).status_code == 422
+
+
+class StubSearcher:
+    """
+    Ranks `total` products, paged as the searcher does.
+    """
+
+    def __init__(self, total=25):
+        self.total = total
+        self.calls = []
+
+    async def asearch_and_embed(self, query, top, offset, facets, **options):
+        self.calls.append(dict(options, top=top, offset=offset, facets=facets))
+        return SearchResults(
+            [
+                StubProduct(id=i, name=query, search_info={"score": -i})
+                for i in range(offset, min(offset + top, self.total))
+            ],
+            {"category": {"Hats": self.total}} if facets else None,
+        )
+
+
+@pytest.fixture
+def searcher(app, monkeypatch):
+    monkeypatch.setattr(config, "SEARCH_MAX_RESULTS", 200)
+    searcher = StubSearcher()
+    app.dependency_overrides[get_searcher] = lambda: searcher
+    return searcher
+
+
+def test_search_pages(app, searcher):
+    client = TestClient(app)
+    page = client.post("/search", json={"query": "hat", "limit": 10}).json()
+    assert [product["id"] for product in page["products"]] == list(range(10))
+    assert (page["offset"], page["limit"], page["next_offset"]) == (0, 10, 10)
+    assert "facets" not in page
+    # One more row tells whether there is a next page.
+    assert searcher.calls[-1]["top"] == 11
+    assert searcher.calls[-1]["candidates"] == 200
+
+    page = client.post(
+        "/search", json={"query": "hat", "limit": 10, "offset": 20, "facets": True}
+    ).json()
+    assert [product["id"] for product in page["products"]] == list(range(20, 25))
+    assert page["next_offset"] is None
+    assert page["products"][0]["search_info"] == {"score": -20}
+    assert page["facets"] == {"category": {"Hats": 25}}
+
+
+def test_search_rejects_pages_past_the_candidates(app, searcher):
+    response = TestClient(app).post(
+        "/search", json={"query": "hat", "limit": 20, "offset": 190}
+    )
+    assert response.status_code == 422
+    assert response.json() == {"detail": "Only the first 200 results can be paged."}
+    assert searcher.calls == []
+
+
+def test_search_needs_a_leg(app, searcher):
+    response = TestClient(app).post(
+        "/search",
+        json={"query": "hat", "enable_vector_search": False, "enable_text_search": False},
+    )
+    assert response.status_code == 422
+
+
+class StubNeighbors:
+    k = 5
+
+    def __init__(self, precomputed=True):
+        self.precomputed = precomputed
+
+    async def aneighbors(self, product_id, top):
+        if not self.precomputed:
+            return SearchResults()
+        return SearchResults(
+            [StubProduct(id=i, name="near", search_info={}) for i in range(top)]
+        )
+
+
+class StubSimilarSearcher:
+    def __init__(self):
+        self.calls = []
+
+    async def asimilar_to(self, product_id, top, filters):
+        self.calls.append((product_id, top, filters))
+        if product_id == 404:
+            return None
+        return SearchResults([StubProduct(id=1, name="live", search_info={})])
+
+
+@pytest.fixture
+def similar(app):
+    def configure(precomputed=True):
+        searcher = StubSimilarSearcher()
+        app.dependency_overrides[get_searcher] = lambda: searcher
+        app.dependency_overrides[get_neighbor_index] = lambda: StubNeighbors(
+            precomputed
+        )
+        return TestClient(app), searcher
+
+    return configure
+
+
+def test_similar_reads_the_precomputed_neighbors(similar):
+    client, searcher = similar()
+    response = client.get("/products/3/similar?top=2").json()
+    assert response["source"] == "precomputed"
+    assert [product["id"] for product in response["products"]] == [0, 1]
+    assert searcher.calls == []
+
+
+@pytest.mark.parametrize(
+    "query, precomputed, filters",
+    [
+        ("top=6", True, None),
+        ("live=true", True, None),
+        ("filters=%5B%7B%22column%22%3A%20%22price%22%7D%5D", True, [{"column": "price"}]),
+        ("", False, None),
+    ],
+)
+def test_similar_searches_live(similar, query, precomputed, filters):
+    client, searcher = similar(precomputed)
+    response = client.get(f"/products/3/similar?{query}").json()
+    assert response["source"] == "live"
+    assert searcher.calls[0][0] == 3
+    assert searcher.calls[0][2] == filters
+
+
+def test_similar_errors(similar):
+    client, _ = similar(precomputed=False)
+    assert client.get("/products/404/similar").status_code == 404
+    response = client.get("/products/3/similar?filters=price")
+    assert response.status_code == 422
+    assert response.json() == {"detail": "filters must be JSON encoded."}
@@ -0,0 +1,146 @@
+"""
+    Tests of services.semantic_cache with the in-process store.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from services import semantic_cache
+from services.semantic_cache import (
+    CatalogVersionTracker,
+    MemorySemanticStore,
+    SemanticCache,
+)
+
+
+class FixedVersion:
+    """
+    Stands in for the CatalogVersionTracker, the version is set by the tests.
+    """
+
+    def __init__(self, version: int = 1):
+        self.version = version
+        self.invalidations = 0
+
+    def current(self) -> int:
+        return self.version
+
+    def invalidate(self):
+        self.invalidations += 1
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(semantic_cache.time, "time", clock.time)
+    return clock
+
+
+def cache(threshold=0.9, ttl=60, max_size=16, version=None):
+    return SemanticCache(
+        MemorySemanticStore(max_size), threshold, ttl, version or FixedVersion()
+    )
+
+
+def test_similar_queries_share_the_answer(clock):
+    semantic = cache()
+    semantic.set([1.0, 0.0], "red hat", "Found a red hat.", [3, 1])
+    hit = semantic.get([0.99, 0.05])
+    assert hit["response"] == "Found a red hat."
+    assert hit["product_ids"] == [3, 1]
+    assert hit["similarity"] == pytest.approx(0.9987, abs=1e-4)
+    assert semantic.get([0.5, 0.5]) is None
+    assert semantic.stats() == {
+        "size": 1,
+        "hits": 1,
+        "misses": 1,
+        "stores": 1,
+        "hit_rate": 0.5,
+    }
+
+
+def test_entries_expire(clock):
+    semantic = cache(ttl=60)
+    semantic.set([1.0, 0.0], "red hat", "Found a red hat.", [])
+    clock.now += 59
+    assert semantic.get([1.0, 0.0]) is not None
+    clock.now += 2
+    assert semantic.get([1.0, 0.0]) is None
+
+
+def test_entries_of_another_catalog_version_are_ignored(clock):
+    version = FixedVersion(1)
+    semantic = cache(version=version)
+    semantic.set([1.0, 0.0], "red hat", "Found a red hat.", [])
+    version.version = 2
+    assert semantic.get([1.0, 0.0]) is None
+    # Storing under the new version drops the stale entries.
+    semantic.set([0.0, 1.0], "blue hat", "Found a blue hat.", [])
+    assert semantic.stats()["size"] == 1
+
+
+def test_oldest_entries_are_evicted(clock):
+    semantic = cache(max_size=2)
+    for i, vector in enumerate(([1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0])):
+        semantic.set(vector, f"query {i}", f"answer {i}", [])
+    assert semantic.stats()["size"] == 2
+    assert semantic.get([1.0, 0.0, 0.0]) is None
+    assert semantic.get([0.0, 0.0, 1.0])["response"] == "answer 2"
+
+
+def test_invalidate_drops_all_the_entries(clock):
+    version = FixedVersion()
+    semantic = cache(version=version)
+    semantic.set([1.0, 0.0], "red hat", "Found a red hat.", [])
+    semantic.invalidate()
+    assert semantic.get([1.0, 0.0]) is None
+    assert version.invalidations == 1
+
+
+def test_catalog_version_is_read_once_per_ttl(monkeypatch):
+    versions = iter([7, 8])
+    queries = []
+
+    class Session:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def execute(self, stmt):
+            queries.append(str(stmt))
+            return SimpleNamespace(scalar=lambda: next(versions))
+
+    monkeypatch.setattr(semantic_cache, "get_db_session", Session)
+    tracker = CatalogVersionTracker(ttl=60)
+    assert tracker.current() == 7
+    assert tracker.current() == 7
+    assert len(queries) == 1
+    assert "catalog_version_seq" in queries[0]
+    tracker.invalidate()
+    assert tracker.current() == 8
+
+
+def test_changes_ignore_the_earlier_entries(clock):
+    version = FixedVersion()
+    semantic = cache(version=version)
+    semantic.set([1.0, 0.0], "red hat", "Found a red hat.", [])
+    clock.now += 1
+    # The entry may have been answered from the catalog before the change,
+    # even if the version it was stored under is still current.
+    semantic.apply_changes(SimpleNamespace(ids=[3], full=False))
+    assert version.invalidations == 1
+    assert semantic.get([1.0, 0.0]) is None
+    clock.now += 1
+    semantic.set([1.0, 0.0], "red hat", "Found another red hat.", [])
+    assert semantic.get([1.0, 0.0])["response"] == "Found another red hat."
@@ -0,0 +1,190 @@
+"""
+    Tests of services.tool_executor.
+"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+from models.database import statement_deadline, statement_timeout_ms
+from services.tool_executor import ToolExecutor, ToolFailure, ToolLoopBudget
+
+
+def tool_call(name: str, arguments: str = "{}"):
+    return SimpleNamespace(function=SimpleNamespace(name=name, arguments=arguments))
+
+
+def test_failures_are_counted():
+    def search(search_query):
+        if search_query == "boom":
+            raise RuntimeError("search failed")
+        return search_query, []
+
+    executor = ToolExecutor({"search": search})
+    results = executor.execute(
+        [
+            tool_call("search", '{"search_query": "ok"}'),
+            tool_call("search", '{"search_query": "boom"}'),
+            tool_call("missing"),
+        ]
+    )
+    assert results[0] == ("ok", [])
+    assert results[1] == ("search failed", [])
+    assert isinstance(results[1], ToolFailure)
+    assert results[2] == ("Unknown tool 'missing'", [])
+    assert ToolExecutor.failures(results) == 2
+
+
+def test_budget_is_degraded_by_failed_calls():
+    budget = ToolLoopBudget(max_iterations=5, time_budget=60)
+    budget.record(0.1, 0.1, tool_calls=2)
+    assert not budget.degraded
+    budget.record(0.1, 0.1, tool_calls=2, failed_calls=1)
+    assert budget.degraded
+    assert budget.summary()["degraded"]
+
+
+def test_budget_is_degraded_by_a_forced_answer():
+    budget = ToolLoopBudget(max_iterations=2, time_budget=60)
+    assert budget.tool_choice() == "auto"
+    assert not budget.degraded
+    budget.record(0.1, 0.1, tool_calls=1)
+    assert budget.tool_choice() == "none"
+    assert budget.degraded
+
+
+def test_budget_is_degraded_by_the_time_budget():
+    budget = ToolLoopBudget(max_iterations=5, time_budget=0.01)
+    time.sleep(0.02)
+    assert budget.tool_choice() == "none"
+    assert budget.degraded
+
+
+def test_timed_out_calls_release_the_workers():
+    calls = []
+
+    def slow_search(search_query):
+        # Stands for a search whose statements stop shortly after the
+        # deadline, once the server noticed the statement timeout.
+        calls.append(search_query)
+        deadline = statement_deadline.get()
+        while deadline is not None and time.monotonic() < deadline + 0.05:
+            time.sleep(0.005)
+        raise TimeoutError("canceling statement due to statement timeout")
+
+    executor = ToolExecutor({"search": slow_search}, max_workers=1)
+    results = executor.execute(
+        [
+            tool_call("search", '{"search_query": "first"}'),
+            tool_call("search", '{"search_query": "second"}'),
+        ],
+        timeout=0.05,
+    )
+    assert results == [("The tool call timed out.", [])] * 2
+    assert ToolExecutor.failures(results) == 2
+    # The queued call was cancelled rather than left to run on the worker,
+    # which is free again once the running call reached its deadline.
+    started = time.monotonic()
+    executor.pool.submit(lambda: None).result(timeout=1)
+    assert time.monotonic() - started < 0.5
+    assert calls == ["first"]
+
+
+def test_async_calls_get_the_deadline():
+    deadlines = []
+
+    async def search(search_query):
+        deadlines.append(statement_deadline.get())
+        return search_query, []
+
+    executor = ToolExecutor({}, {"search": search})
+    before = time.monotonic()
+    results = asyncio.run(
+        executor.aexecute([tool_call("search", '{"search_query": "a"}')], timeout=5)
+    )
+    assert results == [("a", [])]
+    assert before + 5 <= deadlines[0] <= time.monotonic() + 5
+    assert statement_deadline.get() is None
+
+
+def test_statement_timeout_ms():
+    assert statement_timeout_ms() is None
+    token = statement_deadline.set(time.monotonic() + 2)
+    try:
+        assert 1900 < statement_timeout_ms() <= 2000
+        statement_deadline.set(time.monotonic() - 1)
+        # 0 would disable the timeout.
+        assert statement_timeout_ms() == 1
+    finally:
+        statement_deadline.reset(token)
+
+
+def test_tool_choice_allows_tools_until_the_last_iteration():
+    budget = ToolLoopBudget(max_iterations=3, time_budget=60)
+    choices = []
+    for _ in range(3):
+        choices.append(budget.tool_choice())
+        budget.record(0.1, 0.1, tool_calls=1)
+    assert choices == ["auto", "auto", "none"]
+    assert [i["iteration"] for i in budget.summary()["iterations"]] == [1, 2, 3]
+    # A single iteration is always the final answer.
+    assert ToolLoopBudget(max_iterations=1, time_budget=60).tool_choice() == "none"
+
+
+def test_calls_run_concurrently_in_order():
+    def search(search_query, delay):
+        time.sleep(delay)
+        return search_query, []
+
+    executor = ToolExecutor({"search": search}, max_workers=3)
+    started = time.monotonic()
+    results = executor.execute(
+        [
+            tool_call("search", f'{{"search_query": "{query}", "delay": {delay}}}')
+            for query, delay in (("a", 0.2), ("b", 0.1), ("c", 0.0))
+        ],
+        timeout=5,
+    )
+    assert results == [("a", []), ("b", []), ("c", [])]
+    assert time.monotonic() - started < 0.3
+
+
+def test_async_timed_out_calls_are_cancelled():
+    cancelled = []
+
+    async def search(search_query):
+        try:
+            await asyncio.sleep(0 if search_query == "fast" else 5)
+        except asyncio.CancelledError:
+            cancelled.append(search_query)
+            raise
+        return search_query, []
+
+    executor = ToolExecutor({}, {"search": search})
+    results = asyncio.run(
+        executor.aexecute(
+            [
+                tool_call("search", '{"search_query": "fast"}'),
+                tool_call("search", '{"search_query": "slow"}'),
+            ],
+            timeout=0.05,
+        )
+    )
+    assert results == [("fast", []), ("The tool call timed out.", [])]
+    assert cancelled == ["slow"]
+
+
+def test_merge_products_interleaves_and_deduplicates():
+    def products(*ids):
+        return [SimpleNamespace(id=id) for id in ids]
+
+    merged = ToolExecutor.merge_products(
+        [
+            ("first", products(1, 2, 3, 4)),
+            ToolFailure("failed"),
+            ("second", products(5, 1, 6)),
+            ("third", products(2)),
+        ]
+    )
+    assert [product.id for product in merged] == [1, 5, 2, 3, 6, 4]
+    assert ToolExecutor.merge_products([]) == []
@@ -0,0 +1,126 @@
+"""
+    Tests of services.tool_results.ToolResultSerializer.
+"""
+
+from types import SimpleNamespace
+
+from services.tokens import estimate_tokens
+from services.tool_results import ToolResultSerializer, truncate
+
+
+def product(**fields):
+    defaults = {
+        "name": "Summer Dress",
+        "category": "Summer Wear",
+        "age_group": "3-6",
+        "price": 20,
+        "currency": "USD",
+        "rating": 4,
+        "description": "A light cotton dress.",
+        "sizes": ["S", "M"],
+        "available_stock": 5,
+        "content": "Summer Dress, a light cotton dress.",
+    }
+    defaults.update(fields)
+    return SimpleNamespace(**defaults)
+
+
+def test_truncate():
+    assert truncate("short  text", 20) == "short text"
+    assert truncate("a light cotton dress, for summer", 20) == "a light cotton…"
+    assert len(truncate("word " * 100, 50)) <= 50
+
+
+def test_no_products():
+    assert ToolResultSerializer().serialize([]) == (
+        "No products found for the given search query."
+    )
+
+
+def test_full_mode():
+    products = [product(content="first"), product(content="second")]
+    assert ToolResultSerializer(compact=False, max_tokens=1).serialize(products) == (
+        "Retrieved the following products based on your search query:\nfirst\nsecond"
+    )
+
+
+def test_compact_mode():
+    products = [
+        product(),
+        product(
+            name="Rain Coat",
+            category="Outerwear",
+            age_group=None,
+            price=35.5,
+            rating=None,
+            description="",
+            sizes=["M", "L"],
+            available_stock=0,
+        ),
+    ]
+    assert ToolResultSerializer().serialize(products).splitlines() == [
+        "Found 2 products.",
+        "Price range: 20-35.5 USD",
+        "Categories: Summer Wear (1), Outerwear (1)",
+        "Age groups: 3-6 (1)",
+        "Sizes: S, M, L",
+        "In stock: 1 of 2",
+        "Products:",
+        "- Summer Dress | Summer Wear | 3-6 | 20 USD | rating 4 | A light cotton dress.",
+        "- Rain Coat | Outerwear | 35.5 USD",
+    ]
+
+
+def test_fields_and_description_chars():
+    serializer = ToolResultSerializer(("name", "sizes", "description"), description_chars=12)
+    assert serializer.product_line(product()) == "- Summer Dress | S, M | A light…"
+
+
+def test_price_ranges_per_currency():
+    products = [product(price=10), product(price=30), product(price=8, currency="EUR")]
+    assert ToolResultSerializer.summary(products)[1] == (
+        "Price range: 10-30 USD, 8-8 EUR"
+    )
+
+
+def test_token_budget():
+    products = [product(name=f"Dress {i}") for i in range(50)]
+    serializer = ToolResultSerializer(max_tokens=120)
+    result = serializer.serialize(products)
+    assert estimate_tokens(result) <= 120
+    lines = result.splitlines()
+    listed = [line for line in lines if line.startswith("- ")]
+    assert 0 < len(listed) < 50
+    assert listed[0].startswith("- Dress 0 |")
+    assert lines[-1] == f"({50 - len(listed)} more products not listed)"
+    # The full list fits a larger budget.
+    lines = ToolResultSerializer(max_tokens=10_000).serialize(products).splitlines()
+    assert len([line for line in lines if line.startswith("- ")]) == 50
+    assert "more products not listed" not in lines[-1]
+
+
+def test_last_product_uses_the_room_of_the_trailer():
+    products = [product(name="Dress 0"), product(name="Dress 1")]
+    full = ToolResultSerializer(max_tokens=10_000).serialize(products)
+    result = ToolResultSerializer(max_tokens=estimate_tokens(full)).serialize(products)
+    assert result == full
+
+
+def test_budget_smaller_than_the_summary():
+    products = [
+        product(name=f"Item {i}", category=f"Category number {i}", sizes=[f"S{i}"])
+        for i in range(40)
+    ]
+    for max_tokens in (40, 20, 8):
+        result = ToolResultSerializer(max_tokens=max_tokens).serialize(products)
+        lines = result.splitlines()
+        assert estimate_tokens(result) <= max_tokens
+        assert lines[0] == "Found 40 products."
+        assert not any(line.startswith("- ") for line in lines)
+    lines = ToolResultSerializer(max_tokens=40).serialize(products).splitlines()
+    assert lines[-1] == "(40 more products not listed)"
+    assert any(line.startswith("Categories: ") and line.endswith("…") for line in lines)
+
+
+def test_tiny_budget():
+    assert estimate_tokens(ToolResultSerializer(max_tokens=2).serialize([product()])) <= 2
@@ -0,0 +1,135 @@
+"""
+    Tests of the ANN index and operator registry of models.vector_index.
+"""
+
+import pytest
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.schema import CreateIndex
+
+from models.vector_index import (
+    build_vector_index,
+    distance_operator,
+    index_distance_sql,
+    is_compact_index,
+    similarity_sql,
+)
+
+
+def vector_model(metric="cosine", method="hnsw", options=None, **attributes):
+    base = declarative_base()
+
+    class Item(base):
+        __tablename__ = "Item"
+        vector_metric = metric
+        vector_index_method = method
+        vector_index_options = options
+        vector_index_type = "vector"
+        vector_index_dimensions = None
+        partial_vector_index_column = "category"
+
+        id = Column(Integer, primary_key=True)
+        category = Column(String)
+        embedding = Column(Vector(8))
+
+        @staticmethod
+        def get_embedding_field():
+            return "embedding"
+
+    for name, value in attributes.items():
+        setattr(Item, name, value)
+    return Item
+
+
+def create_index_sql(index) -> str:
+    return " ".join(str(CreateIndex(index).compile(dialect=postgresql.dialect())).split())
+
+
+@pytest.mark.parametrize(
+    "metric, operator, opclass, similarity",
+    [
+        ("cosine", "<=>", "vector_cosine_ops", "1 - (d)"),
+        ("ip", "<#>", "vector_ip_ops", "-(d)"),
+        ("l2", "<->", "vector_l2_ops", "-(d)"),
+    ],
+)
+def test_index_and_operator_share_the_metric(metric, operator, opclass, similarity):
+    model = vector_model(metric)
+    assert distance_operator(model) == operator
+    assert similarity_sql(model, "d") == similarity
+    assert create_index_sql(build_vector_index(model)) == (
+        f"CREATE INDEX hnsw_index_for_{metric}_item_embedding ON \"Item\" "
+        f"USING hnsw (embedding {opclass}) WITH (m = 16, ef_construction = 64)"
+    )
+
+
+def test_index_method_options():
+    model = vector_model("l2", "ivfflat", {"lists": 10})
+    assert create_index_sql(build_vector_index(model)) == (
+        'CREATE INDEX ivfflat_index_for_l2_item_embedding ON "Item" '
+        "USING ivfflat (embedding vector_l2_ops) WITH (lists = 10)"
+    )
+
+
+def test_partial_index():
+    sql = create_index_sql(build_vector_index(vector_model(), "Kids' Shoes"))
+    assert sql.startswith("CREATE INDEX hnsw_index_for_cosine_item_embedding_kids_shoes ")
+    assert sql.endswith("WHERE category = 'Kids'' Shoes'")
+
+
+@pytest.mark.parametrize(
+    "attributes, message",
+    [
+        ({"metric": "dot"}, "Unknown vector metric 'dot'"),
+        ({"method": "diskann"}, "Unknown vector index method 'diskann'"),
+    ],
+)
+def test_unknown_metric_or_method(attributes, message):
+    with pytest.raises(ValueError, match=message):
+        build_vector_index(vector_model(**attributes))
+
+
+@pytest.mark.parametrize(
+    "index_type, dimensions, expression, opclass",
+    [
+        ("halfvec", None, "CAST(embedding AS halfvec(8))", "halfvec_cosine_ops"),
+        (
+            "vector",
+            4,
+            "CAST(subvector(embedding, 1, 4) AS vector(4))",
+            "vector_cosine_ops",
+        ),
+        (
+            "bit",
+            4,
+            "CAST(binary_quantize(subvector(embedding, 1, 4)) AS bit(4))",
+            "bit_hamming_ops",
+        ),
+    ],
+)
+def test_compact_indexes(index_type, dimensions, expression, opclass):
+    model = vector_model(vector_index_type=index_type, vector_index_dimensions=dimensions)
+    assert is_compact_index(model)
+    name = f"hnsw_index_for_cosine_item_embedding_{index_type}{dimensions or 8}"
+    assert create_index_sql(build_vector_index(model)) == (
+        f'CREATE INDEX {name} ON "Item" USING hnsw (({expression}) {opclass}) '
+        "WITH (m = 16, ef_construction = 64)"
+    )
+    operator = "<~>" if index_type == "bit" else "<=>"
+    assert index_distance_sql(model, "q") == (
+        f"{expression} {operator} {expression.replace('embedding', 'q')}"
+    )
+
+
+def test_full_vector_index_is_not_compact():
+    model = vector_model(vector_index_dimensions=8)
+    assert not is_compact_index(model)
+    assert index_distance_sql(model, "q") == "embedding <=> q"
+
+
+@pytest.mark.parametrize("dimensions", [9, 1536])
+def test_compact_index_dimensions_are_checked(dimensions):
+    with pytest.raises(ValueError, match="between 1 and 8"):
+        build_vector_index(vector_model(vector_index_dimensions=dimensions))
@@ -0,0 +1,197 @@
+"""
+    Tests of the in-process vector search tier of services.vector_snapshot,
+    against exact NumPy searches. The snapshots are written in the layout of
+    `build_snapshot` without a database.
+"""
+
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from models.product import Product
+from services.vector_snapshot import (
+    POINTER_FILE,
+    SnapshotOverlay,
+    VectorSnapshot,
+    VectorSnapshotTier,
+    kmeans,
+    nearest_lists,
+    snapshot_path,
+)
+
+
+def write_snapshot(
+    directory, ids, vectors, metric="cosine", lists=0, catalog_version=1, xmin=0
+):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if metric == "cosine":
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = np.asarray(ids, dtype=np.int64)
+    version = f"{catalog_version}-{len(os.listdir(directory)) + 1}"
+    if lists:
+        centroids = kmeans(vectors, lists, metric)
+        labels = nearest_lists(vectors, centroids, metric)
+        order = np.argsort(labels, kind="stable")
+        ids, vectors = ids[order], vectors[order]
+        np.save(snapshot_path(directory, version, "centroids"), centroids)
+        np.save(
+            snapshot_path(directory, version, "offsets"),
+            np.searchsorted(labels[order], np.arange(lists + 1)),
+        )
+    np.save(snapshot_path(directory, version, "ids"), ids)
+    np.save(snapshot_path(directory, version, "vectors"), vectors)
+    if metric == "l2":
+        np.save(snapshot_path(directory, version, "norms"), np.sum(vectors**2, axis=1))
+    meta = {
+        "version": version,
+        "catalog_version": catalog_version,
+        "xmin": xmin,
+        "table": "Product",
+        "metric": metric,
+        "dimensions": vectors.shape[1],
+        "dtype": "float32",
+        "rows": len(ids),
+        "lists": lists,
+    }
+    with open(snapshot_path(directory, version, "meta"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    with open(os.path.join(directory, POINTER_FILE), "w", encoding="utf-8") as f:
+        f.write(version)
+    return version
+
+
+def exact_search(ids, vectors, query, k, metric):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    query = np.asarray(query, dtype=np.float32)
+    if metric == "cosine":
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        scores = vectors @ (query / np.linalg.norm(query))
+    elif metric == "ip":
+        scores = vectors @ query
+    else:
+        scores = -np.linalg.norm(vectors - query, axis=1)
+    best = np.argsort(-scores, kind="stable")[:k]
+    return np.asarray(ids)[best], scores[best]
+
+
+@pytest.fixture
+def catalog():
+    rng = np.random.default_rng(7)
+    # Clustered rows, as IVF expects.
+    centers = rng.standard_normal((8, 16))
+    vectors = centers[rng.integers(0, 8, 2000)] + 0.3 * rng.standard_normal((2000, 16))
+    ids = rng.permutation(np.arange(1, 2001))
+    queries = centers + 0.3 * rng.standard_normal((8, 16))
+    return ids, vectors, queries
+
+
+@pytest.mark.parametrize("metric", ["cosine", "ip", "l2"])
+def test_exact_scan_matches_numpy(tmp_path, catalog, metric):
+    ids, vectors, queries = catalog
+    snapshot = VectorSnapshot(tmp_path, write_snapshot(tmp_path, ids, vectors, metric))
+    for query in queries:
+        found_ids, found_scores = snapshot.search(query.tolist(), 10)
+        expected_ids, expected_scores = exact_search(ids, vectors, query, 10, metric)
+        assert found_ids.tolist() == expected_ids.tolist()
+        assert np.allclose(found_scores, expected_scores, atol=1e-4)
+
+
+@pytest.mark.parametrize("metric", ["cosine", "l2"])
+def test_ivf_search(tmp_path, catalog, metric):
+    ids, vectors, queries = catalog
+    snapshot = VectorSnapshot(
+        tmp_path, write_snapshot(tmp_path, ids, vectors, metric, lists=16)
+    )
+    recalls = []
+    for query in queries:
+        expected_ids, _ = exact_search(ids, vectors, query, 10, metric)
+        # Probing every list is an exact search.
+        assert snapshot.search(query.tolist(), 10, probes=16)[0].tolist() == (
+            expected_ids.tolist()
+        )
+        found_ids, _ = snapshot.search(query.tolist(), 10, probes=4)
+        recalls.append(len(set(found_ids.tolist()) & set(expected_ids.tolist())) / 10)
+    assert np.mean(recalls) >= 0.9
+
+
+def test_overlay_replaces_the_snapshot_rows(tmp_path):
+    ids = [1, 2, 3]
+    vectors = [[1.0, 0.0], [0.8, 0.6], [0.0, 1.0]]
+    snapshot = VectorSnapshot(tmp_path, write_snapshot(tmp_path, ids, vectors))
+    query = [1.0, 0.0]
+    assert snapshot.search(query, 3)[0].tolist() == [1, 2, 3]
+
+    overlay = SnapshotOverlay("cosine", 2).update(
+        {1: 10, 3: 11, 4: 12},
+        # Product 1 lost its embedding, 3 moved next to the query and 4 is new.
+        {1: None, 3: [2.0, 0.1], 4: [0.6, 0.8]},
+    )
+    found_ids, found_scores = snapshot.search(query, 3, overlay=overlay)
+    assert found_ids.tolist() == [3, 2, 4]
+    assert found_scores[0] == pytest.approx(2.0 / np.hypot(2.0, 0.1), abs=1e-6)
+    assert snapshot.search(query, 10, overlay=overlay)[0].tolist() == [3, 2, 4]
+
+
+def test_overlay_keeps_the_last_transaction():
+    overlay = SnapshotOverlay("l2", 2).update({1: 20, 2: 5}, {1: [1.0, 1.0], 2: None})
+    overlay = overlay.update({1: 10}, {1: [2.0, 2.0]})
+    assert overlay.entries[1][0] == 20
+    assert overlay.norms.tolist() == [8.0]
+    # A snapshot taken with xmin 6 already contains the change of xid 5.
+    assert sorted(overlay.since(6).entries) == [1]
+    assert len(overlay.since(21)) == 0
+
+
+class FixedVersion:
+    def __init__(self, version):
+        self.version = version
+
+    def current(self):
+        return self.version
+
+    def invalidate(self):
+        pass
+
+
+def change_batch(versions, embedding_ids, xid, full=False):
+    return SimpleNamespace(
+        versions=versions,
+        events=[{"xid": xid, "embedding_ids": embedding_ids}],
+        full=full,
+    )
+
+
+@pytest.fixture
+def tier(tmp_path, monkeypatch):
+    # The snapshot must match the dimensions of the model.
+    monkeypatch.setattr(Product.embedding.type, "dim", 2)
+    write_snapshot(tmp_path, [1, 2], [[1.0, 0.0], [0.0, 1.0]], catalog_version=5)
+    tier = VectorSnapshotTier(Product, str(tmp_path), max_changes=2)
+    tier.catalog_version = FixedVersion(5)
+    tier.fetch_embeddings = lambda ids: {id: [-1.0, 0.0] for id in ids}
+    monkeypatch.setattr(tier, "start", lambda: None)
+    tier.refresh()
+    return tier
+
+
+def test_tier_applies_the_changes(tier):
+    assert tier.search([1.0, 0.0], 1) == ([1], [pytest.approx(1.0)])
+    tier.catalog_version.version = 6
+    tier.refresh()
+    # Stale until the change of version 6 is received.
+    assert tier.search([1.0, 0.0], 1) is None
+    tier.apply_changes(change_batch([6], [1], xid=30))
+    assert tier.search([1.0, 0.0], 2)[0] == [2, 1]
+    assert tier.overlay.entries[1][0] == 30
+    assert tier.stats()["changes"] == 1
+
+
+def test_tier_is_stale_past_max_changes(tier):
+    tier.catalog_version.version = 6
+    tier.apply_changes(change_batch([6], [1, 2, 3], xid=30))
+    assert tier.search([1.0, 0.0], 1) is None
+    assert tier.missed_xid == 31
+    assert len(tier.overlay) == 0
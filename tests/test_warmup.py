@@ -0,0 +1,92 @@
+"""
+    Tests of the worker warmup of services.warmup, against a scripted
+    database session.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from config.main import config
+from models.product import Product
+from services import warmup
+
+
+class ScriptedSession:
+    """
+    Answers the warmup statements: pg_prewarm is installed when `installed`
+    and the prewarm lock is free when `unlocked`.
+    """
+
+    def __init__(self, installed=True, unlocked=True):
+        self.installed = installed
+        self.unlocked = unlocked
+        self.statements = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, stmt, params=None):
+        sql = str(stmt)
+        self.statements.append((sql, params))
+        if "pg_extension" in sql:
+            value = 1 if self.installed else None
+        elif "pg_try_advisory_xact_lock" in sql:
+            value = self.unlocked
+        elif "pg_prewarm" in sql:
+            value = 42
+        else:
+            value = 1
+        return SimpleNamespace(scalar=lambda: value)
+
+    async def commit(self):
+        pass
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = ScriptedSession()
+    monkeypatch.setattr(warmup, "get_async_db_session", lambda: session)
+    return session
+
+
+def test_prewarm_reads_the_indexes(session, monkeypatch):
+    monkeypatch.setattr(config, "WARMUP_PREWARM_TABLE", True)
+    assert asyncio.run(warmup.prewarm(Product)) == 42
+    relations = session.statements[-1][1]["relations"]
+    assert "gin_index_product_content_tsv" in relations
+    assert relations[-1] == "Product"
+
+
+@pytest.mark.parametrize("installed, unlocked", [(False, True), (True, False)])
+def test_prewarm_is_skipped(session, installed, unlocked):
+    session.installed, session.unlocked = installed, unlocked
+    assert asyncio.run(warmup.prewarm(Product)) is None
+    assert not any("pg_prewarm(oid)" in sql for sql, _ in session.statements)
+
+
+def test_warmup_runs_the_queries(session, monkeypatch):
+    monkeypatch.setattr(config, "WARMUP_QUERIES", "red hat, rain boots,")
+    monkeypatch.setattr(config, "WARMUP_CONNECTIONS", 3)
+    queries = []
+
+    async def asearch_and_embed(query):
+        queries.append(query)
+
+    searcher = SimpleNamespace(db_model=Product, asearch_and_embed=asearch_and_embed)
+    asyncio.run(warmup.warmup(searcher))
+    assert queries == ["red hat", "rain boots"]
+    assert [sql for sql, _ in session.statements].count("SELECT 1") == 3
+
+
+def test_warmup_failures_are_logged(monkeypatch, caplog):
+    def unavailable():
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr(warmup, "get_async_db_session", unavailable)
+    asyncio.run(warmup.warmup(SimpleNamespace(db_model=Product)))
+    assert "Warmup failed" in caplog.text